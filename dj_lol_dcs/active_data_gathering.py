@@ -5,22 +5,22 @@ import json
 import time
 import math
 
-import lolapi.app_lib.riotapi_endpoints as riotapi_endpoints
-from lolapi.app_lib.regional_riotapi_hosts import RegionalRiotapiHosts
-from lolapi.app_lib.riot_api import RiotApi
-from lolapi.app_lib.api_key_container import ApiKeyContainer, MethodRateLimits
+from lolapi.app_lib.riot_api_factory import build_riot_api_from_env
 from lolapi.app_lib.exceptions import RiotApiError, ConfigurationError, RatelimitMismatchError, MatchTakenError
+from lolapi.app_lib.exceptions import RetriesExhaustedError
+from lolapi.app_lib.retry_policy import RetryPolicy
 
 import django
 os.environ['DJANGO_SETTINGS_MODULE'] = 'dj_lol_dcs.settings'
 django.setup()
 from lolapi.models import HistoricalMatch
 from lolapi.app_lib.enumerations import Tiers
-from lolapi.app_lib.mysql_requesthistory_checking import MysqlRequestHistory
+from lolapi.app_lib.request_priorities import RequestPriorities
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError
 from lolapi.app_lib.utils import get_or_create_game_version, get_or_create_region, get_existing_summoner_or_none
 from lolapi.app_lib.utils import update_or_create_summoner
+from lolapi.app_lib.utils import request_and_return_match_results, save_participant_summoners_and_match_tier
 from lolapi.app_lib.utils import request_and_link_timeline_to_match, request_and_return_ongoing_match_or_none
 from lolapi.app_lib.utils import create_champion_lane_mapping, get_stats_history
 
@@ -42,27 +42,10 @@ def persist_ongoing_match_and_get_participant_summoners(riotapi, known_tiers, re
 
     # Get identities, tiers of the participants (20 requests)
     # then calculate the average match tier
-    teams_tiers = {}
-    participant_summoners = []
-    # Gather all tiers in a dict {team_key: [tier_and_misc, ..], ..}
-    for p in ongoing_match_dict['participants']:
-        api_p_summoner_dict = request_and_return_summoner(region.name, p['summonerName'], riotapi, retries=2)
-        p_summoner = update_or_create_summoner(region, api_p_summoner_dict)
-        participant_summoners.append(p_summoner)
-        api_tiers_list = request_and_return_summoner_tiers(region.name, p_summoner.summoner_id, riotapi, retries=2)
-        participant_tier_milestone = update_summoner_tier_history(p_summoner, api_tiers_list)
-        if p['teamId'] not in teams_tiers:
-            teams_tiers[p['teamId']] = []
-        teams_tiers[p['teamId']].append({'champion_id': p['championId'], 'tier': participant_tier_milestone.tier})
-    # Calculate avg tier per team
-    teams_avg_tiers = []
-    for team_id, team in teams_tiers.items():
-        teams_avg_tiers.append(known_tiers.get_average(map(lambda x: x['tier'], team)))
-    # Calculate total match avg tier
-    match_avg_tier = known_tiers.get_average(teams_avg_tiers)
-    for team_key in teams_tiers:
-        print("Tiers of team {}: {}".format(team_key, ', '.join(map(lambda t: t['tier'], teams_tiers[team_key]))))
-    print("Average tier for match is: {}".format(match_avg_tier))
+    participant_summoners, teams_tiers, match_avg_tier = save_participant_summoners_and_match_tier(riotapi,
+                                                                                                   known_tiers,
+                                                                                                   region,
+                                                                                                   ongoing_match_dict)
 
     # Save preliminary match data since avg_tier and meta_tier aren't obtainable post-game
     try:
@@ -114,7 +97,9 @@ def persist_ongoing_match_and_get_participant_summoners(riotapi, known_tiers, re
     match.save()
     try:
         print('Requesting match {} participants\' histories'.format(ongoing_match_dict['gameId']))
-        request_and_link_histories_to_match(match, riotapi, region, items_dictionaries)
+        # Histories aren't bound to the post-game window, so let the live matches' requests go first
+        request_and_link_histories_to_match(match, riotapi.with_priority(RequestPriorities.HISTORY), region,
+                                            items_dictionaries)
     except ObjectDoesNotExist:
         print("Missing static game data for game version {}. Unable to retrieve histories.".format(match_game_version.semver))
         pass
@@ -125,61 +110,42 @@ def persist_ongoing_match_and_get_participant_summoners(riotapi, known_tiers, re
     return participant_summoners
 
 
-def request_and_link_histories_to_match(match, riotapi, region, items_dictionaries, retries=0):
+def request_and_link_histories_to_match(match, riotapi, region, items_dictionaries, retries=None, retry_policy=None):
     """
-        If loading histories fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading histories fails, retry_policy (RetryPolicy by default) retries (all of them) up to N times,
+        None leaving N to the policy's default_retries
         - if still no, exit gracefully (leaving partial match data that can be filled later)
         If loading static data fails:
         - cancel loading histories, move on without the histories
     """
-    error_retries_done = 0
-    tries_permitted = 1 + retries
-    while error_retries_done < tries_permitted:
-        try:
-            m_result = json.loads(match.match_result_json)
-            m_timeline = json.loads(match.match_timeline_json)
-            stats_histories = {}
-            for i, p_identity in enumerate(m_result['participantIdentities']):
-                print('Requesting history {} / 10'.format(i+1))
-                p_id = p_identity['participantId']
-                p_data = next(filter(lambda a_p: a_p['participantId'] == p_id, m_result['participants']))
-                p_history = get_stats_history(p_identity['player']['currentAccountId'],
-                                              p_data['championId'],
-                                              create_champion_lane_mapping(m_result, m_timeline)[p_data['championId']],
-                                              set([p_data['spell1Id'], p_data['spell2Id']]),
-                                              m_result['gameCreation'],
-                                              riotapi, region, items_dictionaries,
-                                              max_weeks_lookback=3, max_games_lookback=40)
-                stats_histories[p_data['championId']] = p_history
-            match.match_participants_histories_json = json.dumps(stats_histories)
-            break
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load a historical match (HTTP Error {}) - retry in 1,2,..".format(
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-    if error_retries_done == tries_permitted:
-        print("Retried maximum of {} times - Riot API still returning errors so skipping this history for now".format(
-            retries
-        ))
+    # Lookback as deep as the per-match request budget and the quota left allow if configured, else full depth
+    request_budget = None
+    if 'HISTORY_REQUEST_BUDGET_PER_MATCH' in os.environ:
+        request_budget = int(os.environ['HISTORY_REQUEST_BUDGET_PER_MATCH']) / 10
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+
+    def request_histories():
+        m_result = json.loads(match.match_result_json)
+        m_timeline = json.loads(match.match_timeline_json)
+        stats_histories = {}
+        for i, p_identity in enumerate(m_result['participantIdentities']):
+            print('Requesting history {} / 10'.format(i+1))
+            p_id = p_identity['participantId']
+            p_data = next(filter(lambda a_p: a_p['participantId'] == p_id, m_result['participants']))
+            p_history = get_stats_history(p_identity['player']['currentAccountId'],
+                                          create_champion_lane_mapping(m_result, m_timeline)[p_data['championId']],
+                                          m_result['gameCreation'],
+                                          riotapi, region, items_dictionaries,
+                                          max_weeks_lookback=3, max_games_lookback=40,
+                                          request_budget=request_budget)
+            stats_histories[p_data['championId']] = p_history
+        return stats_histories
+
+    try:
+        stats_histories = retry_policy.run(request_histories, retries=retries, description='a historical match')
+        match.match_participants_histories_json = json.dumps(stats_histories)
+    except RetriesExhaustedError:
+        print("Riot API still returning errors so skipping this history for now")
 
 
 def main():
@@ -189,55 +155,11 @@ def main():
         sys.exit(1)
     region_name = sys.argv[1].upper()
     ratelimit_logfile_location = './{}'.format(sys.argv[2].lower()) if len(sys.argv) > 2 else None
-    api_key = os.environ['RIOT_API_KEY']
-    app_rate_limits = json.loads(os.environ['RIOT_APP_RATE_LIMITS_JSON'])  # [[num-requests, within-seconds], ..]
-    method_rate_limits = {
-        '/lol/summoner/v3/summoners/by-name/{summonerName}': {
-            'EUW': [[2000, 60]],
-            'KR': [[2000, 60]],
-            'NA': [[2000, 60]],
-            'EUNE': [[1600, 60]],
-            'BR': [[1300, 60]],
-            'TR': [[1300, 60]],
-            'LAN': [[1000, 60]],
-            'LAS': [[1000, 60]],
-            'JP': [[800, 60]],
-            'OCE': [[800, 60]],
-            'RU': [[600, 60]]
-        },
-        'leagues-v3 endpoints': {
-            'EUW': [[300, 60]],
-            'NA': [[270, 60]],
-            'EUNE': [[165, 60]],
-            'BR': [[90, 60]],
-            'KR': [[90, 60]],
-            'LAN': [[80, 60]],
-            'LAS': [[80, 60]],
-            'TR': [[60, 60]],
-            'OCE': [[55, 60]],
-            'JP': [[35, 60]],
-            'RU': [[35, 60]]
-        },
-        '/lol/match/v3/matchlists/by-account/{accountId}': [[1000, 10]],
-        '/lol/match/v3/[matches,timelines]': [[500, 10]],
-        'All other endpoints': [[20000, 10]]
-    }
 
     # API init
     tiers = Tiers()
-    riotapi = RiotApi(
-        ApiKeyContainer(
-            api_key,
-            app_rate_limits,
-            MethodRateLimits(method_rate_limits)),
-        MysqlRequestHistory(
-            os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
-            os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
-            os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
-            ratelimit_logfile_location
-        ),
-        RegionalRiotapiHosts(),
-        riotapi_endpoints)
+    # Key pool, rate limiter backend and response cache as configured by the environment (see README)
+    riotapi = build_riot_api_from_env(ratelimit_logfile_location)
     cached_items_dictionaries = {}
 
     target_summoners = []
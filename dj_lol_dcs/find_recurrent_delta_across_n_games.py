@@ -5,17 +5,14 @@ import json
 import itertools
 import argparse
 
-import lolapi.app_lib.riotapi_endpoints as riotapi_endpoints
-from lolapi.app_lib.regional_riotapi_hosts import RegionalRiotapiHosts
-from lolapi.app_lib.riot_api import RiotApi
-from lolapi.app_lib.api_key_container import ApiKeyContainer, MethodRateLimits
+from lolapi.app_lib.riot_api_factory import build_riot_api_from_env
 from lolapi.app_lib.exceptions import RiotApiError, ConfigurationError, RatelimitMismatchError, MatchTakenError
 
 import django
 os.environ['DJANGO_SETTINGS_MODULE'] = 'dj_lol_dcs.settings'
 django.setup()
 from lolapi.models import HistoricalMatch
-from lolapi.app_lib.mysql_requesthistory_checking import MysqlRequestHistory
+from lolapi.app_lib.request_priorities import RequestPriorities
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError
 from django.db.models import Q
@@ -31,54 +28,10 @@ def main(args):
     total_parsed = args.total_parsed
     ratelimit_logfile_location = './{}'.format(args.ratelimit_logfile_location.lower()) if args.ratelimit_logfile_location else None
 
-    api_key = os.environ['RIOT_API_KEY']
-    app_rate_limits = json.loads(os.environ['RIOT_APP_RATE_LIMITS_JSON'])  # [[num-requests, within-seconds], ..]
-    method_rate_limits = {
-        '/lol/summoner/v3/summoners/by-name/{summonerName}': {
-            'EUW': [[2000, 60]],
-            'KR': [[2000, 60]],
-            'NA': [[2000, 60]],
-            'EUNE': [[1600, 60]],
-            'BR': [[1300, 60]],
-            'TR': [[1300, 60]],
-            'LAN': [[1000, 60]],
-            'LAS': [[1000, 60]],
-            'JP': [[800, 60]],
-            'OCE': [[800, 60]],
-            'RU': [[600, 60]]
-        },
-        'leagues-v3 endpoints': {
-            'EUW': [[300, 60]],
-            'NA': [[270, 60]],
-            'EUNE': [[165, 60]],
-            'BR': [[90, 60]],
-            'KR': [[90, 60]],
-            'LAN': [[80, 60]],
-            'LAS': [[80, 60]],
-            'TR': [[60, 60]],
-            'OCE': [[55, 60]],
-            'JP': [[35, 60]],
-            'RU': [[35, 60]]
-        },
-        '/lol/match/v3/matchlists/by-account/{accountId}': [[1000, 10]],
-        '/lol/match/v3/[matches,timelines]': [[500, 10]],
-        'All other endpoints': [[20000, 10]]
-    }
 
     # API init
-    riotapi = RiotApi(
-        ApiKeyContainer(
-            api_key,
-            app_rate_limits,
-            MethodRateLimits(method_rate_limits)),
-        MysqlRequestHistory(
-            os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
-            os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
-            os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
-            ratelimit_logfile_location
-        ),
-        RegionalRiotapiHosts(),
-        riotapi_endpoints)
+    # Key pool, rate limiter backend and response cache as configured by the environment (see README)
+    riotapi = build_riot_api_from_env(ratelimit_logfile_location, priority=RequestPriorities.HISTORY)
 
     def get_matches(tiers, semver, start_idx, stop_idx):
         all_matches = HistoricalMatch.objects.all()
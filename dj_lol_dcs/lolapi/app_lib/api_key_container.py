@@ -18,14 +18,34 @@ class MethodRateLimits:
                 raise ConfigurationError('Non-configured region {} for method {}'.format(region, method))
             return self.__methods[method][region]
 
+    def get_longest_timeframe(self):
+        """Longest timeframe-size amongst all configured methods and regions (0 if nothing configured)"""
+        timeframe_sizes = [0]
+        for method_limits in self.__methods.values():
+            regional_limits = [method_limits] if isinstance(method_limits, list) else method_limits.values()
+            for rate_limits in regional_limits:
+                timeframe_sizes += [int(rl[1]) for rl in rate_limits]
+        return max(timeframe_sizes)
+
+    def paced(self, pacing_policy):
+        """Same mapping with every ratelimit paced as per PacingPolicy"""
+        return MethodRateLimits({
+            method: (pacing_policy.pace(method_limits) if isinstance(method_limits, list) else
+                     {region: pacing_policy.pace(rate_limits) for region, rate_limits in method_limits.items()})
+            for method, method_limits in self.__methods.items()
+        })
+
 
 class ApiKeyContainer:
-    """Container for API-key and respective app-rate-limit(s); Encapsulates and aggregates them together"""
+    """Container for API-key and respective app-rate-limit(s); Encapsulates and aggregates them together
+
+       With a PacingPolicy the rate limits are handed out paced (with the derived limits added), so that every
+       request history backend enforces the pacing; get_configured_app_rate_limits is what the API should report.
+    """
 
-    def __init__(self, api_key, app_rate_limits, method_rate_limits):
-        self.__api_key = api_key
-        self.__app_rate_limits = app_rate_limits
-        self.__method_rate_limits = method_rate_limits
+    def __init__(self, api_key, app_rate_limits, method_rate_limits, pacing_policy=None):
+        self.__pacing_policy = pacing_policy
+        self.change_key(api_key, app_rate_limits, method_rate_limits)
 
     def get_api_key(self):
         return self.__api_key
@@ -33,10 +53,44 @@ class ApiKeyContainer:
     def get_app_rate_limits(self):
         return self.__app_rate_limits
 
+    def get_configured_app_rate_limits(self):
+        return self.__configured_app_rate_limits
+
     def get_method_rate_limits(self):
         return self.__method_rate_limits
 
     def change_key(self, new_api_key, new_app_rate_limits, new_method_rate_limits):
         self.__api_key = new_api_key
-        self.__app_rate_limits = new_app_rate_limits
-        self.__method_rate_limits = new_method_rate_limits
+        self.__configured_app_rate_limits = new_app_rate_limits
+        if self.__pacing_policy is None:
+            self.__app_rate_limits = new_app_rate_limits
+            self.__method_rate_limits = new_method_rate_limits
+        else:
+            self.__app_rate_limits = self.__pacing_policy.pace(new_app_rate_limits)
+            self.__method_rate_limits = new_method_rate_limits.paced(self.__pacing_policy)
+
+
+class ApiKeyPool:
+    """Pool of ApiKeyContainers, each key having app-rate-limits and method-rate-limits (and buckets) of its own
+
+       Requests are spread over the keys by picking the key with the most headroom left for the requested
+       region+method(s), so the total throughput grows with the number of keys.
+    """
+
+    def __init__(self, api_key_containers):
+        if len(api_key_containers) == 0:
+            raise ConfigurationError('API key pool needs at least one API key')
+        self.__api_key_containers = list(api_key_containers)
+
+    def get_api_key_containers(self):
+        return list(self.__api_key_containers)
+
+    def add_api_key_container(self, api_key_container):
+        self.__api_key_containers.append(api_key_container)
+
+    def select(self, request_history_backend, region, methods, priority):
+        """The key with the most headroom (as per request_history_backend.get_headroom), first of equals"""
+        if len(self.__api_key_containers) == 1:
+            return self.__api_key_containers[0]
+        return max(self.__api_key_containers,
+                   key=lambda container: request_history_backend.get_headroom(container, region, methods, priority))
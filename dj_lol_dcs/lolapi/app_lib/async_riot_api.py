@@ -0,0 +1,125 @@
+from .request_priorities import RequestPriorities
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import asyncio
+
+
+class AsyncRequestHistory:
+    """Awaitable permits of a request history backend, e.g. await history.permit_request(..)
+
+       The backend's blocking check-and-wait runs in a thread of the executor instead of the event loop, so other
+       coroutines go on while a permit waits for its rate limits. Every backend is thread-safe for this.
+    """
+
+    def __init__(self, request_history_backend, executor=None):
+        self.request_history_backend = request_history_backend
+        self.__executor = executor
+
+    async def __run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(function, *args))
+
+    async def permit_request(self, api_key_container, region, method, request_uri,
+                             priority=RequestPriorities.LIVE_MATCH):
+        return await self.__run(self.request_history_backend.permit_request,
+                                api_key_container, region, method, request_uri, priority)
+
+    async def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        return await self.__run(self.request_history_backend.permit_requests,
+                                api_key_container, region, method, num_requests, request_uri, priority)
+
+    async def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                                    priority=RequestPriorities.LIVE_MATCH):
+        return await self.__run(self.request_history_backend.permit_mixed_requests,
+                                api_key_container, region, num_requests_per_method, request_uri, priority)
+
+    async def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        return await self.__run(self.request_history_backend.get_headroom,
+                                api_key_container, region, methods, priority)
+
+
+class AsyncRiotApi:
+    """RiotApi's endpoint functions as coroutines, so that one thread keeps dozens of requests in flight
+
+       Each request is the RiotApi call itself (permit, key selection, response checks) run in a thread of the
+       executor, so its request history backend must be thread-safe (every backend is). At most
+       max_in_flight_per_host requests per API host are in flight at once, the rest wait for the host's
+       semaphore without taking a thread. Give the RiotApi an HttpSessionPool of pool_maxsize of at least
+       max_in_flight_per_host, so that every request in flight has a kept-alive connection of its own.
+       RiotApi's adaptive concurrency limit (per region+method) still applies within the threads.
+
+       E.g. results = await asyncio.gather(*[async_riotapi.get_match_result(platform, m) for m in match_ids])
+    """
+
+    def __init__(self, riotapi, api_hosts, max_in_flight_per_host=16, max_threads=64, executor=None):
+        """executor as a ThreadPoolExecutor to share, a new one of max_threads threads otherwise"""
+        self.__riotapi = riotapi
+        self.__api_hosts = api_hosts
+        self.max_in_flight_per_host = max_in_flight_per_host
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='AsyncRiotApi')
+        self.__executor = executor
+        # {api-host: asyncio.Semaphore, ..}, created on first use within the running event loop
+        self.__host_semaphores = {}
+
+    def with_priority(self, priority):
+        """Same as RiotApi.with_priority, sharing this instance's threads and per-host semaphores"""
+        view = AsyncRiotApi(self.__riotapi.with_priority(priority), self.__api_hosts, self.max_in_flight_per_host,
+                            executor=self.__executor)
+        view.__host_semaphores = self.__host_semaphores
+        return view
+
+    def get_request_history(self, request_history_backend):
+        """Awaitable permits of the backend, run in this instance's threads"""
+        return AsyncRequestHistory(request_history_backend, self.__executor)
+
+    async def __request(self, api_host, riotapi_function, *args, **kwargs):
+        semaphore = self.__host_semaphores.get(api_host, None)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_in_flight_per_host)
+            self.__host_semaphores[api_host] = semaphore
+        async with semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.__executor,
+                functools.partial(riotapi_function, *args, **kwargs))
+
+    async def reserve_requests(self, region_name, num_requests_per_endpoint):
+        """Same as RiotApi.reserve_requests, doesn't count as a request in flight"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor,
+            functools.partial(self.__riotapi.reserve_requests, region_name, num_requests_per_endpoint))
+
+    async def release_reserved_requests(self):
+        """Same as RiotApi.release_reserved_requests"""
+        return await asyncio.get_running_loop().run_in_executor(self.__executor,
+                                                                self.__riotapi.release_reserved_requests)
+
+    async def get_summoner(self, region_name, name):
+        return await self.__request(self.__api_hosts.get_host_by_region(region_name),
+                                    self.__riotapi.get_summoner, region_name, name)
+
+    async def get_tiers(self, region_name, summoner_id):
+        return await self.__request(self.__api_hosts.get_host_by_region(region_name),
+                                    self.__riotapi.get_tiers, region_name, summoner_id)
+
+    async def get_active_match(self, region_name, summoner_id):
+        return await self.__request(self.__api_hosts.get_host_by_region(region_name),
+                                    self.__riotapi.get_active_match, region_name, summoner_id)
+
+    async def get_matchlist(self, region_name, account_id, **time_range):
+        """time_range as in RiotApi.get_matchlist, i.e. end_time and/or begin_time (epoch milliseconds)"""
+        return await self.__request(self.__api_hosts.get_host_by_region(region_name),
+                                    self.__riotapi.get_matchlist, region_name, account_id, **time_range)
+
+    async def get_match_result(self, platform_name, match_id):
+        return await self.__request(self.__api_hosts.get_host_by_platform(platform_name),
+                                    self.__riotapi.get_match_result, platform_name, match_id)
+
+    async def get_match_timeline(self, platform_name, match_id):
+        return await self.__request(self.__api_hosts.get_host_by_platform(platform_name),
+                                    self.__riotapi.get_match_timeline, platform_name, match_id)
+
+    def close(self):
+        """Wait for the requests in flight and stop the threads"""
+        self.__executor.shutdown(wait=True)
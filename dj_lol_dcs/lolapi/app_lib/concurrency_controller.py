@@ -0,0 +1,87 @@
+import threading
+import time
+
+
+class AimdConcurrencyController:
+    """Per (region, method) limit of concurrent requests, adapted to what the underlying service can take
+
+       Additive increase: a limit's worth of healthy responses raises the limit by one (up to max_limit).
+       Multiplicative decrease: a service 429 (or an unknown type of 429), a 5xx or a failed connection multiplies
+       the limit by decrease_factor (down to min_limit), and holds back every request to the same region+method
+       for the Retry-After (or backoff_seconds), instead of only the request that got the error.
+       Also keeps a moving average of the responses' round trip time, e.g. to tell how long a batch takes.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32, decrease_factor=0.5, backoff_seconds=5):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.backoff_seconds = backoff_seconds
+        # {(region, method): {'limit': float, 'in_flight': int, 'blocked_until': epoch, 'response_seconds': float},
+        #  ..}, response_seconds None until the first response
+        self.__states = {}
+        self.__condition = threading.Condition()
+
+    @staticmethod
+    def is_overloaded(response):
+        """Whether the response tells the underlying service is overloaded (as opposed to our own rate limits)"""
+        if response is None or response.status_code >= 500:
+            return True
+        if response.status_code == 429:
+            return response.headers.get('X-Rate-Limit-Type', 'service') == 'service'
+        return False
+
+    def __get_state(self, region, method):
+        if (region, method) not in self.__states:
+            self.__states[(region, method)] = {'limit': float(self.initial_limit), 'in_flight': 0, 'blocked_until': 0,
+                                               'response_seconds': None}
+        return self.__states[(region, method)]
+
+    def get_limit(self, region, method):
+        with self.__condition:
+            return self.__get_state(region, method)['limit']
+
+    def get_response_seconds(self, region, method):
+        """Moving average of the region+method's round trip time, None if it had no responses yet"""
+        with self.__condition:
+            return self.__get_state(region, method)['response_seconds']
+
+    def acquire(self, region, method):
+        """Blocks until the region+method is neither backing off nor at its limit of requests in flight"""
+        with self.__condition:
+            state = self.__get_state(region, method)
+            while True:
+                backoff_left = state['blocked_until'] - time.time()
+                if backoff_left <= 0 and state['in_flight'] < int(state['limit']):
+                    break
+                self.__condition.wait(timeout=backoff_left if backoff_left > 0 else None)
+            state['in_flight'] += 1
+
+    def release(self, region, method, response):
+        """Adapt the limit to the response (None if the connection failed or timed out), let waiting requests go"""
+        with self.__condition:
+            state = self.__get_state(region, method)
+            state['in_flight'] -= 1
+            if response is not None:
+                response_seconds = response.elapsed.total_seconds()
+                if state['response_seconds'] is None:
+                    state['response_seconds'] = response_seconds
+                else:
+                    state['response_seconds'] += 0.1 * (response_seconds - state['response_seconds'])
+            if self.is_overloaded(response):
+                # Requests in flight during a backoff hit the same overload, so decrease once per backoff
+                if state['blocked_until'] < time.time():
+                    state['limit'] = max(self.min_limit, state['limit'] * self.decrease_factor)
+                    retry_after = response.headers.get('Retry-After') if response is not None else None
+                    backoff_seconds = int(retry_after) if retry_after is not None else self.backoff_seconds
+                    state['blocked_until'] = time.time() + backoff_seconds
+            elif response.status_code < 400 or response.status_code == 404:
+                state['limit'] = min(self.max_limit, state['limit'] + 1 / state['limit'])
+            self.__condition.notify_all()
+
+    def cancel(self, region, method):
+        """Free the slot of a request that failed for reasons of our own (e.g. its permit), without adapting"""
+        with self.__condition:
+            self.__get_state(region, method)['in_flight'] -= 1
+            self.__condition.notify_all()
@@ -11,6 +11,11 @@ class RiotApiError(Exception):
         super(RiotApiError, self).__init__(msg)
 
 
+class RetriesExhaustedError(RiotApiError):
+    """Raise when a request still fails (non-rate-limit error) after the retries permitted by its RetryPolicy"""
+    pass
+
+
 # Exceptions that indicate "something requires re-configuring"
 ##
 class ConfigurationError(Exception):
@@ -28,3 +33,8 @@ class RatelimitMismatchError(ConfigurationError):
 class MatchTakenError(Exception):
     """Raise when "match already being observed for gathering purposes by another process"""
     pass
+
+
+class PermitServerError(Exception):
+    """Raise when the rate-limit permit server is unreachable or couldn't handle a request"""
+    pass
@@ -0,0 +1,43 @@
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import threading
+import requests
+
+
+class HttpSessionPool:
+    """One requests.Session per host, so that requests to the same host re-use its kept-alive connections
+
+       A connection costs a TCP + TLS handshake, often more than the API's own response time. Each host's session
+       keeps up to pool_maxsize idle connections (i.e. as many as there are threads requesting that host at once);
+       keep_alive False closes every connection after its response, as module-level requests.get does.
+    """
+
+    def __init__(self, pool_maxsize=10, keep_alive=True):
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.__sessions = {}
+        self.__sessions_lock = threading.Lock()
+
+    def get_session(self, host):
+        with self.__sessions_lock:
+            session = self.__sessions.get(host, None)
+            if session is None:
+                session = requests.Session()
+                # A single host per session, so a single connection pool of pool_maxsize connections
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.__sessions[host] = session
+            return session
+
+    def get(self, url, **kwargs):
+        """requests.get through the session of the url's host"""
+        return self.get_session(urlsplit(url).netloc).get(url, **kwargs)
+
+    def close(self):
+        with self.__sessions_lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions = {}
@@ -0,0 +1,245 @@
+from .exceptions import ConfigurationError
+from .request_priorities import RequestPriorities
+from .ratelimit_log_writer import BufferedCsvLogWriter
+from .ratelimit_metrics import RateLimitMetrics
+
+from collections import deque
+import threading
+import time
+
+
+class InMemoryRequestHistory:
+    # How often a request held back by waiting higher priority requests re-checks its limits
+    __waiting_recheck_seconds = 0.1
+
+    def __init__(self, logfile_location=None, request_priorities=None):
+        """Saves requests as-per rate limit groups (region+method combination) in process memory, no DB involved
+
+           Each limit (region+method+timeframe) has its own ring buffer of at most max-requests timestamps,
+           so checking a limit is a look at the oldest timestamp instead of a query over all past requests.
+           Waiting requests of a higher priority are granted before lower priority ones in the same limit.
+           Prints or logs the checks (as csv) in the same format as MysqlRequestHistory.
+        """
+        self.logfile_location = logfile_location
+        self.__log_writer = BufferedCsvLogWriter(logfile_location) if logfile_location is not None else None
+        self.request_priorities = request_priorities if request_priorities is not None else RequestPriorities()
+        self.metrics = RateLimitMetrics()
+        self.__buckets = {}
+        # {(api-key, region, method, timeframe-size): {priority: num-requests-waiting, ..}, ..}
+        self.__waiting = {}
+        self.__buckets_lock = threading.Lock()
+
+    @staticmethod
+    def __get_applied_rate_limits(api_key_container, region, methods):
+        """From standard [[max-requests, timeframe-size], ..]
+           to structure [[max-requests, timeframe-size, region, method, api-key], ..] app-rate-limits having None
+           as method; every key has limits (and therefore buckets) of its own
+        """
+        api_key = api_key_container.get_api_key()
+        app_rate_limits = [
+            rl + [region, None, api_key] for
+            rl in
+            api_key_container.get_app_rate_limits()
+        ]
+        request_specific_method_rate_limits = [
+            rl + [region, method, api_key] for
+            method in
+            methods for
+            rl in
+            api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+        ]
+        return app_rate_limits + request_specific_method_rate_limits
+
+    def __get_bucket(self, max_requests, timeframe_size, region, method, api_key):
+        key = (api_key, region, method, timeframe_size)
+        bucket = self.__buckets.get(key, None)
+        if bucket is None or bucket.maxlen != max_requests:
+            # New limit, or re-configured max-requests; keep the most recent timestamps that still fit
+            bucket = deque(bucket if bucket is not None else [], maxlen=max_requests)
+            self.__buckets[key] = bucket
+        return bucket
+
+    def __count_waiting(self, applied_rate_limits_with_region_and_method, num_requests_per_method, priority, sign):
+        for limit in applied_rate_limits_with_region_and_method:
+            method = str(limit[3]) if limit[3] is not None else None
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            waiting = self.__waiting.setdefault((limit[4], str(limit[2]), method, int(limit[1])), {})
+            waiting[priority] = waiting.get(priority, 0) + sign * num_requests
+
+    def __check_rate_limits(self, applied_rate_limits_with_region_and_method, num_requests_per_method, priority):
+        """applied_rate_limits_with_region_and_method is modified
+               from standard [[max-requests, timeframe-size], ..]
+               to structure [[max-requests, timeframe-size, region, method, api-key], ..]
+           same as in MysqlRequestHistory, num_requests_per_method being {method: num-requests-to-fit, ..}
+
+           Requests of higher priorities waiting for the same limit count as if they were already made, and the
+           shares reserved for higher priorities are off limits (unless the batch would never fit otherwise).
+
+           Every limit is checked in one pass, returning the wait until the last of the full limits has room,
+           so a single sleep covers all of them.
+        """
+        epoch_now = time.time()
+        wait_seconds = None
+        binding_limit = None
+        for limit in applied_rate_limits_with_region_and_method:
+            max_requests_in_timeframe = int(limit[0])
+            timeframe_size            = int(limit[1])
+            region                    = str(limit[2])
+            method                    = str(limit[3]) if limit[3] is not None else None
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            if num_requests > max_requests_in_timeframe:
+                raise ConfigurationError('{} requests never fit in [{}, {}] rate limit of {} {}'.format(
+                    num_requests, max_requests_in_timeframe, timeframe_size, region, method))
+            bucket = self.__get_bucket(max_requests_in_timeframe, timeframe_size, region, method, limit[4])
+            # Drop timestamps that fell out of the timeframe, buffer is chronological so they are all at the left
+            timeframe_start = epoch_now - timeframe_size
+            while len(bucket) > 0 and bucket[0] < timeframe_start:
+                bucket.popleft()
+            if self.logfile_location is None:
+                print("[RATE-LIMIT][{}][{}][{}/{}, in {} second timeframe]".format(
+                    region,
+                    method,
+                    len(bucket),
+                    max_requests_in_timeframe,
+                    timeframe_size))
+            else:
+                # Queued for the background writer, so that no file is opened while the limits are locked
+                self.__log_writer.writerow([time.time(),
+                                            region,
+                                            method,
+                                            timeframe_size,
+                                            len(bucket),
+                                            max_requests_in_timeframe])
+            self.metrics.observe_limit(limit[4], region, method, timeframe_size, len(bucket),
+                                       max_requests_in_timeframe)
+            usable_max_requests = max(self.request_priorities.get_max_requests(max_requests_in_timeframe, priority),
+                                      num_requests)
+            waiting = self.__waiting.get((limit[4], region, method, timeframe_size), {})
+            higher_priorities_waiting = sum(n for p, n in waiting.items() if p < priority)
+            requests_ahead = len(bucket) + higher_priorities_waiting
+            if requests_ahead + num_requests > usable_max_requests:
+                # Wait for as many of the oldest requests to fall out of the timeframe as there are missing slots
+                blocking_request_idx = requests_ahead + num_requests - usable_max_requests - 1
+                if blocking_request_idx >= len(bucket):
+                    # Not even an empty bucket would do before the higher priorities waiting have been served
+                    limit_wait_seconds = self.__waiting_recheck_seconds
+                else:
+                    limit_wait_seconds = timeframe_size - (epoch_now - bucket[blocking_request_idx])
+                if binding_limit is None or limit_wait_seconds > wait_seconds:
+                    binding_limit = limit
+                wait_seconds = max(wait_seconds or 0, limit_wait_seconds)
+        if binding_limit is not None:
+            self.metrics.observe_binding(binding_limit[4], str(binding_limit[2]),
+                                         str(binding_limit[3]) if binding_limit[3] is not None else None,
+                                         int(binding_limit[1]))
+        return wait_seconds is None, wait_seconds
+
+    def __add_requests_to_buckets(self, applied_rate_limits_with_region_and_method, num_requests_per_method):
+        epoch_now = time.time()
+        for limit in applied_rate_limits_with_region_and_method:
+            method = str(limit[3]) if limit[3] is not None else None
+            bucket = self.__get_bucket(int(limit[0]), int(limit[1]), str(limit[2]), method, limit[4])
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            bucket.extend([epoch_now] * num_requests)
+        return epoch_now
+
+    def permit_request(self, api_key_container, region, method, request_uri,
+                       priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until the request fits in all of its rate limits, returns the permitted request's timestamp"""
+        return self.permit_mixed_requests(api_key_container, region, {method: 1}, request_uri, priority)
+
+    def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                        priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until all num_requests fit in the rate limits at once, and reserves them"""
+        return self.permit_mixed_requests(api_key_container, region, {method: num_requests}, request_uri, priority)
+
+    def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until {method: num-requests, ..} fit in the rate limits at once, and reserves them"""
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        started_at = time.time()
+        with self.__buckets_lock:
+            self.__count_waiting(applied_rate_limits, num_requests_per_method, priority, 1)
+        try:
+            while True:
+                # Check and record under the lock (threads of this process), but never sleep while holding it
+                with self.__buckets_lock:
+                    ok, wait_seconds = self.__check_rate_limits(applied_rate_limits, num_requests_per_method, priority)
+                    if ok:
+                        self.__count_waiting(applied_rate_limits, num_requests_per_method, priority, -1)
+                        permitted_at = self.__add_requests_to_buckets(applied_rate_limits, num_requests_per_method)
+                        self.metrics.observe_permit(api_key_container.get_api_key(), region,
+                                                    num_requests_per_method, permitted_at - started_at)
+                        return permitted_at
+                time.sleep(wait_seconds)
+        except BaseException:
+            # Misconfigured or interrupted while waiting, don't keep holding back lower priorities
+            with self.__buckets_lock:
+                self.__count_waiting(applied_rate_limits, num_requests_per_method, priority, -1)
+            raise
+
+    def revoke_requests(self, api_key_container, region, num_requests_per_method, request_uri, permitted_at):
+        """Give back permitted requests that were never made, e.g. the requesting client went away or the
+           permits of a reservation expired unused; permitted_at as returned by permit_mixed_requests
+        """
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        with self.__buckets_lock:
+            for limit in applied_rate_limits:
+                method = str(limit[3]) if limit[3] is not None else None
+                bucket = self.__get_bucket(int(limit[0]), int(limit[1]), str(limit[2]), method, limit[4])
+                num_requests = (sum(num_requests_per_method.values()) if method is None
+                                else num_requests_per_method[method])
+                for _ in range(num_requests):
+                    if permitted_at in bucket:
+                        bucket.remove(permitted_at)
+
+    def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        """Smallest share of max-requests still free amongst the (app and method) limits of the key and methods"""
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region, methods)
+        headroom = 1.0
+        with self.__buckets_lock:
+            epoch_now = time.time()
+            for limit in applied_rate_limits:
+                max_requests_in_timeframe = int(limit[0])
+                bucket = self.__get_bucket(max_requests_in_timeframe, int(limit[1]), str(limit[2]),
+                                           str(limit[3]) if limit[3] is not None else None, limit[4])
+                timeframe_start = epoch_now - int(limit[1])
+                while len(bucket) > 0 and bucket[0] < timeframe_start:
+                    bucket.popleft()
+                usable_max_requests = self.request_priorities.get_max_requests(max_requests_in_timeframe, priority)
+                headroom = min(headroom, (usable_max_requests - len(bucket)) / max_requests_in_timeframe)
+        return headroom
+
+    def get_metrics(self):
+        """Snapshot of the limiter's metrics (see RateLimitMetrics), of the permits served by this process"""
+        return self.metrics.get_snapshot()
+
+    def synchronize_request_counts(self, api_key_container, region, method,
+                                   app_rate_limit_counts, method_rate_limit_counts):
+        """Reconcile the buckets with counts received from API (X-App-Rate-Limit-Count, X-Method-Rate-Limit-Count)
+
+           Counts are in format [[num-requests, timeframe-size], ..]. Requests the API has counted but the bucket
+           is missing are added as timestamps of the current time. Buckets are never reduced.
+        """
+        with self.__buckets_lock:
+            epoch_now = time.time()
+            for limit in self.__get_applied_rate_limits(api_key_container, region, [method]):
+                received_counts = app_rate_limit_counts if limit[3] is None else method_rate_limit_counts
+                received_count_per_timeframe = {int(received[1]): int(received[0]) for received in received_counts}
+                timeframe_size = int(limit[1])
+                if timeframe_size not in received_count_per_timeframe:
+                    continue
+                bucket = self.__get_bucket(int(limit[0]), timeframe_size, str(limit[2]),
+                                           str(limit[3]) if limit[3] is not None else None, limit[4])
+                timeframe_start = epoch_now - timeframe_size
+                while len(bucket) > 0 and bucket[0] < timeframe_start:
+                    bucket.popleft()
+                missing_requests = received_count_per_timeframe[timeframe_size] - len(bucket)
+                # Beyond max-requests the ring buffer would only drop own (older) timestamps
+                for _ in range(min(missing_requests, bucket.maxlen - len(bucket))):
+                    bucket.append(epoch_now)
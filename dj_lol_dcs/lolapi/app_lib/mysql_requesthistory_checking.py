@@ -1,7 +1,17 @@
+from .exceptions import ConfigurationError
+from .request_priorities import RequestPriorities
+from .ratelimit_log_writer import BufferedCsvLogWriter
+from .ratelimit_metrics import RateLimitMetrics
+from .request_count_sync import get_placeholder_requests
+
 import MySQLdb as MDB
 from warnings import filterwarnings
+import threading
+import hashlib
+import random
+import socket
 import time
-import csv
+import uuid
 import os
 
 
@@ -11,22 +21,25 @@ filterwarnings('ignore', category=MDB.Warning)
 
 class MysqlRequestHistory:
 
-    def __init__(self, user, passwd, db, logfile_location=None):
-        """Saves requests as-per rate limit groups (region+method combination) and prints or logs them (as csv)"""
+    def __init__(self, user, passwd, db, logfile_location=None, prune_interval_seconds=60, request_priorities=None,
+                 lease_seconds=10, lease_poll_seconds=0.01, lease_max_poll_seconds=0.2):
+        """Saves requests as-per rate limit groups (region+method combination) and prints or logs them (as csv)
+
+           Priorities are applied as reserved shares only; there is no cross-script queue of waiting requests.
+           Rate limit groups are held as leases which expire after lease_seconds, so that a script which crashed
+           or hangs while holding them doesn't stall the others. Waiting scripts poll after lease_poll_seconds,
+           doubling (with jitter) up to lease_max_poll_seconds, so that many waiting threads don't flood the
+           database with a write transaction every few milliseconds each.
+           Every thread gets a connection (and lease owner identity) of its own, so threads may share the instance.
+        """
         self.logfile_location = logfile_location
-        self.dbh = MDB.connect(
-            host="localhost",
-            user=user,
-            passwd=passwd,
-            db=db,
-            use_unicode=True,
-            charset="utf8"
-        )
-        self.cursor = self.dbh.cursor()
-        self.dbh.set_character_set('utf8')
-        self.cursor.execute('SET NAMES utf8;')
-        self.cursor.execute('SET CHARACTER SET utf8;')
-        self.cursor.execute('SET character_set_connection=utf8;')
+        self.__log_writer = BufferedCsvLogWriter(logfile_location) if logfile_location is not None else None
+        self.request_priorities = request_priorities if request_priorities is not None else RequestPriorities()
+        self.metrics = RateLimitMetrics()
+        self.__user = user
+        self.__passwd = passwd
+        self.__db = db
+        self.__thread_local = threading.local()
 
         self.cursor.execute('CREATE TABLE IF NOT EXISTS RequestHistory ('
                             + 'id Integer NOT NULL AUTO_INCREMENT, '
@@ -35,105 +48,455 @@ class MysqlRequestHistory:
                             + 'region_name Varchar(255) NOT NULL, '
                             + 'method_name Varchar(255) NOT NULL, '
                             + 'request_uri Varchar(510) NOT NULL, '
-                            + 'PRIMARY KEY (id)'
+                            + 'PRIMARY KEY (id), '
+                            + 'INDEX key_region_method_time (api_key, region_name, method_name, at_time), '
+                            + 'INDEX key_region_time (api_key, region_name, at_time), '
+                            + 'INDEX at_time (at_time)'
                             + ');')
         self.dbh.commit()
+        # Tables created before the indexes existed don't get them from CREATE TABLE IF NOT EXISTS.
+        # Window counts are aggregated within these (covering) indexes, without reading the rows
+        self.cursor.execute("SHOW INDEX FROM RequestHistory WHERE Key_name = 'key_region_method_time'")
+        if len(self.cursor.fetchall()) == 0:
+            self.cursor.execute('ALTER TABLE RequestHistory '
+                                + 'ADD INDEX key_region_method_time (api_key, region_name, method_name, at_time)')
+            self.dbh.commit()
+        self.cursor.execute("SHOW INDEX FROM RequestHistory WHERE Key_name = 'key_region_time'")
+        if len(self.cursor.fetchall()) == 0:
+            self.cursor.execute('ALTER TABLE RequestHistory ADD INDEX key_region_time (api_key, region_name, at_time)')
+            self.dbh.commit()
+        self.cursor.execute("SHOW INDEX FROM RequestHistory WHERE Key_name = 'at_time'")
+        if len(self.cursor.fetchall()) == 0:
+            self.cursor.execute('ALTER TABLE RequestHistory ADD INDEX at_time (at_time)')
+            self.dbh.commit()
+        # Superseded by key_region_method_time (every window condition has the api_key), only slowing inserts
+        self.cursor.execute("SHOW INDEX FROM RequestHistory WHERE Key_name = 'region_method_time'")
+        if len(self.cursor.fetchall()) > 0:
+            self.cursor.execute('ALTER TABLE RequestHistory DROP INDEX region_method_time')
+            self.dbh.commit()
+
+        # Leases of the rate limit groups, one row per group held; an expired row is free for anyone to take over
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS RateLimitLease ('
+                            + 'lock_name Varchar(64) NOT NULL, '
+                            + 'owner Varchar(255) NOT NULL, '
+                            + 'expires_at Datetime(6) NOT NULL, '
+                            + 'PRIMARY KEY (lock_name)'
+                            + ');')
+        self.dbh.commit()
+        self.lease_seconds = lease_seconds
+        self.lease_poll_seconds = lease_poll_seconds
+        self.lease_max_poll_seconds = lease_max_poll_seconds
+
+        # Requests older than their key's longest rate-limited period are never queried again, so they are pruned
+        # periodically; {api-key: epoch, ..} of the last prune
+        self.prune_interval_seconds = prune_interval_seconds
+        self.__last_pruned_at = {}
+
+    def __connect(self):
+        dbh = MDB.connect(
+            host="localhost",
+            user=self.__user,
+            passwd=self.__passwd,
+            db=self.__db,
+            use_unicode=True,
+            charset="utf8"
+        )
+        cursor = dbh.cursor()
+        dbh.set_character_set('utf8')
+        cursor.execute('SET NAMES utf8;')
+        cursor.execute('SET CHARACTER SET utf8;')
+        cursor.execute('SET character_set_connection=utf8;')
+        self.__thread_local.dbh = dbh
+        self.__thread_local.cursor = cursor
+        # host:pid:thread-instance, so that leases of a dead process on this host are reclaimed without waiting
+        # for expiry, and two threads of one script never take each other's lease as their own
+        self.__thread_local.lease_owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    @property
+    def dbh(self):
+        """This thread's connection, a MySQLdb connection is not to be shared between threads"""
+        if getattr(self.__thread_local, 'dbh', None) is None:
+            self.__connect()
+        return self.__thread_local.dbh
+
+    @property
+    def cursor(self):
+        if getattr(self.__thread_local, 'cursor', None) is None:
+            self.__connect()
+        return self.__thread_local.cursor
+
+    @property
+    def lease_owner(self):
+        if getattr(self.__thread_local, 'lease_owner', None) is None:
+            self.__connect()
+        return self.__thread_local.lease_owner
+
+    @staticmethod
+    def __get_lock_names(applied_rate_limits_with_region_and_method):
+        """One lease per rate limit group (key + region + method, or key + region for app-rate-limits)
+
+           Lease names are max 64 characters, so the group is hashed. Sorted, so every script acquires them
+           in the same order and two scripts touching the same groups cannot deadlock each other.
+        """
+        rate_limit_groups = set(
+            "{} {} {}".format(limit[4], limit[2], limit[3] if limit[3] is not None else "App ratelimit") for
+            limit in
+            applied_rate_limits_with_region_and_method
+        )
+        return sorted("RequestHistory_{}".format(hashlib.md5(group.encode('utf8')).hexdigest()) for
+                      group in
+                      rate_limit_groups)
+
+    @staticmethod
+    def __is_orphaned(lease_owner):
+        """Whether the lease's owner was a process of this host which no longer exists
+
+           Other hosts' processes can't be looked up, their leases are reclaimed once expired.
+        """
+        owner_host, owner_pid, _ = lease_owner.rsplit(':', 2)
+        if owner_host != socket.gethostname():
+            return False
+        try:
+            os.kill(int(owner_pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+
+    def __try_lease(self, lock_name):
+        """Take the lease if it's free, expired or orphaned, returns whether this script now holds it"""
+        # Both assignments of the update see the owner already updated, so an expired lease gets a new expiry too
+        self.cursor.execute("INSERT INTO RateLimitLease (lock_name, owner, expires_at) "
+                            + "VALUES (%s, %s, NOW(6) + INTERVAL %s MICROSECOND) "
+                            + "ON DUPLICATE KEY UPDATE "
+                            + "owner = IF(expires_at < NOW(6), VALUES(owner), owner), "
+                            + "expires_at = IF(owner = VALUES(owner), VALUES(expires_at), expires_at)",
+                            (lock_name, self.lease_owner, int(self.lease_seconds * 1000000)))
+        self.cursor.execute("SELECT owner FROM RateLimitLease WHERE lock_name = %s FOR UPDATE", (lock_name,))
+        lease_owner = self.cursor.fetchone()[0]
+        if lease_owner != self.lease_owner and self.__is_orphaned(lease_owner):
+            self.cursor.execute("UPDATE RateLimitLease SET owner = %s, expires_at = NOW(6) + INTERVAL %s MICROSECOND "
+                                + "WHERE lock_name = %s AND owner = %s",
+                                (self.lease_owner, int(self.lease_seconds * 1000000), lock_name, lease_owner))
+            lease_owner = self.lease_owner
+        self.dbh.commit()
+        return lease_owner == self.lease_owner
+
+    def __lock(self, lock_names):
+        for lock_name in lock_names:
+            poll_seconds = self.lease_poll_seconds
+            while not self.__try_lease(lock_name):
+                # Jittered, so that the threads waiting for the same lease don't all poll at once
+                time.sleep(random.uniform(0.5, 1) * poll_seconds)
+                poll_seconds = min(self.lease_max_poll_seconds, poll_seconds * 2)
+
+    def __holds_leases(self, lock_names):
+        """Whether every lease is still this script's, locking their rows until the transaction is committed
+
+           A lease which expired before this (a check slower than lease_seconds) may have been taken over
+           by another script, so nothing may be recorded on the strength of it.
+        """
+        self.cursor.execute("SELECT COUNT(*) FROM RateLimitLease WHERE owner = %s AND expires_at >= NOW(6) "
+                            + "AND lock_name IN (" + ", ".join(["%s"] * len(lock_names)) + ") FOR UPDATE",
+                            [self.lease_owner] + list(lock_names))
+        return int(self.cursor.fetchone()[0]) == len(lock_names)
+
+    @staticmethod
+    def __get_applied_rate_limits(api_key_container, region, methods):
+        """From standard [[max-requests, timeframe-size], ..]
+           to structure [[max-requests, timeframe-size, region, method, api-key], ..] app-rate-limits having None
+           as method; every key has limits (and therefore requests counted against them) of its own
+        """
+        api_key = api_key_container.get_api_key()
+        app_rate_limits = [
+            rl + [region, None, api_key] for
+            rl in
+            api_key_container.get_app_rate_limits()
+        ]
+        request_specific_method_rate_limits = [
+            rl + [region, method, api_key] for
+            method in
+            methods for
+            rl in
+            api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+        ]
+        return app_rate_limits + request_specific_method_rate_limits
+
+    @staticmethod
+    def __get_window_condition(api_key, region, method, timeframe_size):
+        """WHERE-condition (and its parameters) of a rate limit's window, method None for the region's app-rate-limit
 
-    def __lock(self):
-        self.cursor.execute("LOCK TABLES RequestHistory WRITE")
+           Compares the bare columns against constants, so that the key_region_method_time (or key_region_time)
+           index is usable. Times are whole seconds, so the request's last second in the window is still counted.
+        """
+        if method is None:
+            return ("region_name = %s AND api_key = %s AND at_time >= (NOW() - INTERVAL %s SECOND)",
+                    [region, api_key, timeframe_size])
+        return ("region_name = %s AND method_name = %s AND api_key = %s AND at_time >= (NOW() - INTERVAL %s SECOND)",
+                [region, method, api_key, timeframe_size])
+
+    def __get_nth_oldest_request_time(self, api_key, region, method, timeframe_size, n):
+        """Time of the n:th (0 being the oldest) request in the rate limit's window"""
+        condition, params = self.__get_window_condition(api_key, region, method, timeframe_size)
+        self.cursor.execute("SELECT UNIX_TIMESTAMP(at_time) FROM RequestHistory WHERE " + condition
+                            + " ORDER BY at_time ASC LIMIT 1 OFFSET %s", params + [n])
+        row = self.cursor.fetchone()
         self.dbh.commit()
+        return row[0] if row is not None else time.time()
 
-    def __check_rate_limits(self, applied_rate_limits_with_region_and_method):
+    def __check_rate_limits(self, applied_rate_limits_with_region_and_method, num_requests_per_method, priority):
         """applied_rate_limits_with_region_and_method is modified
                from standard [[max-requests, timeframe-size], ..]
-               to structure [[max-requests, timeframe-size, region, method], ..]
-           allowing us to retrieve requests from db to highest timeframe size, reducing db queries
+               to structure [[max-requests, timeframe-size, region, method, api-key], ..]
+           allowing us to count the requests of every limit in a single aggregate query,
+           num_requests_per_method being {method: num-requests-to-fit, ..}
+           The shares reserved for higher priorities are off limits (unless the batch would never fit otherwise).
+           Every limit is checked in one pass, returning the wait until the last of the full limits has room,
+           so a single sleep (and re-check query) covers all of them.
         """
 
-        # Find longest timeframe/period (and therefore the period containing all sub-periods) reducing DB queries to 1
-        highest_timeframe_size = max(map(lambda ratelimit: ratelimit[1], applied_rate_limits_with_region_and_method))
-
-        # DB query the requests within the longest rate-limited period
-        self.cursor.execute("SELECT UNIX_TIMESTAMP(at_time), region_name, method_name FROM RequestHistory"
-                            + " WHERE UNIX_TIMESTAMP(at_time) > (UNIX_TIMESTAMP()-%s)"
-                            + " ORDER BY UNIX_TIMESTAMP(at_time) DESC", (highest_timeframe_size,))
-        relevant_request_history = list(map(lambda row: {'time': row[0], 'region': row[1], 'method': row[2]},
-                                            self.cursor.fetchall()))
+        # DB query the number of requests (and the oldest of them) in each limit's window, one row per limit,
+        # so the cost doesn't grow with the number of requests made within the longest window
+        subqueries = []
+        subquery_params = []
+        for limit_idx, limit in enumerate(applied_rate_limits_with_region_and_method):
+            condition, params = self.__get_window_condition(limit[4], str(limit[2]),
+                                                            str(limit[3]) if limit[3] is not None else None,
+                                                            int(limit[1]))
+            subqueries.append("(SELECT %s, COUNT(*), UNIX_TIMESTAMP(MIN(at_time)) FROM RequestHistory WHERE "
+                              + condition + ")")
+            subquery_params += [limit_idx] + params
+        self.cursor.execute(" UNION ALL ".join(subqueries), subquery_params)
+        window_stats = {int(row[0]): (int(row[1]), row[2]) for row in self.cursor.fetchall()}
+        # End the read snapshot, so that a re-check (after sleeping) sees what other scripts have inserted
+        self.dbh.commit()
 
         # Make comparisons
-        epoch_now = int(time.time())
-        for limit in applied_rate_limits_with_region_and_method:
+        wait_seconds = None
+        binding_limit = None
+        for limit_idx, limit in enumerate(applied_rate_limits_with_region_and_method):
             max_requests_in_timeframe = int(limit[0])
             timeframe_size            = int(limit[1])
             region                    = str(limit[2])
             method                    = str(limit[3]) if limit[3] is not None else None
-            timeframe_start = epoch_now - timeframe_size
-            if method is None:
-                requests_done_in_timeframe = list(
-                    filter(lambda r: r['time'] >= timeframe_start and r['region'] == region,
-                           relevant_request_history)
-                )
-            else:
-                requests_done_in_timeframe = list(
-                    filter(lambda r: r['time'] >= timeframe_start and r['region'] == region and r['method'] == method,
-                           relevant_request_history)
-                )
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            if num_requests > max_requests_in_timeframe:
+                raise ConfigurationError('{} requests never fit in [{}, {}] rate limit of {} {}'.format(
+                    num_requests, max_requests_in_timeframe, timeframe_size, region, method))
+            requests_done_in_timeframe, oldest_request_time = window_stats[limit_idx]
             if self.logfile_location is None:
                 print("[RATE-LIMIT][{}][{}][{}/{}, in {} second timeframe]".format(
                     region,
                     method,
-                    len(requests_done_in_timeframe),
+                    requests_done_in_timeframe,
                     max_requests_in_timeframe,
                     timeframe_size))
             else:
-                os.makedirs(os.path.dirname(self.logfile_location), exist_ok=True)
-                with open(self.logfile_location, 'a', newline='') as fh:
-                    csv_writer = csv.writer(fh, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                    csv_writer.writerow([time.time(),
-                                         region,
-                                         method,
-                                         timeframe_size,
-                                         len(requests_done_in_timeframe),
-                                         max_requests_in_timeframe])
-            if len(requests_done_in_timeframe) >= max_requests_in_timeframe:
-                return False, (timeframe_size - (epoch_now - requests_done_in_timeframe[-1]['time']))
-        return True, None
-
-    def __add_request_to_db(self, api_key, region, method, request_uri):
+                # Queued for the background writer, so that no file is opened while the limits are locked
+                self.__log_writer.writerow([time.time(),
+                                            region,
+                                            method,
+                                            timeframe_size,
+                                            requests_done_in_timeframe,
+                                            max_requests_in_timeframe])
+            self.metrics.observe_limit(limit[4], region, method, timeframe_size, requests_done_in_timeframe,
+                                       max_requests_in_timeframe)
+            usable_max_requests = max(self.request_priorities.get_max_requests(max_requests_in_timeframe, priority),
+                                      num_requests)
+            if requests_done_in_timeframe + num_requests > usable_max_requests:
+                # Wait for as many of the oldest requests to fall out of the timeframe as there are missing slots,
+                # only a batch (or a reduced max-requests) needs more than the oldest one, i.e. another query
+                blocking_request_idx = requests_done_in_timeframe + num_requests - usable_max_requests - 1
+                if blocking_request_idx == 0:
+                    blocking_request_time = oldest_request_time
+                else:
+                    blocking_request_time = self.__get_nth_oldest_request_time(limit[4], region, method,
+                                                                               timeframe_size, blocking_request_idx)
+                # The request is counted up to (and including) its last second in the timeframe
+                limit_wait_seconds = timeframe_size + 1 - (time.time() - blocking_request_time)
+                if binding_limit is None or limit_wait_seconds > wait_seconds:
+                    binding_limit = limit
+                wait_seconds = max(wait_seconds or 0, limit_wait_seconds)
+        if binding_limit is not None:
+            self.metrics.observe_binding(binding_limit[4], str(binding_limit[2]),
+                                         str(binding_limit[3]) if binding_limit[3] is not None else None,
+                                         int(binding_limit[1]))
+        return wait_seconds is None, wait_seconds
+
+    def __prune_request_history(self, api_key, longest_timeframe_size):
+        """Delete the key's requests which no longer fall into any of its rate-limited periods, at most once per
+           prune interval; only the key's own, since other keys (e.g. of other scripts) may have longer periods
+        """
+        if time.time() - self.__last_pruned_at.get(api_key, 0) < self.prune_interval_seconds:
+            return
+        self.cursor.execute("DELETE FROM RequestHistory WHERE api_key = %s AND at_time < (NOW() - INTERVAL %s SECOND)",
+                            (api_key, longest_timeframe_size))
+        self.dbh.commit()
+        self.__last_pruned_at[api_key] = time.time()
+
+    def __add_requests_to_db(self, api_key, region, num_requests_per_method, request_uri):
         escaped_sqlstr = ('INSERT INTO RequestHistory ('
                           + 'api_key, '
                           + 'region_name, '
                           + 'method_name, '
                           + 'request_uri'
                           + ") VALUES (%s, %s, %s, %s)")
-        self.cursor.execute(escaped_sqlstr, (api_key, region, method, request_uri))
+        self.cursor.executemany(escaped_sqlstr, [
+            (api_key, region, method, request_uri) for
+            method, num_requests in
+            num_requests_per_method.items() for
+            _ in
+            range(num_requests)
+        ])
+        self.dbh.commit()
+
+    def __count_requests(self, api_key, region, method, timeframe_sizes):
+        """Number of requests in each timeframe, method None counting all of the region's (app-rate-limited) requests"""
+        condition, params = self.__get_window_condition(api_key, region, method, max(timeframe_sizes))
+        count_columns = ["COALESCE(SUM(at_time >= (NOW() - INTERVAL %s SECOND)), 0)"] * len(timeframe_sizes)
+        self.cursor.execute("SELECT " + ", ".join(count_columns) + " FROM RequestHistory WHERE " + condition,
+                            list(timeframe_sizes) + params)
+        counts = self.cursor.fetchone()
+        self.dbh.commit()
+        return {
+            timeframe_size: int(count) for
+            timeframe_size, count in
+            zip(timeframe_sizes, counts)
+        }
+
+    def __add_placeholder_requests_to_db(self, api_key, region, method, request_uri, num_requests, seconds_ago):
+        escaped_sqlstr = ('INSERT INTO RequestHistory ('
+                          + 'api_key, '
+                          + 'region_name, '
+                          + 'method_name, '
+                          + 'request_uri, '
+                          + 'at_time'
+                          + ") VALUES (%s, %s, %s, %s, NOW() - INTERVAL %s SECOND)")
+        self.cursor.executemany(escaped_sqlstr, [(api_key, region, method, request_uri, seconds_ago)] * num_requests)
         self.dbh.commit()
 
-    def __unlock(self):
-        self.cursor.execute("UNLOCK TABLES")
+    def __unlock(self, lock_names):
+        # Only this script's leases, any of them taken over meanwhile belong to their new owner
+        self.cursor.execute("DELETE FROM RateLimitLease WHERE owner = %s "
+                            + "AND lock_name IN (" + ", ".join(["%s"] * len(lock_names)) + ")",
+                            [self.lease_owner] + list(lock_names))
         self.dbh.commit()
 
-    def permit_request(self, api_key_container, region, method, request_uri):
+    def permit_request(self, api_key_container, region, method, request_uri,
+                       priority=RequestPriorities.LIVE_MATCH):
+        self.permit_mixed_requests(api_key_container, region, {method: 1}, request_uri, priority)
+
+    def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                        priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until all num_requests fit in the rate limits at once, and reserves them"""
+        self.permit_mixed_requests(api_key_container, region, {method: num_requests}, request_uri, priority)
+
+    def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until {method: num-requests, ..} fit in the rate limits at once, and reserves them"""
         api_key = api_key_container.get_api_key()
-        # from standard [[max-requests, timeframe-size], ..]
-        # to structure [[max-requests, timeframe-size, region, method], ..]
-        app_rate_limits = [
-            rl + [region, None] for
-            rl in
-            api_key_container.get_app_rate_limits()
-        ]
-        request_specific_method_rate_limits = [
-            rl + [region, method] for
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        longest_timeframe_size = max([int(rl[1]) for rl in api_key_container.get_app_rate_limits()]
+                                     + [api_key_container.get_method_rate_limits().get_longest_timeframe()])
+        # Lock the touched rate limit groups to prevent a race condition between multiple active scripts,
+        # scripts requesting other regions (and thus other app-rate-limit groups) are not blocked
+        lock_names = self.__get_lock_names(applied_rate_limits)
+        self.__prune_request_history(api_key, longest_timeframe_size)
+        started_at = time.time()
+        while True:
+            self.__lock(lock_names)
+            try:
+                # Check rate-limit quotas, catches first full quota
+                ok, wait_seconds = self.__check_rate_limits(applied_rate_limits, num_requests_per_method, priority)
+                if ok:
+                    if self.__holds_leases(lock_names):
+                        # Recorded in the same transaction that confirmed (and locked) the leases
+                        self.__add_requests_to_db(api_key, region, num_requests_per_method, request_uri)
+                        self.metrics.observe_permit(api_key, region, num_requests_per_method, time.time() - started_at)
+                        return
+                    # Outlived the leases, so another script may have recorded requests meanwhile; check again
+                    self.dbh.rollback()
+            finally:
+                # Released even if a check raises; if this script dies instead, the leases expire on their own
+                self.__unlock(lock_names)
+            # Sleep without the leases, so other scripts' checks (e.g. on other methods of the key) aren't held up
+            if wait_seconds is not None:
+                time.sleep(wait_seconds)
+
+    def revoke_requests(self, api_key_container, region, num_requests_per_method, request_uri, permitted_at=None):
+        """Give back permitted requests that were never made, e.g. the permits of a reservation expired unused
+
+           The rows are found by their request_uri, so it has to be unique to the permit (permitted_at is unused).
+           Deleting rows only frees room in the windows, so no lease is needed.
+        """
+        api_key = api_key_container.get_api_key()
+        for method, num_requests in num_requests_per_method.items():
+            self.cursor.execute("DELETE FROM RequestHistory "
+                                + "WHERE api_key = %s AND region_name = %s AND method_name = %s AND request_uri = %s "
+                                + "ORDER BY id DESC LIMIT %s",
+                                (api_key, region, method, request_uri, num_requests))
+        self.dbh.commit()
+
+    def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        """Smallest share of max-requests still free amongst the (app and method) limits of the key and methods"""
+        api_key = api_key_container.get_api_key()
+        headroom = 1.0
+        for limit_method in [None] + list(methods):
+            if limit_method is None:
+                limits = api_key_container.get_app_rate_limits()
+            else:
+                limits = api_key_container.get_method_rate_limits().get_rate_limit(limit_method, region)
+            if len(limits) == 0:
+                continue
+            requests_in_history = self.__count_requests(api_key, region, limit_method, [int(rl[1]) for rl in limits])
+            for rl in limits:
+                usable_max_requests = self.request_priorities.get_max_requests(int(rl[0]), priority)
+                headroom = min(headroom, (usable_max_requests - requests_in_history[int(rl[1])]) / int(rl[0]))
+        return headroom
+
+    def get_metrics(self):
+        """Snapshot of the limiter's metrics (see RateLimitMetrics), of this process' checks and permits"""
+        return self.metrics.get_snapshot()
+
+    def synchronize_request_counts(self, api_key_container, region, method,
+                                   app_rate_limit_counts, method_rate_limit_counts):
+        """Reconcile the history with counts received from API (X-App-Rate-Limit-Count, X-Method-Rate-Limit-Count)
+
+           Counts are in format [[num-requests, timeframe-size], ..]. Requests the API has counted but the history
+           is missing (made outside of this bookkeeping, drift between scripts) are added as placeholder requests,
+           each timeframe's just before the next shorter one (see get_placeholder_requests) so that they don't fill
+           the shorter timeframes. The history is never reduced, so it errs on the safe side.
+        """
+        api_key = api_key_container.get_api_key()
+        method_timeframe_sizes = [
+            int(rl[1]) for
             rl in
             api_key_container.get_method_rate_limits().get_rate_limit(method, region)
         ]
-        # Lock tables to prevent a race condition between multiple active scripts
-        self.__lock()
-        # Check rate-limit quotas, catches first full quota
-        ok, wait_seconds = self.__check_rate_limits(app_rate_limits + request_specific_method_rate_limits)
-        while not ok:
-            time.sleep(wait_seconds)
-            # Re-check in case if multiple quotas full simultaneously
-            ok, wait_seconds = self.__check_rate_limits(app_rate_limits + request_specific_method_rate_limits)
-        self.__add_request_to_db(api_key, region, method, request_uri)
-        self.__unlock()
+        app_timeframe_sizes = [int(rl[1]) for rl in api_key_container.get_app_rate_limits()]
+        lock_names = self.__get_lock_names([[None, None, region, None, api_key],
+                                            [None, None, region, method, api_key]])
+        self.__lock(lock_names)
+        try:
+            self.__add_missing_requests(api_key, region, method, method_timeframe_sizes, app_timeframe_sizes,
+                                        app_rate_limit_counts, method_rate_limit_counts)
+        finally:
+            self.__unlock(lock_names)
+
+    def __add_missing_requests(self, api_key, region, method, method_timeframe_sizes, app_timeframe_sizes,
+                               app_rate_limit_counts, method_rate_limit_counts):
+        # Method first, since placeholders for the method count towards the app-rate-limits too
+        if len(method_rate_limit_counts) > 0 and len(method_timeframe_sizes) > 0:
+            requests_in_history = self.__count_requests(api_key, region, method, method_timeframe_sizes)
+            for num_requests, seconds_ago in get_placeholder_requests(method_rate_limit_counts, requests_in_history):
+                self.__add_placeholder_requests_to_db(api_key, region, method, 'X-Method-Rate-Limit-Count',
+                                                      num_requests, seconds_ago)
+        if len(app_rate_limit_counts) > 0 and len(app_timeframe_sizes) > 0:
+            requests_in_history = self.__count_requests(api_key, region, None, app_timeframe_sizes)
+            for num_requests, seconds_ago in get_placeholder_requests(app_rate_limit_counts, requests_in_history):
+                # Empty method_name, so they count towards the app-rate-limits only
+                self.__add_placeholder_requests_to_db(api_key, region, '', 'X-App-Rate-Limit-Count',
+                                                      num_requests, seconds_ago)
@@ -0,0 +1,44 @@
+from .exceptions import ConfigurationError
+
+import math
+
+
+class PacingPolicy:
+    """Spreads the requests of a rate limit evenly over its timeframe instead of letting them burst at its start
+
+       Every [max-requests, timeframe-size] limit gets a derived limit of its sustainable rate per pacing interval
+       plus the burst allowance, e.g. [[500, 10]] paced per 1 second with a burst of 10 => [[60, 1], [500, 10]];
+       requests trickle at ~50/s instead of 500 in the first second and a 9 second wait. Behaves like a leaky
+       bucket (GCRA) while using the sliding windows every request history backend already keeps.
+    """
+
+    def __init__(self, burst=0, interval_seconds=1):
+        """burst as requests allowed per interval on top of the sustainable rate, interval_seconds a whole second"""
+        if int(interval_seconds) < 1 or int(burst) < 0:
+            raise ConfigurationError('Pacing needs an interval of 1+ seconds and a burst of 0+, got {} and {}'.format(
+                interval_seconds, burst))
+        self.burst = int(burst)
+        self.interval_seconds = int(interval_seconds)
+
+    def pace(self, rate_limits):
+        """[[max-requests, timeframe-size], ..] with the derived limits added, sorted by timeframe-size
+
+           A derived limit sharing its timeframe-size with another limit is merged into it (the stricter wins),
+           since the backends keep one window per timeframe-size.
+        """
+        max_requests_per_timeframe = {}
+        for rl in rate_limits:
+            timeframe_size = int(rl[1])
+            max_requests_per_timeframe[timeframe_size] = min(int(rl[0]),
+                                                             max_requests_per_timeframe.get(timeframe_size, int(rl[0])))
+        for rl in rate_limits:
+            max_requests, timeframe_size = int(rl[0]), int(rl[1])
+            if timeframe_size <= self.interval_seconds:
+                continue
+            paced_max_requests = math.ceil(max_requests * self.interval_seconds / timeframe_size) + self.burst
+            max_requests_per_timeframe[self.interval_seconds] = min(
+                paced_max_requests,
+                max_requests_per_timeframe.get(self.interval_seconds, paced_max_requests))
+        return [[max_requests, timeframe_size] for
+                timeframe_size, max_requests in
+                sorted(max_requests_per_timeframe.items())]
@@ -0,0 +1,98 @@
+from .api_key_container import ApiKeyContainer, MethodRateLimits
+
+import socketserver
+import json
+import os
+
+
+class PermitRequestHandler(socketserver.StreamRequestHandler):
+    """Serves one client connection; a line of JSON in, a line of JSON out, until the client disconnects"""
+
+    def handle(self):
+        for line in self.rfile:
+            message = json.loads(line.decode('utf8'))
+            # The client resolves its limits ({method: limits, ..}), so the server needs no configuration of its own
+            api_key_container = None
+            if 'api_key' in message:
+                api_key_container = ApiKeyContainer(
+                    message['api_key'],
+                    message['app_rate_limits'],
+                    MethodRateLimits(message['method_rate_limits']))
+            num_requests_per_method = None
+            reply = {'ok': True}
+            try:
+                if message['op'] == 'permit':
+                    num_requests_per_method = {message['method']: 1}
+                    permitted_at = self.server.request_history_backend.permit_request(api_key_container,
+                                                                                      message['region'],
+                                                                                      message['method'],
+                                                                                      message['request_uri'],
+                                                                                      message['priority'])
+                elif message['op'] == 'permit_mixed':
+                    num_requests_per_method = message['num_requests_per_method']
+                    permitted_at = self.server.request_history_backend.permit_mixed_requests(
+                        api_key_container,
+                        message['region'],
+                        num_requests_per_method,
+                        message['request_uri'],
+                        message['priority'])
+                elif message['op'] == 'revoke':
+                    permitted_at = None
+                    self.server.request_history_backend.revoke_requests(api_key_container,
+                                                                        message['region'],
+                                                                        message['num_requests_per_method'],
+                                                                        message['request_uri'],
+                                                                        message['permitted_at'])
+                elif message['op'] == 'headroom':
+                    permitted_at = None
+                    reply['headroom'] = self.server.request_history_backend.get_headroom(
+                        api_key_container,
+                        message['region'],
+                        list(message['method_rate_limits']),
+                        message['priority'])
+                elif message['op'] == 'metrics':
+                    permitted_at = None
+                    reply['metrics'] = self.server.request_history_backend.get_metrics()
+                elif message['op'] == 'synchronize':
+                    permitted_at = None
+                    self.server.request_history_backend.synchronize_request_counts(api_key_container,
+                                                                                   message['region'],
+                                                                                   message['method'],
+                                                                                   message['app_rate_limit_counts'],
+                                                                                   message['method_rate_limit_counts'])
+                else:
+                    raise ValueError('Unknown op {}'.format(message['op']))
+            except Exception as err:
+                permitted_at = None
+                reply = {'ok': False, 'error': '{}: {}'.format(type(err).__name__, err)}
+            if message.get('op', None) in ('permit', 'permit_mixed'):
+                # The client needs it to revoke the permit, e.g. a reservation that expired unused
+                reply['permitted_at'] = permitted_at
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # Client crashed (or quit) while waiting for its permit, don't let the unused permit eat quota
+                if permitted_at is not None:
+                    self.server.request_history_backend.revoke_requests(api_key_container,
+                                                                        message['region'],
+                                                                        num_requests_per_method,
+                                                                        message['request_uri'],
+                                                                        permitted_at)
+                return
+
+
+class PermitServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Long-lived server owning the rate limit state (e.g. InMemoryRequestHistory) for all scripts on the host
+
+       Every client connection is served in its own thread, so a client waiting for a full rate limit doesn't
+       block clients whose requests go to other rate limit groups. The backend must be thread-safe.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_location, request_history_backend):
+        self.request_history_backend = request_history_backend
+        # A socket file left behind by a previous (killed) server would make bind() fail
+        if os.path.exists(socket_location):
+            os.remove(socket_location)
+        super(PermitServer, self).__init__(socket_location, PermitRequestHandler)
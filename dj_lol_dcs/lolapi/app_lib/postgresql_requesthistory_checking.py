@@ -0,0 +1,351 @@
+from .exceptions import ConfigurationError
+from .request_priorities import RequestPriorities
+from .ratelimit_log_writer import BufferedCsvLogWriter
+from .ratelimit_metrics import RateLimitMetrics
+from .request_count_sync import get_placeholder_requests
+
+from django.db import connections, transaction
+import hashlib
+import time
+
+
+class PostgresqlRequestHistory:
+
+    def __init__(self, logfile_location=None, prune_interval_seconds=60, request_priorities=None, using='default'):
+        """Saves requests as-per rate limit groups (region+method combination) in the Django database (PostgreSQL),
+           and prints or logs them (as csv)
+
+           Reuses the connection Django already holds (per thread) for the database alias `using`, so no database
+           server of its own is needed. The history table is UNLOGGED, as it's only read for the longest timeframe;
+           after a server crash it starts empty and synchronize_request_counts catches it up with the API's counts.
+           Priorities are applied as reserved shares only; there is no cross-script queue of waiting requests.
+        """
+        self.logfile_location = logfile_location
+        self.__log_writer = BufferedCsvLogWriter(logfile_location) if logfile_location is not None else None
+        self.request_priorities = request_priorities if request_priorities is not None else RequestPriorities()
+        self.metrics = RateLimitMetrics()
+        self.using = using
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('CREATE UNLOGGED TABLE IF NOT EXISTS request_history ('
+                           + 'id bigserial PRIMARY KEY, '
+                           + 'at_time timestamptz NOT NULL DEFAULT statement_timestamp(), '
+                           + 'api_key varchar(255) NOT NULL, '
+                           + 'region_name varchar(255) NOT NULL, '
+                           + 'method_name varchar(255) NOT NULL, '
+                           + 'request_uri varchar(510) NOT NULL'
+                           + ')')
+            # Window counts are aggregated within these indexes
+            cursor.execute('CREATE INDEX IF NOT EXISTS request_history_key_region_method_time '
+                           + 'ON request_history (api_key, region_name, method_name, at_time)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS request_history_key_region_time '
+                           + 'ON request_history (api_key, region_name, at_time)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS request_history_at_time ON request_history (at_time)')
+
+        # Requests older than their key's longest rate-limited period are never queried again, so they are pruned
+        # periodically; {api-key: epoch, ..} of the last prune
+        self.prune_interval_seconds = prune_interval_seconds
+        self.__last_pruned_at = {}
+
+    @staticmethod
+    def __get_lock_keys(applied_rate_limits_with_region_and_method):
+        """One advisory lock per rate limit group (key + region + method, or key + region for app-rate-limits)
+
+           Advisory locks are identified by a bigint, so the group is hashed. Sorted, so every script acquires them
+           in the same order and two scripts touching the same groups cannot deadlock each other.
+        """
+        rate_limit_groups = set(
+            "{} {} {}".format(limit[4], limit[2], limit[3] if limit[3] is not None else "App ratelimit") for
+            limit in
+            applied_rate_limits_with_region_and_method
+        )
+        return sorted(int.from_bytes(hashlib.md5(group.encode('utf8')).digest()[:8], 'big', signed=True) for
+                      group in
+                      rate_limit_groups)
+
+    def __begin_transaction(self):
+        """Transaction the advisory (xact) locks are held for, i.e. until it's committed; use as a context manager"""
+        if connections[self.using].in_atomic_block:
+            # The locks would be held (and the sleeps between checks taken) for the rest of the enclosing transaction
+            raise ConfigurationError('PostgresqlRequestHistory must not be used within a transaction')
+        return transaction.atomic(using=self.using)
+
+    @staticmethod
+    def __lock(cursor, lock_keys):
+        for lock_key in lock_keys:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_key])
+
+    @staticmethod
+    def __get_applied_rate_limits(api_key_container, region, methods):
+        """From standard [[max-requests, timeframe-size], ..]
+           to structure [[max-requests, timeframe-size, region, method, api-key], ..] app-rate-limits having None
+           as method; every key has limits (and therefore requests counted against them) of its own
+        """
+        api_key = api_key_container.get_api_key()
+        app_rate_limits = [
+            rl + [region, None, api_key] for
+            rl in
+            api_key_container.get_app_rate_limits()
+        ]
+        request_specific_method_rate_limits = [
+            rl + [region, method, api_key] for
+            method in
+            methods for
+            rl in
+            api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+        ]
+        return app_rate_limits + request_specific_method_rate_limits
+
+    @staticmethod
+    def __get_window_condition(api_key, region, method, timeframe_size):
+        """WHERE-condition (and its parameters) of a rate limit's window, method None for the region's app-rate-limit
+
+           statement_timestamp() is stable within the statement, so the indexes are usable for the comparison.
+        """
+        if method is None:
+            return ("api_key = %s AND region_name = %s "
+                    + "AND at_time >= statement_timestamp() - %s * INTERVAL '1 second'",
+                    [api_key, region, timeframe_size])
+        return ("api_key = %s AND region_name = %s AND method_name = %s "
+                + "AND at_time >= statement_timestamp() - %s * INTERVAL '1 second'",
+                [api_key, region, method, timeframe_size])
+
+    def __get_nth_oldest_request_time(self, cursor, api_key, region, method, timeframe_size, n):
+        """Time of the n:th (0 being the oldest) request in the rate limit's window"""
+        condition, params = self.__get_window_condition(api_key, region, method, timeframe_size)
+        cursor.execute("SELECT EXTRACT(EPOCH FROM at_time) FROM request_history WHERE " + condition
+                       + " ORDER BY at_time ASC LIMIT 1 OFFSET %s", params + [n])
+        row = cursor.fetchone()
+        return float(row[0]) if row is not None else time.time()
+
+    def __check_rate_limits(self, cursor, applied_rate_limits_with_region_and_method, num_requests_per_method,
+                            priority):
+        """applied_rate_limits_with_region_and_method is modified
+               from standard [[max-requests, timeframe-size], ..]
+               to structure [[max-requests, timeframe-size, region, method, api-key], ..]
+           same as in MysqlRequestHistory, num_requests_per_method being {method: num-requests-to-fit, ..}
+           The shares reserved for higher priorities are off limits (unless the batch would never fit otherwise).
+           Every limit is checked in one pass, returning the wait until the last of the full limits has room.
+        """
+
+        # DB query the number of requests (and the oldest of them) in each limit's window, one row per limit
+        subqueries = []
+        subquery_params = []
+        for limit_idx, limit in enumerate(applied_rate_limits_with_region_and_method):
+            condition, params = self.__get_window_condition(limit[4], str(limit[2]),
+                                                            str(limit[3]) if limit[3] is not None else None,
+                                                            int(limit[1]))
+            subqueries.append("(SELECT %s, COUNT(*), EXTRACT(EPOCH FROM MIN(at_time)) FROM request_history WHERE "
+                              + condition + ")")
+            subquery_params += [limit_idx] + params
+        cursor.execute(" UNION ALL ".join(subqueries), subquery_params)
+        window_stats = {int(row[0]): (int(row[1]), row[2]) for row in cursor.fetchall()}
+
+        # Make comparisons
+        wait_seconds = None
+        binding_limit = None
+        for limit_idx, limit in enumerate(applied_rate_limits_with_region_and_method):
+            max_requests_in_timeframe = int(limit[0])
+            timeframe_size            = int(limit[1])
+            region                    = str(limit[2])
+            method                    = str(limit[3]) if limit[3] is not None else None
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            if num_requests > max_requests_in_timeframe:
+                raise ConfigurationError('{} requests never fit in [{}, {}] rate limit of {} {}'.format(
+                    num_requests, max_requests_in_timeframe, timeframe_size, region, method))
+            requests_done_in_timeframe, oldest_request_time = window_stats[limit_idx]
+            if self.logfile_location is None:
+                print("[RATE-LIMIT][{}][{}][{}/{}, in {} second timeframe]".format(
+                    region,
+                    method,
+                    requests_done_in_timeframe,
+                    max_requests_in_timeframe,
+                    timeframe_size))
+            else:
+                # Queued for the background writer, so that no file is opened while the limits are locked
+                self.__log_writer.writerow([time.time(),
+                                            region,
+                                            method,
+                                            timeframe_size,
+                                            requests_done_in_timeframe,
+                                            max_requests_in_timeframe])
+            self.metrics.observe_limit(limit[4], region, method, timeframe_size, requests_done_in_timeframe,
+                                       max_requests_in_timeframe)
+            usable_max_requests = max(self.request_priorities.get_max_requests(max_requests_in_timeframe, priority),
+                                      num_requests)
+            if requests_done_in_timeframe + num_requests > usable_max_requests:
+                # Wait for as many of the oldest requests to fall out of the timeframe as there are missing slots
+                blocking_request_idx = requests_done_in_timeframe + num_requests - usable_max_requests - 1
+                if blocking_request_idx == 0:
+                    blocking_request_time = float(oldest_request_time)
+                else:
+                    blocking_request_time = self.__get_nth_oldest_request_time(cursor, limit[4], region, method,
+                                                                               timeframe_size, blocking_request_idx)
+                limit_wait_seconds = timeframe_size - (time.time() - blocking_request_time)
+                if binding_limit is None or limit_wait_seconds > wait_seconds:
+                    binding_limit = limit
+                wait_seconds = max(wait_seconds or 0, limit_wait_seconds)
+        if binding_limit is not None:
+            self.metrics.observe_binding(binding_limit[4], str(binding_limit[2]),
+                                         str(binding_limit[3]) if binding_limit[3] is not None else None,
+                                         int(binding_limit[1]))
+        return wait_seconds is None, wait_seconds
+
+    def __prune_request_history(self, api_key, longest_timeframe_size):
+        """Delete the key's requests which no longer fall into any of its rate-limited periods, at most once per
+           prune interval; only the key's own, since other keys (e.g. of other scripts) may have longer periods
+        """
+        if time.time() - self.__last_pruned_at.get(api_key, 0) < self.prune_interval_seconds:
+            return
+        with connections[self.using].cursor() as cursor:
+            cursor.execute("DELETE FROM request_history "
+                           + "WHERE api_key = %s AND at_time < statement_timestamp() - %s * INTERVAL '1 second'",
+                           [api_key, longest_timeframe_size])
+        self.__last_pruned_at[api_key] = time.time()
+
+    @staticmethod
+    def __add_requests_to_db(cursor, api_key, region, num_requests_per_method, request_uri):
+        escaped_sqlstr = ('INSERT INTO request_history ('
+                          + 'api_key, '
+                          + 'region_name, '
+                          + 'method_name, '
+                          + 'request_uri'
+                          + ") VALUES (%s, %s, %s, %s)")
+        cursor.executemany(escaped_sqlstr, [
+            (api_key, region, method, request_uri) for
+            method, num_requests in
+            num_requests_per_method.items() for
+            _ in
+            range(num_requests)
+        ])
+
+    def __count_requests(self, cursor, api_key, region, method, timeframe_sizes):
+        """Number of requests in each timeframe, method None counting all of the region's (app-rate-limited) requests"""
+        condition, params = self.__get_window_condition(api_key, region, method, max(timeframe_sizes))
+        count_column = "COUNT(*) FILTER (WHERE at_time >= statement_timestamp() - %s * INTERVAL '1 second')"
+        count_columns = [count_column] * len(timeframe_sizes)
+        cursor.execute("SELECT " + ", ".join(count_columns) + " FROM request_history WHERE " + condition,
+                       list(timeframe_sizes) + params)
+        counts = cursor.fetchone()
+        return {
+            timeframe_size: int(count) for
+            timeframe_size, count in
+            zip(timeframe_sizes, counts)
+        }
+
+    @staticmethod
+    def __add_placeholder_requests_to_db(cursor, api_key, region, method, request_uri, num_requests, seconds_ago):
+        escaped_sqlstr = ('INSERT INTO request_history ('
+                          + 'api_key, '
+                          + 'region_name, '
+                          + 'method_name, '
+                          + 'request_uri, '
+                          + 'at_time'
+                          + ") VALUES (%s, %s, %s, %s, statement_timestamp() - %s * INTERVAL '1 second')")
+        cursor.executemany(escaped_sqlstr, [(api_key, region, method, request_uri, seconds_ago)] * num_requests)
+
+    def permit_request(self, api_key_container, region, method, request_uri,
+                       priority=RequestPriorities.LIVE_MATCH):
+        self.permit_mixed_requests(api_key_container, region, {method: 1}, request_uri, priority)
+
+    def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                        priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until all num_requests fit in the rate limits at once, and reserves them"""
+        self.permit_mixed_requests(api_key_container, region, {method: num_requests}, request_uri, priority)
+
+    def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until {method: num-requests, ..} fit in the rate limits at once, and reserves them"""
+        api_key = api_key_container.get_api_key()
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        longest_timeframe_size = max([int(rl[1]) for rl in api_key_container.get_app_rate_limits()]
+                                     + [api_key_container.get_method_rate_limits().get_longest_timeframe()])
+        # Lock the touched rate limit groups to prevent a race condition between multiple active scripts,
+        # scripts requesting other regions (and thus other app-rate-limit groups) are not blocked
+        lock_keys = self.__get_lock_keys(applied_rate_limits)
+        self.__prune_request_history(api_key, longest_timeframe_size)
+        started_at = time.time()
+        while True:
+            with self.__begin_transaction(), connections[self.using].cursor() as cursor:
+                self.__lock(cursor, lock_keys)
+                ok, wait_seconds = self.__check_rate_limits(cursor, applied_rate_limits, num_requests_per_method,
+                                                            priority)
+                if ok:
+                    self.__add_requests_to_db(cursor, api_key, region, num_requests_per_method, request_uri)
+                    self.metrics.observe_permit(api_key, region, num_requests_per_method, time.time() - started_at)
+                    return
+            # Sleep after the transaction (and its locks) ended, so other scripts' checks aren't held up meanwhile
+            time.sleep(wait_seconds)
+
+    def revoke_requests(self, api_key_container, region, num_requests_per_method, request_uri, permitted_at=None):
+        """Give back permitted requests that were never made, e.g. the permits of a reservation expired unused
+
+           The rows are found by their request_uri, so it has to be unique to the permit (permitted_at is unused).
+           Deleting rows only frees room in the windows, so no advisory lock is needed.
+        """
+        api_key = api_key_container.get_api_key()
+        with connections[self.using].cursor() as cursor:
+            for method, num_requests in num_requests_per_method.items():
+                cursor.execute("DELETE FROM request_history WHERE id IN ("
+                               + "SELECT id FROM request_history "
+                               + "WHERE api_key = %s AND region_name = %s AND method_name = %s AND request_uri = %s "
+                               + "ORDER BY id DESC LIMIT %s)",
+                               [api_key, region, method, request_uri, num_requests])
+
+    def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        """Smallest share of max-requests still free amongst the (app and method) limits of the key and methods"""
+        api_key = api_key_container.get_api_key()
+        headroom = 1.0
+        with connections[self.using].cursor() as cursor:
+            for limit_method in [None] + list(methods):
+                if limit_method is None:
+                    limits = api_key_container.get_app_rate_limits()
+                else:
+                    limits = api_key_container.get_method_rate_limits().get_rate_limit(limit_method, region)
+                if len(limits) == 0:
+                    continue
+                requests_in_history = self.__count_requests(cursor, api_key, region, limit_method,
+                                                            [int(rl[1]) for rl in limits])
+                for rl in limits:
+                    usable_max_requests = self.request_priorities.get_max_requests(int(rl[0]), priority)
+                    headroom = min(headroom, (usable_max_requests - requests_in_history[int(rl[1])]) / int(rl[0]))
+        return headroom
+
+    def get_metrics(self):
+        """Snapshot of the limiter's metrics (see RateLimitMetrics), of this process' checks and permits"""
+        return self.metrics.get_snapshot()
+
+    def synchronize_request_counts(self, api_key_container, region, method,
+                                   app_rate_limit_counts, method_rate_limit_counts):
+        """Reconcile the history with counts received from API (X-App-Rate-Limit-Count, X-Method-Rate-Limit-Count)
+
+           Counts are in format [[num-requests, timeframe-size], ..]. Requests the API has counted but the history
+           is missing (made outside of this bookkeeping, drift between scripts) are added as placeholder requests,
+           each timeframe's just before the next shorter one (see get_placeholder_requests) so that they don't fill
+           the shorter timeframes. The history is never reduced, so it errs on the safe side.
+        """
+        api_key = api_key_container.get_api_key()
+        method_timeframe_sizes = [
+            int(rl[1]) for
+            rl in
+            api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+        ]
+        app_timeframe_sizes = [int(rl[1]) for rl in api_key_container.get_app_rate_limits()]
+        lock_keys = self.__get_lock_keys([[None, None, region, None, api_key],
+                                          [None, None, region, method, api_key]])
+        with self.__begin_transaction(), connections[self.using].cursor() as cursor:
+            self.__lock(cursor, lock_keys)
+            # Method first, since placeholders for the method count towards the app-rate-limits too
+            if len(method_rate_limit_counts) > 0 and len(method_timeframe_sizes) > 0:
+                requests_in_history = self.__count_requests(cursor, api_key, region, method, method_timeframe_sizes)
+                for num_requests, seconds_ago in get_placeholder_requests(method_rate_limit_counts,
+                                                                          requests_in_history):
+                    self.__add_placeholder_requests_to_db(cursor, api_key, region, method,
+                                                          'X-Method-Rate-Limit-Count', num_requests, seconds_ago)
+            if len(app_rate_limit_counts) > 0 and len(app_timeframe_sizes) > 0:
+                requests_in_history = self.__count_requests(cursor, api_key, region, None, app_timeframe_sizes)
+                for num_requests, seconds_ago in get_placeholder_requests(app_rate_limit_counts, requests_in_history):
+                    # Empty method_name, so they count towards the app-rate-limits only
+                    self.__add_placeholder_requests_to_db(cursor, api_key, region, '', 'X-App-Rate-Limit-Count',
+                                                          num_requests, seconds_ago)
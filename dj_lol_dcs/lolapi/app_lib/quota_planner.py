@@ -0,0 +1,50 @@
+from .request_priorities import RequestPriorities
+
+import math
+
+
+class QuotaPlanner:
+    """Predicts how long a job's requests take under the rate limits of a key pool, and which limit holds it back
+
+       Every limit lets a full window of requests go at once and then max-requests per timeframe, so n requests
+       need (ceil(n / max-requests) - 1) timeframes; the keys of the pool add up their max-requests. The job can't
+       go faster than its slowest limit, nor than its requests made one after another (seconds_per_request).
+    """
+
+    def __init__(self, api_key_pool, request_priorities=None, seconds_per_request=0.0):
+        self.__api_key_containers = api_key_pool.get_api_key_containers()
+        self.request_priorities = request_priorities if request_priorities is not None else RequestPriorities()
+        self.seconds_per_request = seconds_per_request
+
+    def __get_usable_max_requests(self, limits_per_key, priority):
+        """{timeframe-size: max-requests of every key together, ..}, as usable by the priority"""
+        max_requests_per_timeframe = {}
+        for rate_limits in limits_per_key:
+            for max_requests, timeframe_size in rate_limits:
+                usable_max_requests = self.request_priorities.get_max_requests(int(max_requests), priority)
+                max_requests_per_timeframe[int(timeframe_size)] = (
+                    max_requests_per_timeframe.get(int(timeframe_size), 0) + usable_max_requests)
+        return max_requests_per_timeframe
+
+    def plan(self, region, num_requests_per_method, priority=RequestPriorities.LIVE_MATCH):
+        """Returns (predicted seconds, [[seconds, method, max-requests, timeframe-size, num-requests], ..]) of
+           {method: num-requests, ..}, the limits sorted slowest first, method None for the app-rate-limits
+        """
+        limit_estimates = []
+        num_requests_total = sum(num_requests_per_method.values())
+        app_limits_per_key = [container.get_app_rate_limits() for container in self.__api_key_containers]
+        bucket_limits = [(None, num_requests_total, app_limits_per_key)] + [
+            (method,
+             num_requests,
+             [container.get_method_rate_limits().get_rate_limit(method, region) for
+              container in
+              self.__api_key_containers])
+            for method, num_requests in num_requests_per_method.items()
+        ]
+        for method, num_requests, limits_per_key in bucket_limits:
+            for timeframe_size, max_requests in self.__get_usable_max_requests(limits_per_key, priority).items():
+                seconds = max(0, math.ceil(num_requests / max_requests) - 1) * timeframe_size
+                limit_estimates.append([seconds, method, max_requests, timeframe_size, num_requests])
+        limit_estimates.sort(key=lambda estimate: estimate[0], reverse=True)
+        seconds = max([estimate[0] for estimate in limit_estimates] + [num_requests_total * self.seconds_per_request])
+        return seconds, limit_estimates
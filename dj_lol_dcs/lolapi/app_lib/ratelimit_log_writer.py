@@ -0,0 +1,100 @@
+import threading
+import atexit
+import fcntl
+import queue
+import time
+import csv
+import os
+
+
+class BufferedCsvLogWriter:
+    """Writes the rate limit log (csv) from a background thread, so that a permit check only queues its rows
+
+       Rows are written in batches, once flush_rows of them are queued or flush_interval_seconds has passed since
+       the first one of the batch. When the file grows beyond max_bytes it's rotated (logfile.1, logfile.2, ..,
+       keeping backup_count of them), max_bytes None never rotating. Queued rows are written at interpreter exit.
+       Scripts may share the log file: every write (and rotation) holds an flock of logfile.lock.
+       At most max_queued_rows wait to be written, e.g. while the disk is full the rest are dropped (and counted)
+       instead of piling up in memory; a failed write is printed and the thread goes on with the next batch.
+    """
+
+    def __init__(self, logfile_location, flush_rows=100, flush_interval_seconds=0.5, max_bytes=50*1024*1024,
+                 backup_count=5, max_queued_rows=100000):
+        self.logfile_location = logfile_location
+        self.flush_rows = flush_rows
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.__rows = queue.Queue(maxsize=max_queued_rows)
+        self.dropped_rows = 0
+        self.__closed = False
+        os.makedirs(os.path.dirname(os.path.abspath(self.logfile_location)), exist_ok=True)
+        self.__thread = threading.Thread(target=self.__run, name='BufferedCsvLogWriter', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def writerow(self, row):
+        try:
+            self.__rows.put_nowait(row)
+        except queue.Full:
+            self.dropped_rows += 1
+
+    def close(self):
+        """Write the rows queued so far and stop the background thread"""
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__rows.put(None)
+        self.__thread.join()
+
+    def __rotate(self):
+        for backup_idx in range(self.backup_count - 1, 0, -1):
+            backup_location = '{}.{}'.format(self.logfile_location, backup_idx)
+            if os.path.exists(backup_location):
+                os.replace(backup_location, '{}.{}'.format(self.logfile_location, backup_idx + 1))
+        if self.backup_count > 0:
+            os.replace(self.logfile_location, '{}.1'.format(self.logfile_location))
+        else:
+            os.remove(self.logfile_location)
+
+    def __write(self, rows):
+        # Locked apart from the log file itself, which a rotation renames; opened (again) under the lock, so that
+        # rows never go to a file another script has just rotated away
+        with open('{}.lock'.format(self.logfile_location), 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            with open(self.logfile_location, 'a', newline='') as fh:
+                csv_writer = csv.writer(fh, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+                csv_writer.writerows(rows)
+                logfile_size = fh.tell()
+            if self.max_bytes is not None and logfile_size > self.max_bytes:
+                self.__rotate()
+
+    def __run(self):
+        stopped = False
+        reported_dropped_rows = 0
+        while not stopped:
+            # Block for the first row of a batch, then collect more until the batch is full or due
+            row = self.__rows.get()
+            if row is None:
+                break
+            batch = [row]
+            flush_at = time.time() + self.flush_interval_seconds
+            while len(batch) < self.flush_rows:
+                try:
+                    row = self.__rows.get(timeout=max(0, flush_at - time.time()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopped = True
+                    break
+                batch.append(row)
+            if self.dropped_rows > reported_dropped_rows:
+                print("Rate limit log {} queue was full, dropped {} rows".format(
+                    self.logfile_location, self.dropped_rows - reported_dropped_rows))
+                reported_dropped_rows = self.dropped_rows
+            try:
+                self.__write(batch)
+            except Exception as err:
+                # E.g. disk full or the directory removed; this batch is lost, but the log goes on once it's fixed
+                print("Failed to write {} rows to rate limit log {}: {}".format(len(batch), self.logfile_location,
+                                                                                 repr(err)))
@@ -0,0 +1,119 @@
+import threading
+import socket
+import bisect
+import atexit
+import fcntl
+import json
+import time
+import os
+
+
+class RateLimitMetrics:
+    """Counters and histograms of a rate limiter backend, queryable in-process (get_snapshot), over the permit socket
+       or, for the other backends, exported to a file every now and then (start_export)
+
+       Per bucket (key + region + method + timeframe, method None for app-rate-limits): the requests counted vs.
+       max-requests at its latest check (i.e. its headroom), and how many times it was the binding constraint,
+       i.e. the limit whose wait was the longest when a permit had to wait.
+       Per key + region + method: permits and requests granted, and a histogram of the seconds spent waiting for them.
+    """
+    # Upper bounds of the wait histogram's bins, in seconds; waits longer than the last one go to a bin of their own
+    wait_seconds_bounds = [0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120]
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started_at = time.time()
+        # {(api-key, region, method, timeframe-size): [requests-done, max-requests, observed-at, times-binding], ..}
+        self.__buckets = {}
+        # {(api-key, region, method): [permits, requests, wait-sum, wait-max, [count-per-bin, ..]], ..}
+        self.__permits = {}
+
+    def observe_limit(self, api_key, region, method, timeframe_size, requests_done, max_requests):
+        """A check saw requests_done of max_requests in the limit's window"""
+        with self.__lock:
+            bucket = self.__buckets.setdefault((api_key, region, method, timeframe_size), [0, 0, 0.0, 0])
+            bucket[0] = requests_done
+            bucket[1] = max_requests
+            bucket[2] = time.time()
+
+    def observe_binding(self, api_key, region, method, timeframe_size):
+        """A check had to wait, the limit's wait being the longest of them"""
+        with self.__lock:
+            self.__buckets.setdefault((api_key, region, method, timeframe_size), [0, 0, 0.0, 0])[3] += 1
+
+    def observe_permit(self, api_key, region, num_requests_per_method, wait_seconds):
+        """{method: num-requests, ..} were permitted after waiting wait_seconds"""
+        bin_idx = bisect.bisect_left(self.wait_seconds_bounds, wait_seconds)
+        with self.__lock:
+            for method, num_requests in num_requests_per_method.items():
+                permits = self.__permits.setdefault((api_key, region, method),
+                                                    [0, 0, 0.0, 0.0, [0] * (len(self.wait_seconds_bounds) + 1)])
+                permits[0] += 1
+                permits[1] += num_requests
+                permits[2] += wait_seconds
+                permits[3] = max(permits[3], wait_seconds)
+                permits[4][bin_idx] += 1
+
+    def start_export(self, file_location, interval_seconds=60):
+        """Append a snapshot to file_location every interval_seconds (and at exit) as a line of JSON, along with the
+           process' host and pid; scripts may share the file, ratelimit_metrics.py --file shows the latest of each
+        """
+        def export_periodically():
+            while True:
+                time.sleep(interval_seconds)
+                self.export(file_location)
+        threading.Thread(target=export_periodically, name='RateLimitMetrics', daemon=True).start()
+        atexit.register(self.export, file_location)
+
+    def export(self, file_location):
+        """Append a snapshot to file_location now, see start_export"""
+        snapshot = self.get_snapshot()
+        snapshot['host'] = socket.gethostname()
+        snapshot['pid'] = os.getpid()
+        snapshot['exported_at'] = time.time()
+        try:
+            with open(file_location, 'a') as fh:
+                # A line at a time, so that the scripts sharing the file don't interleave theirs
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                fh.write(json.dumps(snapshot) + '\n')
+        except OSError as err:
+            print("Failed to export rate limit metrics to {}: {}".format(file_location, repr(err)))
+
+    @staticmethod
+    def __mask(api_key):
+        """Enough of the key to tell a pool's keys apart, without exporting the key itself"""
+        return '..{}'.format(api_key[-4:])
+
+    def get_snapshot(self):
+        """JSON-serializable {'since': .., 'buckets': [{..}, ..], 'permits': [{..}, ..]}, the most binding first"""
+        with self.__lock:
+            buckets = [
+                {'api_key': self.__mask(api_key),
+                 'region': region,
+                 'method': method,
+                 'timeframe_size': timeframe_size,
+                 'requests_done': requests_done,
+                 'max_requests': max_requests,
+                 'headroom': (max_requests - requests_done) / max_requests if max_requests > 0 else None,
+                 'observed_at': observed_at,
+                 'times_binding': times_binding} for
+                (api_key, region, method, timeframe_size), (requests_done, max_requests, observed_at, times_binding) in
+                self.__buckets.items()
+            ]
+            permits = [
+                {'api_key': self.__mask(api_key),
+                 'region': region,
+                 'method': method,
+                 'permits_granted': num_permits,
+                 'requests_granted': num_requests,
+                 'wait_seconds_sum': wait_sum,
+                 'wait_seconds_max': wait_max,
+                 'wait_seconds_histogram': [[bound, count] for
+                                            bound, count in
+                                            zip(self.wait_seconds_bounds + [None], wait_counts)]} for
+                (api_key, region, method), (num_permits, num_requests, wait_sum, wait_max, wait_counts) in
+                self.__permits.items()
+            ]
+        buckets.sort(key=lambda bucket: bucket['times_binding'], reverse=True)
+        permits.sort(key=lambda permit: permit['wait_seconds_sum'], reverse=True)
+        return {'since': self.__started_at, 'buckets': buckets, 'permits': permits}
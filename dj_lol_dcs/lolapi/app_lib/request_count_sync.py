@@ -0,0 +1,28 @@
+def get_placeholder_requests(received_counts, requests_in_history):
+    """[(num-requests, seconds-ago), ..] to add to a request history so that it catches up with the API's counts
+
+       received_counts as [[num-requests, timeframe-size], ..] (X-App-Rate-Limit-Count, X-Method-Rate-Limit-Count),
+       requests_in_history as {timeframe-size: num-requests, ..} of the same history, whose timeframes overlap
+       (e.g. the MySQL and PostgreSQL tables). Going from the shortest timeframe up, each one's missing requests are
+       placed just before the next shorter timeframe starts, so that drift in a long timeframe doesn't fill the
+       short ones; those placed for the shorter timeframes already count towards the longer ones.
+    """
+    placeholder_requests = []
+    num_placed = 0
+    shorter_timeframe_size = None
+    for num_received, timeframe_size in sorted([
+        [int(received[0]), int(received[1])] for
+        received in
+        received_counts
+        if int(received[1]) in requests_in_history
+    ], key=lambda received: received[1]):
+        num_missing = num_received - requests_in_history[timeframe_size] - num_placed
+        if num_missing > 0:
+            if shorter_timeframe_size is None:
+                seconds_ago = 0
+            else:
+                seconds_ago = min(shorter_timeframe_size + 1, timeframe_size - 1)
+            placeholder_requests.append((num_missing, seconds_ago))
+            num_placed += num_missing
+        shorter_timeframe_size = timeframe_size
+    return placeholder_requests
@@ -0,0 +1,33 @@
+from .exceptions import ConfigurationError
+
+
+class RequestPriorities:
+    """Priority classes of rate limit permits (the smaller, the sooner) and the shares of capacity reserved for them
+
+       E.g. {'LIVE_MATCH': 0.3, 'HISTORY': 0.2} keeps 30% of every limit's max-requests for live match requests
+       and another 20% for live match and history requests, so that repairs/backfills get the leftover 50%.
+    """
+    LIVE_MATCH = 0
+    HISTORY = 1
+    REPAIR = 2
+
+    __names = ['LIVE_MATCH', 'HISTORY', 'REPAIR']
+
+    def __init__(self, reserved_shares=None):
+        """reserved_shares as {priority-name: share-of-max-requests, ..}, no reservations by default"""
+        self.__reserved_shares = {}
+        for name, share in (reserved_shares or {}).items():
+            if name not in self.__names:
+                raise ConfigurationError('Unknown request priority {}, known are {}'.format(name, self.__names))
+            self.__reserved_shares[getattr(self, name)] = float(share)
+        if sum(self.__reserved_shares.values()) >= 1:
+            raise ConfigurationError('Reserved shares {} leave nothing for the lowest priority'.format(
+                reserved_shares))
+
+    def get_name(self, priority):
+        return self.__names[priority]
+
+    def get_max_requests(self, max_requests, priority):
+        """Max-requests of a limit usable by the priority, i.e. minus the shares reserved for higher priorities"""
+        reserved_share = sum(share for p, share in self.__reserved_shares.items() if p < priority)
+        return max(1, max_requests - int(max_requests * reserved_share))
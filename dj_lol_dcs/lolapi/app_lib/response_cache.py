@@ -0,0 +1,106 @@
+import threading
+import hashlib
+import json
+import gzip
+import os
+
+
+class CachedResponse:
+    """Stands in for the requests.Response of a cached (and therefore successful) request"""
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode('utf8')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class DiskResponseCache:
+    """Responses that never change (e.g. a finished match's result and timeline) as gzip files, shared by every script
+
+       A response is stored under the sha256 of its (platform, endpoint, id), two levels of directories deep so
+       that no directory grows too large. Files are written aside and renamed into place, so concurrent scripts
+       only ever read whole files. A hit refreshes the file's mtime; once the files add up to more than max_bytes
+       the least recently used ones are deleted, down to 90% of max_bytes so that eviction doesn't run every put.
+    """
+
+    def __init__(self, cache_location, max_bytes=1024*1024*1024):
+        self.cache_location = cache_location
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        os.makedirs(self.cache_location, exist_ok=True)
+        self.__total_bytes = sum(size for _, _, size in self.__list_files())
+
+    def __get_path(self, platform, endpoint, key):
+        digest = hashlib.sha256('{} {} {}'.format(platform, endpoint, key).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_location, digest[:2], digest[2:4], digest + '.json.gz')
+
+    def __list_files(self):
+        """[(path, mtime, size), ..] of every cached response"""
+        files = []
+        for dir_path, _, file_names in os.walk(self.cache_location):
+            for file_name in file_names:
+                if not file_name.endswith('.json.gz'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another script meanwhile
+                    continue
+                files.append((path, stat.st_mtime, stat.st_size))
+        return files
+
+    def contains(self, platform, endpoint, key):
+        """Whether the response is cached, without reading it (nor counting as a use)"""
+        return os.path.exists(self.__get_path(platform, endpoint, key))
+
+    def get(self, platform, endpoint, key):
+        """The cached response's content (bytes), None if not cached"""
+        path = self.__get_path(platform, endpoint, key)
+        try:
+            with gzip.open(path, 'rb') as fh:
+                content = fh.read()
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError):
+            # Truncated or otherwise corrupt, e.g. the disk filled up; request it again instead
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, platform, endpoint, key, content):
+        path = self.__get_path(platform, endpoint, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with gzip.open(temp_path, 'wb') as fh:
+            fh.write(content)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.__lock:
+            self.__total_bytes += size
+            if self.__total_bytes > self.max_bytes:
+                self.__evict()
+
+    def __evict(self):
+        # Re-counted from disk, since other scripts put (and evict) files too
+        files = sorted(self.__list_files(), key=lambda f: f[1])
+        self.__total_bytes = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if self.__total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.__total_bytes -= size
@@ -0,0 +1,82 @@
+from .exceptions import RiotApiError, RetriesExhaustedError
+
+import random
+import time
+
+
+class RetryPolicy:
+    """How failed Riot API requests are retried, one policy for every call instead of a copy of the loop around each
+
+       - 429 of the underlying service (X-Rate-Limit-Type service, or none at all): wait Retry-After (or back off)
+         and try again, not counting it as a retry, since it's the service being crowded
+       - 429 of the application or method rate limit: something is badly wrong in our rate limiting, never retried
+       - statuses the caller handles itself (passthrough_statuses, e.g. 404 of "not in a match"): raised as-is
+       - other errors: retried up to the budget (the call's retries, else the endpoint's in retry_budgets, else
+         default_retries), then raised as RetriesExhaustedError
+       Backoff is exponential with jitter (half of it random), so scripts failing together don't retry together,
+       unless the API sent a Retry-After. Every wait goes through wait_hook(seconds), time.sleep by default, so that
+       a script can free what it holds meanwhile instead of idling with it; periodical_data_repair.py gives its
+       unused reserved permits back to the limiter and closes its DB connection.
+    """
+
+    def __init__(self, retry_budgets=None, default_retries=2, base_backoff_seconds=1, max_backoff_seconds=60,
+                 service_backoff_seconds=5, wait_hook=None):
+        """retry_budgets as {endpoint-function-name: retries, ..}, e.g. {'get_match_timeline': 1}"""
+        self.retry_budgets = retry_budgets if retry_budgets is not None else {}
+        self.default_retries = default_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.service_backoff_seconds = service_backoff_seconds
+        self.wait_hook = wait_hook if wait_hook is not None else time.sleep
+
+    def get_retries(self, endpoint):
+        return self.retry_budgets.get(endpoint, self.default_retries)
+
+    def get_backoff_seconds(self, attempt, response, base_backoff_seconds):
+        """Retry-After if the API sent one, else base * 2^attempt (capped) of which the latter half is random"""
+        if 'Retry-After' in response.headers:
+            return float(response.headers['Retry-After'])
+        backoff_seconds = min(self.max_backoff_seconds, base_backoff_seconds * 2 ** attempt)
+        return backoff_seconds / 2 + random.uniform(0, backoff_seconds / 2)
+
+    def run(self, operation, retries=None, description='request', passthrough_statuses=()):
+        """Returns operation() (a request, or a chain of them), retrying it as per the policy"""
+        retries = retries if retries is not None else self.default_retries
+        retries_done = 0
+        service_waits_done = 0
+        while True:
+            try:
+                return operation()
+            except RiotApiError as err:
+                status_code = err.response.status_code
+                if status_code in passthrough_statuses:
+                    raise
+                if status_code == 429:
+                    rate_limit_type = err.response.headers.get('X-Rate-Limit-Type', 'service')
+                    if rate_limit_type != 'service':
+                        print("Really bad. Received {} rate limit error".format(rate_limit_type))
+                        raise RiotApiError(err.response) from None
+                    wait_seconds = self.get_backoff_seconds(service_waits_done, err.response,
+                                                            self.service_backoff_seconds)
+                    service_waits_done += 1
+                    self.wait_hook(wait_seconds)
+                    continue
+                if retries_done >= retries:
+                    print("Retried the maximum {} times to load {}.".format(retries, description))
+                    raise RetriesExhaustedError(err.response) from None
+                wait_seconds = self.get_backoff_seconds(retries_done, err.response, self.base_backoff_seconds)
+                print("Failed to load {} (HTTP Error {}) - retry {}/{} in {:.1f}s".format(
+                    description,
+                    status_code,
+                    retries_done + 1,
+                    retries,
+                    wait_seconds))
+                retries_done += 1
+                self.wait_hook(wait_seconds)
+
+    def call(self, riotapi, endpoint, *args, retries=None, description=None, passthrough_statuses=()):
+        """riotapi.<endpoint>(*args) retried as per the policy, e.g. call(riotapi, 'get_summoner', 'EUW', name)"""
+        return self.run(lambda: getattr(riotapi, endpoint)(*args),
+                        retries=retries if retries is not None else self.get_retries(endpoint),
+                        description=description if description is not None else endpoint,
+                        passthrough_statuses=passthrough_statuses)
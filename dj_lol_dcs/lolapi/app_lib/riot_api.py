@@ -1,22 +1,76 @@
 from .exceptions import RiotApiError, RatelimitMismatchError
+from .api_key_container import ApiKeyPool
+from .request_priorities import RequestPriorities
+from .concurrency_controller import AimdConcurrencyController
+from .http_session_pool import HttpSessionPool
+from .response_cache import CachedResponse
 
 from operator import itemgetter
 
+from collections import deque
+import threading
 import requests
 import json
+import math
 import time
+import uuid
 
 
 class RiotApi:
+    # Rate limit method (as in MethodRateLimits) each of the endpoint functions is counted towards
+    ENDPOINT_METHODS = {
+        'get_summoner': '/lol/summoner/v3/summoners/by-name/{summonerName}',
+        'get_tiers': 'leagues-v3 endpoints',
+        'get_active_match': 'All other endpoints',
+        'get_matchlist': '/lol/match/v3/matchlists/by-account/{accountId}',
+        'get_match_result': '/lol/match/v3/[matches,timelines]',
+        'get_match_timeline': '/lol/match/v3/[matches,timelines]'
+    }
+    # Share of the shortest timeframe (of the limits involved) that reserved permits stay valid for; a request
+    # is counted from its reservation, but by the API from when it's made, so that much of a window overlaps
+    reservation_validity_share = 0.1
+    # Seconds between synchronizations of a key+region+method's counts with the API's (every 429 synchronizes
+    # regardless); with the database backends each one takes the group's lock and runs the count queries
+    synchronize_interval_seconds = 1
 
-    def __init__(self, api_key_container, requesthistory_backend, api_hosts, regional_endpoints):
-        self.__api_key_container = api_key_container
+    def __init__(self, api_key_container_or_pool, requesthistory_backend, api_hosts, regional_endpoints,
+                 priority=RequestPriorities.LIVE_MATCH, concurrency_controller=None, http_session_pool=None,
+                 response_cache=None):
+        if isinstance(api_key_container_or_pool, ApiKeyPool):
+            self.__api_key_pool = api_key_container_or_pool
+        else:
+            self.__api_key_pool = ApiKeyPool([api_key_container_or_pool])
         self.__api_hosts = api_hosts
         self.__endpoints = regional_endpoints
         self.__request_history_backend = requesthistory_backend
+        self.__priority = priority
+        # Shared by every request (and with_priority view), so that they all back off together on an overload
+        if concurrency_controller is None:
+            concurrency_controller = AimdConcurrencyController()
+        self.__concurrency_controller = concurrency_controller
+        # Kept-alive connections per API host, also shared with the with_priority views
+        if http_session_pool is None:
+            http_session_pool = HttpSessionPool()
+        self.__http_session_pool = http_session_pool
+        # Finished matches' results and timelines never change, so they are requested once if a cache is given
+        self.__response_cache = response_cache
+        # {(region, method): deque([[num-permits-left, valid-until, api-key-container, request-uri, permitted-at], ..]),
+        #  ..} permitted ahead by reserve_requests
+        self.__reserved_permits = {}
+        self.__reserved_permits_lock = threading.Lock()
+        # {(api-key, region, method): epoch, ..} of the last synchronize_request_counts
+        self.__synchronized_at = {}
+        self.__synchronized_at_lock = threading.Lock()
 
-    def __validate_app_rate_limits(self, received_limits):
-        configured_limits = self.__api_key_container.get_app_rate_limits()
+    def with_priority(self, priority):
+        """Same API (key, backend) whose requests are permitted with another RequestPriorities priority class"""
+        return RiotApi(self.__api_key_pool, self.__request_history_backend, self.__api_hosts, self.__endpoints,
+                       priority=priority, concurrency_controller=self.__concurrency_controller,
+                       http_session_pool=self.__http_session_pool, response_cache=self.__response_cache)
+
+    @staticmethod
+    def __validate_app_rate_limits(api_key_container, received_limits):
+        configured_limits = api_key_container.get_configured_app_rate_limits()
 
         # Compare length
         if len(configured_limits) != len(received_limits):
@@ -42,10 +96,166 @@ class RiotApi:
                     json.dumps(received_limits))
                 raise RatelimitMismatchError(msg)
 
-    def __get(self, url, api_key_container, region, method):
-        # Update request history and do request
-        self.__request_history_backend.permit_request(api_key_container, region, method, url)
-        response = requests.get(url)
+    @staticmethod
+    def __parse_rate_limit_header(header_value):
+        """Received format e.g. "10:1,100:10,6000:600,36000:3600" => transform to [[n,s], ..]"""
+        return [[int(n) for n in l.split(':')] for l in header_value.split(',')]
+
+    def __synchronize_request_counts(self, response, api_key_container, region, method):
+        """Let the request history catch up with the request counts the API has (also sent along 429 responses)"""
+        sync_key = (api_key_container.get_api_key(), region, method)
+        epoch_now = time.time()
+        with self.__synchronized_at_lock:
+            seconds_since_synchronized = epoch_now - self.__synchronized_at.get(sync_key, 0)
+            if response.status_code != 429 and seconds_since_synchronized < self.synchronize_interval_seconds:
+                return
+            self.__synchronized_at[sync_key] = epoch_now
+        app_rate_limit_counts = []
+        method_rate_limit_counts = []
+        if 'X-App-Rate-Limit-Count' in response.headers:
+            app_rate_limit_counts = self.__parse_rate_limit_header(response.headers['X-App-Rate-Limit-Count'])
+        if 'X-Method-Rate-Limit-Count' in response.headers:
+            method_rate_limit_counts = self.__parse_rate_limit_header(response.headers['X-Method-Rate-Limit-Count'])
+        if len(app_rate_limit_counts) > 0 or len(method_rate_limit_counts) > 0:
+            self.__request_history_backend.synchronize_request_counts(api_key_container, region, method,
+                                                                      app_rate_limit_counts, method_rate_limit_counts)
+
+    def __revoke_reservations(self, region, method, reservations):
+        """Give the unused permits of the (expired or released) reservations back to the request history"""
+        for num_permits_left, _, api_key_container, request_uri, permitted_at in reservations:
+            if num_permits_left > 0:
+                self.__request_history_backend.revoke_requests(api_key_container, region, {method: num_permits_left},
+                                                               request_uri, permitted_at)
+
+    def __consume_reserved_permit(self, region, method):
+        """Use up one of the permits reserved ahead (by reserve_requests), returns its key's container or None"""
+        expired_reservations = []
+        api_key_container = None
+        with self.__reserved_permits_lock:
+            reservations = self.__reserved_permits.get((region, method), deque())
+            while len(reservations) > 0 and (reservations[0][0] == 0 or reservations[0][1] < time.time()):
+                expired_reservations.append(reservations.popleft())
+            if len(reservations) > 0:
+                reservations[0][0] -= 1
+                api_key_container = reservations[0][2]
+        # Outside of the lock, since it's a round trip to the backend
+        self.__revoke_reservations(region, method, expired_reservations)
+        return api_key_container
+
+    def release_reserved_requests(self):
+        """Give back the permits reserved (by reserve_requests) but not used yet, e.g. once a batch is done"""
+        with self.__reserved_permits_lock:
+            released = self.__reserved_permits
+            self.__reserved_permits = {}
+        for (region, method), reservations in released.items():
+            self.__revoke_reservations(region, method, reservations)
+
+    def get_headroom(self, region_name, endpoints):
+        """Share of max-requests still free for the endpoints (on the key with the most), 1.0 being idle"""
+        methods = list(set(self.ENDPOINT_METHODS[endpoint] for endpoint in endpoints))
+        return max(self.__request_history_backend.get_headroom(api_key_container, region_name, methods, self.__priority)
+                   for api_key_container in self.__api_key_pool.get_api_key_containers())
+
+    def __get_batch_seconds(self, region, num_requests_per_method):
+        """Expected duration of a batch, a method's requests at most its concurrency limit at a time (0 unmeasured)"""
+        batch_seconds = 0
+        for method, num_requests in num_requests_per_method.items():
+            response_seconds = self.__concurrency_controller.get_response_seconds(region, method)
+            if response_seconds is None:
+                continue
+            concurrency_limit = max(1, int(self.__concurrency_controller.get_limit(region, method)))
+            batch_seconds += math.ceil(num_requests / concurrency_limit) * response_seconds
+        return batch_seconds
+
+    def reserve_requests(self, region_name, num_requests_per_endpoint):
+        """Reserve permits for a batch of requests at once, e.g. {'get_summoner': 10, 'get_tiers': 10}
+
+           Blocks until the whole batch fits in the rate limits, then the batch's requests skip the per-request
+           permit (and its lock/check/record round trip). A batch larger than the smallest max-requests of its
+           limits could never fit at once, so the reservation is capped to it and the rest are permitted normally.
+           The requests are recorded at the time of reservation, while the API counts them from when they're made;
+           so reserved permits are only valid for reservation_validity_share of the shortest timeframe involved,
+           later requests of the batch are permitted normally. Unused permits are revoked once they expire, or
+           right away by release_reserved_requests. A batch expected to take longer than that (its methods' rounds
+           of concurrent requests, at their average round trip time) isn't reserved at all, since most of its
+           permits would expire and cost a revoke and a permit of their own; e.g. a 1 second app-rate-limit leaves
+           0.1 seconds, less than one round trip.
+        """
+        api_key_container = self.__api_key_pool.select(self.__request_history_backend,
+                                                       region_name,
+                                                       list(set(self.ENDPOINT_METHODS[endpoint] for
+                                                                endpoint in
+                                                                num_requests_per_endpoint)),
+                                                       self.__priority)
+        app_rate_limits = api_key_container.get_app_rate_limits()
+        method_rate_limits = api_key_container.get_method_rate_limits()
+        app_capacity = min([int(rl[0]) for rl in app_rate_limits], default=None)
+        timeframe_sizes = [int(rl[1]) for rl in app_rate_limits]
+        num_requests_per_method = {}
+        for endpoint, num_requests in num_requests_per_endpoint.items():
+            method = self.ENDPOINT_METHODS[endpoint]
+            method_limits = method_rate_limits.get_rate_limit(method, region_name)
+            method_capacity = min([int(rl[0]) for rl in method_limits], default=None)
+            num_reserved = num_requests_per_method.get(method, 0)
+            if method_capacity is not None:
+                num_requests = min(num_requests, method_capacity - num_reserved)
+            if app_capacity is not None:
+                num_requests = min(num_requests, app_capacity)
+                app_capacity -= max(num_requests, 0)
+            if num_requests > 0:
+                num_requests_per_method[method] = num_reserved + num_requests
+                timeframe_sizes += [int(rl[1]) for rl in method_limits]
+        if len(num_requests_per_method) == 0:
+            return
+        validity_seconds = self.reservation_validity_share * min(timeframe_sizes, default=0)
+        if self.__get_batch_seconds(region_name, num_requests_per_method) > validity_seconds:
+            return
+        # Unique, so that the database backends find the reservation's requests to revoke
+        request_uri = 'RiotApi.reserve_requests {}'.format(uuid.uuid4().hex)
+        permitted_at = self.__request_history_backend.permit_mixed_requests(api_key_container,
+                                                                            region_name,
+                                                                            num_requests_per_method,
+                                                                            request_uri,
+                                                                            self.__priority)
+        valid_until = time.time() + validity_seconds
+        with self.__reserved_permits_lock:
+            for method, num_requests in num_requests_per_method.items():
+                self.__reserved_permits.setdefault((region_name, method), deque()).append([num_requests,
+                                                                                           valid_until,
+                                                                                           api_key_container,
+                                                                                           request_uri,
+                                                                                           permitted_at])
+
+    def __get(self, url_with_api_key, api_host, region, method):
+        """url_with_api_key builds the request's URL (on api_host) for the API key picked from the pool"""
+        # Wait for a free slot of the adaptive concurrency limit first, so that a permit isn't held while waiting
+        self.__concurrency_controller.acquire(region, method)
+        response = None
+        connection_failed = False
+        try:
+            # Update request history (unless permitted ahead as part of a reserved batch) and do request
+            api_key_container = self.__consume_reserved_permit(region, method)
+            reserved = api_key_container is not None
+            if not reserved:
+                api_key_container = self.__api_key_pool.select(self.__request_history_backend, region, [method],
+                                                               self.__priority)
+            url = url_with_api_key(api_key_container.get_api_key())
+            if not reserved:
+                self.__request_history_backend.permit_request(api_key_container, region, method, url,
+                                                              self.__priority)
+            try:
+                response = self.__http_session_pool.get_session(api_host).get(url)
+            except (requests.ConnectionError, requests.Timeout):
+                connection_failed = True
+                raise
+        finally:
+            # Only the service's responses (or its unreachability) adapt the limit; a failed permit, backend or
+            # interrupt says nothing about the service
+            if response is not None or connection_failed:
+                self.__concurrency_controller.release(region, method, response)
+            else:
+                self.__concurrency_controller.cancel(region, method)
+        self.__synchronize_request_counts(response, api_key_container, region, method)
 
         # Check response status
         if response.status_code != 200:
@@ -53,58 +263,76 @@ class RiotApi:
 
         # Confirm app-rate-limit(s); Received format e.g. "10:1,100:10,6000:600,36000:3600" => transform to [[n,s], ..]
         received_app_rate_limits = [l.split(':') for l in response.headers['X-App-Rate-Limit'].split(',')]
-        self.__validate_app_rate_limits(received_app_rate_limits)
+        self.__validate_app_rate_limits(api_key_container, received_app_rate_limits)
+
+        return response
+
+    def is_cached(self, platform_name, endpoint, key):
+        """Whether the endpoint's response (e.g. 'get_match_result' of a match id) is served from the response cache,
+           i.e. requesting it takes no permit
+        """
+        return self.__response_cache is not None and self.__response_cache.contains(platform_name, endpoint, key)
 
+    def __get_immutable(self, request, platform_name, endpoint, key):
+        """request()'s response from the response cache if it's there, else requested (using a permit) and cached"""
+        if self.__response_cache is None:
+            return request()
+        content = self.__response_cache.get(platform_name, endpoint, key)
+        if content is not None:
+            return CachedResponse(content)
+        response = request()
+        # Only successful responses get here, __get raises on the others (e.g. 404 of a match still going on)
+        self.__response_cache.put(platform_name, endpoint, key, response.content)
         return response
 
     def get_summoner(self, region_name, name):
-        return self.__get(self.__endpoints.SUMMONER_BY_NAME(self.__api_hosts.get_host_by_region(region_name),
-                                                            name,
-                                                            self.__api_key_container.get_api_key()),
-                          self.__api_key_container,
+        api_host = self.__api_hosts.get_host_by_region(region_name)
+        return self.__get(lambda api_key: self.__endpoints.SUMMONER_BY_NAME(api_host, name, api_key),
+                          api_host,
                           region_name,
-                          '/lol/summoner/v3/summoners/by-name/{summonerName}')
+                          self.ENDPOINT_METHODS['get_summoner'])
 
     def get_tiers(self, region_name, summoner_id):
-        return self.__get(self.__endpoints.TIERS_BY_SUMMONER_ID(self.__api_hosts.get_host_by_region(region_name),
-                                                                summoner_id,
-                                                                self.__api_key_container.get_api_key()),
-                          self.__api_key_container,
+        api_host = self.__api_hosts.get_host_by_region(region_name)
+        return self.__get(lambda api_key: self.__endpoints.TIERS_BY_SUMMONER_ID(api_host, summoner_id, api_key),
+                          api_host,
                           region_name,
-                          'leagues-v3 endpoints')
+                          self.ENDPOINT_METHODS['get_tiers'])
 
     def get_active_match(self, region_name, summoner_id):
-        return self.__get(self.__endpoints.SPECTATOR_BY_SUMMONER_ID(self.__api_hosts.get_host_by_region(region_name),
-                                                                    summoner_id,
-                                                                    self.__api_key_container.get_api_key()),
-                          self.__api_key_container,
+        api_host = self.__api_hosts.get_host_by_region(region_name)
+        return self.__get(lambda api_key: self.__endpoints.SPECTATOR_BY_SUMMONER_ID(api_host, summoner_id, api_key),
+                          api_host,
                           region_name,
-                          'All other endpoints')
+                          self.ENDPOINT_METHODS['get_active_match'])
 
     def get_matchlist(self, region_name, account_id,
                       end_time=int(time.time()*1000), begin_time=(int(time.time()*1000)-(7*24*60*60*1000))
                       ):
-        return self.__get(self.__endpoints.MATCHLIST_BY_ACCOUNT_ID(self.__api_hosts.get_host_by_region(region_name),
-                                                                   account_id,
-                                                                   self.__api_key_container.get_api_key(),
-                                                                   end_time=end_time,
-                                                                   begin_time=begin_time),
-                          self.__api_key_container,
+        api_host = self.__api_hosts.get_host_by_region(region_name)
+        return self.__get(lambda api_key: self.__endpoints.MATCHLIST_BY_ACCOUNT_ID(api_host,
+                                                                                   account_id,
+                                                                                   api_key,
+                                                                                   end_time=end_time,
+                                                                                   begin_time=begin_time),
+                          api_host,
                           region_name,
-                          '/lol/match/v3/matchlists/by-account/{accountId}')
+                          self.ENDPOINT_METHODS['get_matchlist'])
 
     def get_match_result(self, platform_name, match_id):
-        return self.__get(self.__endpoints.MATCH_BY_MATCH_ID(self.__api_hosts.get_host_by_platform(platform_name),
-                                                             match_id,
-                                                             self.__api_key_container.get_api_key()),
-                          self.__api_key_container,
-                          self.__api_hosts.get_region_by_platform(platform_name),
-                          '/lol/match/v3/[matches,timelines]')
+        api_host = self.__api_hosts.get_host_by_platform(platform_name)
+        return self.__get_immutable(
+            lambda: self.__get(lambda api_key: self.__endpoints.MATCH_BY_MATCH_ID(api_host, match_id, api_key),
+                               api_host,
+                               self.__api_hosts.get_region_by_platform(platform_name),
+                               self.ENDPOINT_METHODS['get_match_result']),
+            platform_name, 'get_match_result', match_id)
 
     def get_match_timeline(self, platform_name, match_id):
-        return self.__get(self.__endpoints.TIMELINE_BY_MATCH_ID(self.__api_hosts.get_host_by_platform(platform_name),
-                                                                match_id,
-                                                                self.__api_key_container.get_api_key()),
-                          self.__api_key_container,
-                          self.__api_hosts.get_region_by_platform(platform_name),
-                          '/lol/match/v3/[matches,timelines]')
+        api_host = self.__api_hosts.get_host_by_platform(platform_name)
+        return self.__get_immutable(
+            lambda: self.__get(lambda api_key: self.__endpoints.TIMELINE_BY_MATCH_ID(api_host, match_id, api_key),
+                               api_host,
+                               self.__api_hosts.get_region_by_platform(platform_name),
+                               self.ENDPOINT_METHODS['get_match_timeline']),
+            platform_name, 'get_match_timeline', match_id)
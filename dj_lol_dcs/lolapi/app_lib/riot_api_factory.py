@@ -0,0 +1,134 @@
+from .riot_api import RiotApi
+from .api_key_container import ApiKeyContainer, ApiKeyPool, MethodRateLimits
+from .regional_riotapi_hosts import RegionalRiotapiHosts
+from .request_priorities import RequestPriorities
+from .pacing_policy import PacingPolicy
+from .response_cache import DiskResponseCache
+from .unixsocket_requesthistory_checking import UnixSocketRequestHistory
+from .sharedmemory_requesthistory_checking import SharedMemoryRequestHistory
+from . import riotapi_endpoints
+
+import json
+import os
+
+
+# Same for every API key, the app-rate-limits (RIOT_APP_RATE_LIMITS_JSON) are per key
+METHOD_RATE_LIMITS = {
+    '/lol/summoner/v3/summoners/by-name/{summonerName}': {
+        'EUW': [[2000, 60]],
+        'KR': [[2000, 60]],
+        'NA': [[2000, 60]],
+        'EUNE': [[1600, 60]],
+        'BR': [[1300, 60]],
+        'TR': [[1300, 60]],
+        'LAN': [[1000, 60]],
+        'LAS': [[1000, 60]],
+        'JP': [[800, 60]],
+        'OCE': [[800, 60]],
+        'RU': [[600, 60]]
+    },
+    'leagues-v3 endpoints': {
+        'EUW': [[300, 60]],
+        'NA': [[270, 60]],
+        'EUNE': [[165, 60]],
+        'BR': [[90, 60]],
+        'KR': [[90, 60]],
+        'LAN': [[80, 60]],
+        'LAS': [[80, 60]],
+        'TR': [[60, 60]],
+        'OCE': [[55, 60]],
+        'JP': [[35, 60]],
+        'RU': [[35, 60]]
+    },
+    '/lol/match/v3/matchlists/by-account/{accountId}': [[1000, 10]],
+    '/lol/match/v3/[matches,timelines]': [[500, 10]],
+    'All other endpoints': [[20000, 10]]
+}
+
+
+def build_request_priorities_from_env():
+    """Reserved shares of capacity per priority class (RATELIMIT_PRIORITY_SHARES_JSON) e.g. {"LIVE_MATCH": 0.3}"""
+    return RequestPriorities(json.loads(os.environ.get('RATELIMIT_PRIORITY_SHARES_JSON', '{}')))
+
+
+def build_api_key_pool_from_env():
+    """RIOT_API_KEY (with RIOT_APP_RATE_LIMITS_JSON) and the keys of RIOT_EXTRA_API_KEYS_JSON, e.g.
+       [{"api_key": "RGAPI-..", "app_rate_limits": [[20, 1], [100, 120]]}, ..], each with app-rate-limits of its own;
+       every limit paced (spread evenly over its timeframe plus a burst allowance) if RATELIMIT_PACING_BURST is set
+    """
+    pacing_policy = None
+    if 'RATELIMIT_PACING_BURST' in os.environ:
+        pacing_policy = PacingPolicy(int(os.environ['RATELIMIT_PACING_BURST']))
+    api_keys = [{
+        'api_key': os.environ['RIOT_API_KEY'],
+        'app_rate_limits': json.loads(os.environ['RIOT_APP_RATE_LIMITS_JSON'])  # [[num-requests, within-seconds], ..]
+    }] + json.loads(os.environ.get('RIOT_EXTRA_API_KEYS_JSON', '[]'))
+    return ApiKeyPool([
+        ApiKeyContainer(api_key['api_key'], api_key['app_rate_limits'], MethodRateLimits(METHOD_RATE_LIMITS),
+                        pacing_policy=pacing_policy) for
+        api_key in
+        api_keys
+    ])
+
+
+def build_request_history_from_env(logfile_location=None, request_priorities=None):
+    """Rate limit permits from a local permit daemon (RATELIMIT_PERMIT_SOCKET) or a shared memory file
+       (RATELIMIT_SHARED_MEMORY_FILE) if one is configured, from the MySQL request history if its credentials
+       (MYSQL_REQUESTHISTORY_*) are, otherwise from the Django PostgreSQL database (django.setup() done already)
+
+       Other than the permit daemon (which serves its metrics over the socket), the backend's metrics are exported
+       to RATELIMIT_METRICS_FILE every RATELIMIT_METRICS_INTERVAL seconds (default 60) if it's set
+    """
+    if request_priorities is None:
+        request_priorities = build_request_priorities_from_env()
+    if 'RATELIMIT_PERMIT_SOCKET' in os.environ:
+        return UnixSocketRequestHistory(os.environ['RATELIMIT_PERMIT_SOCKET'])
+    if 'RATELIMIT_SHARED_MEMORY_FILE' in os.environ:
+        request_history = SharedMemoryRequestHistory(os.environ['RATELIMIT_SHARED_MEMORY_FILE'],
+                                                     logfile_location,
+                                                     request_priorities=request_priorities)
+    elif 'RATELIMIT_POSTGRESQL' in os.environ or 'MYSQL_REQUESTHISTORY_USERNAME' not in os.environ:
+        # On the Django database, through the connection the script already has
+        from .postgresql_requesthistory_checking import PostgresqlRequestHistory
+        request_history = PostgresqlRequestHistory(logfile_location, request_priorities=request_priorities)
+    else:
+        # Imported only here, so that MySQLdb is needed only by the scripts using the MySQL request history
+        from .mysql_requesthistory_checking import MysqlRequestHistory
+        request_history = MysqlRequestHistory(os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
+                                              os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
+                                              os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
+                                              logfile_location,
+                                              request_priorities=request_priorities)
+    if 'RATELIMIT_METRICS_FILE' in os.environ:
+        request_history.metrics.start_export(os.environ['RATELIMIT_METRICS_FILE'],
+                                             float(os.environ.get('RATELIMIT_METRICS_INTERVAL', '60')))
+    return request_history
+
+
+def build_response_cache_from_env():
+    """Finished matches' results and timelines from a local (gzip) cache if RIOT_RESPONSE_CACHE_DIR is set, so
+       re-runs cost no quota; RIOT_RESPONSE_CACHE_MAX_MB (default 1024) bounds its size
+    """
+    if 'RIOT_RESPONSE_CACHE_DIR' not in os.environ:
+        return None
+    return DiskResponseCache(os.environ['RIOT_RESPONSE_CACHE_DIR'],
+                             int(os.environ.get('RIOT_RESPONSE_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+
+
+def build_riot_api_from_env(logfile_location=None, priority=RequestPriorities.LIVE_MATCH, api_hosts=None,
+                            api_key_pool=None, request_priorities=None):
+    """RiotApi as configured by the environment variables (see README), shared by every script
+
+       api_key_pool and request_priorities if the script already built them (e.g. for planning), else from the
+       environment likewise; logfile_location is the rate limit csv log, printed if None
+    """
+    if request_priorities is None:
+        request_priorities = build_request_priorities_from_env()
+    if api_key_pool is None:
+        api_key_pool = build_api_key_pool_from_env()
+    return RiotApi(api_key_pool,
+                   build_request_history_from_env(logfile_location, request_priorities),
+                   api_hosts if api_hosts is not None else RegionalRiotapiHosts(),
+                   riotapi_endpoints,
+                   priority=priority,
+                   response_cache=build_response_cache_from_env())
@@ -0,0 +1,334 @@
+from .exceptions import ConfigurationError
+from .request_priorities import RequestPriorities
+from .ratelimit_log_writer import BufferedCsvLogWriter
+from .ratelimit_metrics import RateLimitMetrics
+
+import threading
+import hashlib
+import struct
+import fcntl
+import mmap
+import time
+import os
+
+
+class SharedMemoryRequestHistory:
+    """Saves requests as-per rate limit groups in a memory-mapped file, shared by every script on the host
+
+       File layout:
+       - header: magic, version, number of slots in the bucket table, end of the allocated ring data
+       - bucket table: per slot md5(key+region+method+timeframe), ring offset, ring capacity, ring head, ring count
+       - ring data: per bucket max-requests timestamps (doubles), written in a circle starting from the head
+       The file is locked (flock) for the duration of a check-and-record, never while sleeping.
+       Priorities are applied as reserved shares only; there is no cross-process queue of waiting requests.
+    """
+    __magic = b'LOLRLSHM'
+    __version = 1
+    __header = struct.Struct('<8sIIQ')
+    __slot = struct.Struct('<16sQIII4x')
+    __timestamp = struct.Struct('<d')
+
+    def __init__(self, mmap_file_location, logfile_location=None, num_slots=4096, request_priorities=None):
+        self.logfile_location = logfile_location
+        self.__log_writer = BufferedCsvLogWriter(logfile_location) if logfile_location is not None else None
+        self.request_priorities = request_priorities if request_priorities is not None else RequestPriorities()
+        self.metrics = RateLimitMetrics()
+        self.__thread_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(mmap_file_location)), exist_ok=True)
+        self.__fd = os.open(mmap_file_location, os.O_RDWR | os.O_CREAT, 0o600)
+        self.__mm = None
+        fcntl.flock(self.__fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.__fd).st_size < self.__header.size:
+                # Fresh file, initialize header and an empty bucket table (followed by room for some rings)
+                data_start = self.__header.size + num_slots * self.__slot.size
+                os.ftruncate(self.__fd, data_start + 1024 * 1024)
+                self.__remap()
+                self.__header.pack_into(self.__mm, 0, self.__magic, self.__version, num_slots, data_start)
+            else:
+                self.__remap()
+            magic, version, _, _ = self.__header.unpack_from(self.__mm, 0)
+            if magic != self.__magic or version != self.__version:
+                raise ConfigurationError('{} is not a (version {}) shared request history file'.format(
+                    mmap_file_location, self.__version))
+        finally:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+    def __remap(self):
+        if self.__mm is not None:
+            self.__mm.close()
+        self.__mm = mmap.mmap(self.__fd, os.fstat(self.__fd).st_size)
+
+    def __lock(self):
+        self.__thread_lock.acquire()
+        fcntl.flock(self.__fd, fcntl.LOCK_EX)
+        # Another script may have grown the file (allocating new rings) since our mapping
+        if os.fstat(self.__fd).st_size != len(self.__mm):
+            self.__remap()
+
+    def __unlock(self):
+        fcntl.flock(self.__fd, fcntl.LOCK_UN)
+        self.__thread_lock.release()
+
+    def __allocate_ring(self, capacity):
+        magic, version, num_slots, data_end = self.__header.unpack_from(self.__mm, 0)
+        required_size = data_end + capacity * self.__timestamp.size
+        if required_size > len(self.__mm):
+            os.ftruncate(self.__fd, max(required_size, 2 * len(self.__mm)))
+            self.__remap()
+        self.__header.pack_into(self.__mm, 0, magic, version, num_slots, required_size)
+        return data_end
+
+    def __get_bucket_slot(self, max_requests, timeframe_size, region, method, api_key):
+        """Find (or allocate) the bucket's slot in the table using linear probing, returns slot offset"""
+        digest = hashlib.md5('{} {} {} {}'.format(api_key, region, method, timeframe_size).encode('utf8')).digest()
+        _, _, num_slots, _ = self.__header.unpack_from(self.__mm, 0)
+        first_index = int.from_bytes(digest[:4], 'little') % num_slots
+        for probe in range(num_slots):
+            slot_offset = self.__header.size + ((first_index + probe) % num_slots) * self.__slot.size
+            slot_digest, ring_offset, capacity, head, count = self.__slot.unpack_from(self.__mm, slot_offset)
+            if slot_digest == digest:
+                if capacity != max_requests:
+                    # Re-configured max-requests; keep the most recent timestamps that still fit (old ring is leaked)
+                    kept = [self.__ring_get(ring_offset, capacity, (head - count + i) % capacity)
+                            for i in range(count)][-max_requests:]
+                    ring_offset = self.__allocate_ring(max_requests)
+                    for i, timestamp in enumerate(kept):
+                        self.__ring_set(ring_offset, i, timestamp)
+                    self.__slot.pack_into(self.__mm, slot_offset, digest, ring_offset, max_requests,
+                                          len(kept) % max_requests, len(kept))
+                return slot_offset
+            if slot_digest == bytes(16):
+                ring_offset = self.__allocate_ring(max_requests)
+                self.__slot.pack_into(self.__mm, slot_offset, digest, ring_offset, max_requests, 0, 0)
+                return slot_offset
+        raise ConfigurationError('Shared request history bucket table is full ({} slots)'.format(num_slots))
+
+    def __ring_get(self, ring_offset, capacity, index):
+        return self.__timestamp.unpack_from(self.__mm, ring_offset + (index % capacity) * self.__timestamp.size)[0]
+
+    def __ring_set(self, ring_offset, index, timestamp):
+        self.__timestamp.pack_into(self.__mm, ring_offset + index * self.__timestamp.size, timestamp)
+
+    def __evict_expired(self, slot_offset, timeframe_start):
+        """Drop timestamps that fell out of the timeframe, returns the number of timestamps left"""
+        digest, ring_offset, capacity, head, count = self.__slot.unpack_from(self.__mm, slot_offset)
+        while count > 0 and self.__ring_get(ring_offset, capacity, head - count) < timeframe_start:
+            count -= 1
+        self.__slot.pack_into(self.__mm, slot_offset, digest, ring_offset, capacity, head, count)
+        return count
+
+    def __get_nth_oldest(self, slot_offset, n):
+        """Timestamp of the n:th (0 being the oldest) timestamp in the ring"""
+        _, ring_offset, capacity, head, count = self.__slot.unpack_from(self.__mm, slot_offset)
+        return self.__ring_get(ring_offset, capacity, head - count + n)
+
+    def __append(self, slot_offset, timestamp):
+        digest, ring_offset, capacity, head, count = self.__slot.unpack_from(self.__mm, slot_offset)
+        self.__ring_set(ring_offset, head, timestamp)
+        self.__slot.pack_into(self.__mm, slot_offset, digest, ring_offset, capacity,
+                              (head + 1) % capacity, min(count + 1, capacity))
+
+    def __remove(self, slot_offset, timestamp, num_timestamps):
+        """Remove up to num_timestamps (newest first) occurrences of timestamp, keeping the ring chronological"""
+        digest, ring_offset, capacity, head, count = self.__slot.unpack_from(self.__mm, slot_offset)
+        timestamps = [self.__ring_get(ring_offset, capacity, head - count + i) for i in range(count)]
+        for idx in reversed(range(len(timestamps))):
+            if num_timestamps == 0:
+                break
+            if timestamps[idx] == timestamp:
+                del timestamps[idx]
+                num_timestamps -= 1
+        # Re-written to end at the head, i.e. the removed ones leave a gap at the oldest end
+        for i, kept_timestamp in enumerate(timestamps):
+            self.__ring_set(ring_offset, (head - len(timestamps) + i) % capacity, kept_timestamp)
+        self.__slot.pack_into(self.__mm, slot_offset, digest, ring_offset, capacity, head, len(timestamps))
+
+    @staticmethod
+    def __get_applied_rate_limits(api_key_container, region, methods):
+        """From standard [[max-requests, timeframe-size], ..]
+           to structure [[max-requests, timeframe-size, region, method, api-key], ..] app-rate-limits having None
+           as method; every key has limits (and therefore buckets) of its own
+        """
+        api_key = api_key_container.get_api_key()
+        app_rate_limits = [
+            rl + [region, None, api_key] for
+            rl in
+            api_key_container.get_app_rate_limits()
+        ]
+        request_specific_method_rate_limits = [
+            rl + [region, method, api_key] for
+            method in
+            methods for
+            rl in
+            api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+        ]
+        return app_rate_limits + request_specific_method_rate_limits
+
+    def __check_rate_limits(self, applied_rate_limits_with_region_and_method, num_requests_per_method, priority):
+        """applied_rate_limits_with_region_and_method is modified
+               from standard [[max-requests, timeframe-size], ..]
+               to structure [[max-requests, timeframe-size, region, method, api-key], ..]
+           same as in MysqlRequestHistory, num_requests_per_method being {method: num-requests-to-fit, ..}
+
+           The shares reserved for higher priorities are off limits (unless the batch would never fit otherwise).
+
+           Every limit is checked in one pass, returning the wait until the last of the full limits has room,
+           so a single sleep covers all of them.
+        """
+        epoch_now = time.time()
+        wait_seconds = None
+        binding_limit = None
+        for limit in applied_rate_limits_with_region_and_method:
+            max_requests_in_timeframe = int(limit[0])
+            timeframe_size            = int(limit[1])
+            region                    = str(limit[2])
+            method                    = str(limit[3]) if limit[3] is not None else None
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            if num_requests > max_requests_in_timeframe:
+                raise ConfigurationError('{} requests never fit in [{}, {}] rate limit of {} {}'.format(
+                    num_requests, max_requests_in_timeframe, timeframe_size, region, method))
+            slot_offset = self.__get_bucket_slot(max_requests_in_timeframe, timeframe_size, region, method, limit[4])
+            requests_done_in_timeframe = self.__evict_expired(slot_offset, epoch_now - timeframe_size)
+            if self.logfile_location is None:
+                print("[RATE-LIMIT][{}][{}][{}/{}, in {} second timeframe]".format(
+                    region,
+                    method,
+                    requests_done_in_timeframe,
+                    max_requests_in_timeframe,
+                    timeframe_size))
+            else:
+                # Queued for the background writer, so that no file is opened while the limits are locked
+                self.__log_writer.writerow([time.time(),
+                                            region,
+                                            method,
+                                            timeframe_size,
+                                            requests_done_in_timeframe,
+                                            max_requests_in_timeframe])
+            self.metrics.observe_limit(limit[4], region, method, timeframe_size, requests_done_in_timeframe,
+                                       max_requests_in_timeframe)
+            usable_max_requests = max(self.request_priorities.get_max_requests(max_requests_in_timeframe, priority),
+                                      num_requests)
+            if requests_done_in_timeframe + num_requests > usable_max_requests:
+                # Wait for as many of the oldest requests to fall out of the timeframe as there are missing slots
+                blocking_request_time = self.__get_nth_oldest(
+                    slot_offset, requests_done_in_timeframe + num_requests - usable_max_requests - 1)
+                limit_wait_seconds = timeframe_size - (epoch_now - blocking_request_time)
+                if binding_limit is None or limit_wait_seconds > wait_seconds:
+                    binding_limit = limit
+                wait_seconds = max(wait_seconds or 0, limit_wait_seconds)
+        if binding_limit is not None:
+            self.metrics.observe_binding(binding_limit[4], str(binding_limit[2]),
+                                         str(binding_limit[3]) if binding_limit[3] is not None else None,
+                                         int(binding_limit[1]))
+        return wait_seconds is None, wait_seconds
+
+    def __add_requests_to_buckets(self, applied_rate_limits_with_region_and_method, num_requests_per_method):
+        epoch_now = time.time()
+        for limit in applied_rate_limits_with_region_and_method:
+            method = str(limit[3]) if limit[3] is not None else None
+            slot_offset = self.__get_bucket_slot(int(limit[0]), int(limit[1]), str(limit[2]), method, limit[4])
+            num_requests = (sum(num_requests_per_method.values()) if method is None
+                            else num_requests_per_method[method])
+            for _ in range(num_requests):
+                self.__append(slot_offset, epoch_now)
+        return epoch_now
+
+    def permit_request(self, api_key_container, region, method, request_uri,
+                       priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until the request fits in all of its rate limits, returns the permitted request's timestamp"""
+        return self.permit_mixed_requests(api_key_container, region, {method: 1}, request_uri, priority)
+
+    def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                        priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until all num_requests fit in the rate limits at once, and reserves them"""
+        return self.permit_mixed_requests(api_key_container, region, {method: num_requests}, request_uri, priority)
+
+    def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until {method: num-requests, ..} fit in the rate limits at once, and reserves them"""
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        started_at = time.time()
+        while True:
+            self.__lock()
+            try:
+                ok, wait_seconds = self.__check_rate_limits(applied_rate_limits, num_requests_per_method, priority)
+                if ok:
+                    permitted_at = self.__add_requests_to_buckets(applied_rate_limits, num_requests_per_method)
+                    self.metrics.observe_permit(api_key_container.get_api_key(), region, num_requests_per_method,
+                                                permitted_at - started_at)
+                    return permitted_at
+            finally:
+                self.__unlock()
+            time.sleep(wait_seconds)
+
+    def revoke_requests(self, api_key_container, region, num_requests_per_method, request_uri, permitted_at):
+        """Give back permitted requests that were never made, e.g. the permits of a reservation expired unused;
+           permitted_at as returned by permit_mixed_requests
+        """
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region,
+                                                             num_requests_per_method.keys())
+        self.__lock()
+        try:
+            for limit in applied_rate_limits:
+                method = str(limit[3]) if limit[3] is not None else None
+                slot_offset = self.__get_bucket_slot(int(limit[0]), int(limit[1]), str(limit[2]), method, limit[4])
+                num_requests = (sum(num_requests_per_method.values()) if method is None
+                                else num_requests_per_method[method])
+                self.__remove(slot_offset, permitted_at, num_requests)
+        finally:
+            self.__unlock()
+
+    def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        """Smallest share of max-requests still free amongst the (app and method) limits of the key and methods"""
+        applied_rate_limits = self.__get_applied_rate_limits(api_key_container, region, methods)
+        headroom = 1.0
+        self.__lock()
+        try:
+            epoch_now = time.time()
+            for limit in applied_rate_limits:
+                max_requests_in_timeframe = int(limit[0])
+                slot_offset = self.__get_bucket_slot(max_requests_in_timeframe, int(limit[1]), str(limit[2]),
+                                                     str(limit[3]) if limit[3] is not None else None, limit[4])
+                requests_in_bucket = self.__evict_expired(slot_offset, epoch_now - int(limit[1]))
+                usable_max_requests = self.request_priorities.get_max_requests(max_requests_in_timeframe, priority)
+                headroom = min(headroom, (usable_max_requests - requests_in_bucket) / max_requests_in_timeframe)
+        finally:
+            self.__unlock()
+        return headroom
+
+    def get_metrics(self):
+        """Snapshot of the limiter's metrics (see RateLimitMetrics), of this process' checks and permits
+
+           Other processes sharing the file keep their own.
+        """
+        return self.metrics.get_snapshot()
+
+    def synchronize_request_counts(self, api_key_container, region, method,
+                                   app_rate_limit_counts, method_rate_limit_counts):
+        """Reconcile the buckets with counts received from API (X-App-Rate-Limit-Count, X-Method-Rate-Limit-Count)
+
+           Counts are in format [[num-requests, timeframe-size], ..]. Requests the API has counted but the bucket
+           is missing are added as timestamps of the current time. Buckets are never reduced.
+        """
+        self.__lock()
+        try:
+            epoch_now = time.time()
+            for limit in self.__get_applied_rate_limits(api_key_container, region, [method]):
+                received_counts = app_rate_limit_counts if limit[3] is None else method_rate_limit_counts
+                received_count_per_timeframe = {int(received[1]): int(received[0]) for received in received_counts}
+                max_requests_in_timeframe = int(limit[0])
+                timeframe_size = int(limit[1])
+                if timeframe_size not in received_count_per_timeframe:
+                    continue
+                slot_offset = self.__get_bucket_slot(max_requests_in_timeframe, timeframe_size, str(limit[2]),
+                                                     str(limit[3]) if limit[3] is not None else None, limit[4])
+                requests_in_bucket = self.__evict_expired(slot_offset, epoch_now - timeframe_size)
+                missing_requests = received_count_per_timeframe[timeframe_size] - requests_in_bucket
+                # Beyond max-requests the ring would only overwrite own (older) timestamps
+                for _ in range(min(missing_requests, max_requests_in_timeframe - requests_in_bucket)):
+                    self.__append(slot_offset, epoch_now)
+        finally:
+            self.__unlock()
@@ -0,0 +1,144 @@
+from .exceptions import PermitServerError
+from .request_priorities import RequestPriorities
+
+import threading
+import socket
+import json
+
+
+class UnixSocketRequestHistory:
+
+    def __init__(self, socket_location):
+        """Asks permits from a PermitServer over a unix domain socket, instead of bookkeeping requests itself
+
+           Keeps one connection open (re-connecting if the server restarts), so a permit costs one round trip
+           through the kernel instead of a DB transaction. Every thread has a connection of its own, so that
+           a thread waiting for its permit doesn't hold up the other threads' permits.
+        """
+        self.socket_location = socket_location
+        self.__thread_local = threading.local()
+
+    def __connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.socket_location)
+        self.__thread_local.connection = connection
+        self.__thread_local.connection_fh = connection.makefile('rwb')
+
+    def __disconnect(self):
+        try:
+            self.__thread_local.connection_fh.close()
+            self.__thread_local.connection.close()
+        except (OSError, AttributeError):
+            pass
+        self.__thread_local.connection = None
+        self.__thread_local.connection_fh = None
+
+    def __send(self, message):
+        # One re-connect attempt, in case the server was restarted since the previous message
+        for attempt in range(2):
+            try:
+                if getattr(self.__thread_local, 'connection', None) is None:
+                    self.__connect()
+                self.__thread_local.connection_fh.write((json.dumps(message) + '\n').encode('utf8'))
+                self.__thread_local.connection_fh.flush()
+                reply_line = self.__thread_local.connection_fh.readline()
+                if len(reply_line) == 0:
+                    raise ConnectionResetError('Permit server closed the connection')
+                break
+            except OSError as err:
+                self.__disconnect()
+                if attempt == 1:
+                    raise PermitServerError('Permit server at {} unreachable ({})'.format(
+                        self.socket_location, err)) from None
+        reply = json.loads(reply_line.decode('utf8'))
+        if not reply['ok']:
+            raise PermitServerError(reply['error'])
+        return reply
+
+    def permit_request(self, api_key_container, region, method, request_uri,
+                       priority=RequestPriorities.LIVE_MATCH):
+        return self.__send({
+            'op': 'permit',
+            'api_key': api_key_container.get_api_key(),
+            'app_rate_limits': api_key_container.get_app_rate_limits(),
+            'method_rate_limits': {
+                method: api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+            },
+            'region': region,
+            'method': method,
+            'request_uri': request_uri,
+            'priority': priority
+        })['permitted_at']
+
+    def permit_requests(self, api_key_container, region, method, num_requests, request_uri,
+                        priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until all num_requests fit in the rate limits at once, and reserves them"""
+        return self.permit_mixed_requests(api_key_container, region, {method: num_requests}, request_uri, priority)
+
+    def permit_mixed_requests(self, api_key_container, region, num_requests_per_method, request_uri,
+                              priority=RequestPriorities.LIVE_MATCH):
+        """Blocks until {method: num-requests, ..} fit in the rate limits at once, and reserves them"""
+        return self.__send({
+            'op': 'permit_mixed',
+            'api_key': api_key_container.get_api_key(),
+            'app_rate_limits': api_key_container.get_app_rate_limits(),
+            'method_rate_limits': {
+                method: api_key_container.get_method_rate_limits().get_rate_limit(method, region) for
+                method in
+                num_requests_per_method
+            },
+            'region': region,
+            'num_requests_per_method': num_requests_per_method,
+            'request_uri': request_uri,
+            'priority': priority
+        })['permitted_at']
+
+    def revoke_requests(self, api_key_container, region, num_requests_per_method, request_uri, permitted_at):
+        """Give back permitted requests that were never made; permitted_at as returned by permit_mixed_requests"""
+        self.__send({
+            'op': 'revoke',
+            'api_key': api_key_container.get_api_key(),
+            'app_rate_limits': api_key_container.get_app_rate_limits(),
+            'method_rate_limits': {
+                method: api_key_container.get_method_rate_limits().get_rate_limit(method, region) for
+                method in
+                num_requests_per_method
+            },
+            'region': region,
+            'num_requests_per_method': num_requests_per_method,
+            'request_uri': request_uri,
+            'permitted_at': permitted_at
+        })
+
+    def get_headroom(self, api_key_container, region, methods, priority=RequestPriorities.LIVE_MATCH):
+        return self.__send({
+            'op': 'headroom',
+            'api_key': api_key_container.get_api_key(),
+            'app_rate_limits': api_key_container.get_app_rate_limits(),
+            'method_rate_limits': {
+                method: api_key_container.get_method_rate_limits().get_rate_limit(method, region) for
+                method in
+                methods
+            },
+            'region': region,
+            'priority': priority
+        })['headroom']
+
+    def get_metrics(self):
+        """Snapshot of the permit server's metrics (see RateLimitMetrics), i.e. of every script using it"""
+        return self.__send({'op': 'metrics'})['metrics']
+
+    def synchronize_request_counts(self, api_key_container, region, method,
+                                   app_rate_limit_counts, method_rate_limit_counts):
+        self.__send({
+            'op': 'synchronize',
+            'api_key': api_key_container.get_api_key(),
+            'app_rate_limits': api_key_container.get_app_rate_limits(),
+            'method_rate_limits': {
+                method: api_key_container.get_method_rate_limits().get_rate_limit(method, region)
+            },
+            'region': region,
+            'method': method,
+            'app_rate_limit_counts': app_rate_limit_counts,
+            'method_rate_limit_counts': method_rate_limit_counts
+        })
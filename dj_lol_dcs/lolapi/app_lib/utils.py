@@ -1,10 +1,13 @@
 from lolapi.app_lib.exceptions import RiotApiError, ConfigurationError, RatelimitMismatchError, MatchTakenError
+from lolapi.app_lib.exceptions import RetriesExhaustedError
+from lolapi.app_lib.retry_policy import RetryPolicy
 from lolapi.models import GameVersion, Champion, ChampionGameData, StaticGameData
 from lolapi.models import HistoricalMatch
 from lolapi.models import Region, Summoner, SummonerTierHistory
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 import lolapi.app_lib.datadragon_endpoints as d_endpoints
+from concurrent.futures import ThreadPoolExecutor
 import json
 import time
 import requests
@@ -68,20 +71,69 @@ def get_existing_summoner_or_none(riotapi, region, summoner_name):
     return api_summoner_dict
 
 
-def get_participant_summoners(riotapi, known_tiers, region, ongoing_match_dict):
+def request_participants_summoners_and_tiers(region_name, participants, riotapi, retries=None, max_workers=10,
+                                             retry_policy=None):
+    """
+        Request every participant's summoner and then its tiers, up to max_workers participants at once (each in a
+        thread of its own)
+        - returns [(api_summoner_dict, api_tiers_list), ..] in the order of participants
+        - the caller saves the results (in its own thread), but the threads' permits may still use the DB (e.g. the
+          PostgreSQL or MySQL request history), so each thread closes its Django DB connection when it's done
+        - at most min(max_workers, riotapi's concurrency limit) requests per method are in flight, the
+          AimdConcurrencyController starting at 4 per region+method and growing with healthy responses (up to 32)
+        - if any of them fails, every failed participant is reported and the first one's RiotApiError re-raised
+    """
+    def request_summoner_and_tiers(participant):
+        try:
+            api_summoner_dict = request_and_return_summoner(region_name, participant['summonerName'], riotapi,
+                                                            retries=retries, retry_policy=retry_policy)
+            api_tiers_list = request_and_return_summoner_tiers(region_name, api_summoner_dict['id'], riotapi,
+                                                               retries=retries, retry_policy=retry_policy)
+            return api_summoner_dict, api_tiers_list
+        finally:
+            # Django connections are per thread, and the executor's threads are gone after this call
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(participants)))) as executor:
+        futures = [executor.submit(request_summoner_and_tiers, p) for p in participants]
+    failures = [(p, f.exception()) for p, f in zip(participants, futures) if f.exception() is not None]
+    for p, err in failures:
+        print("Failed to load summoner or tiers of participant {} ({}): {}".format(
+            p['summonerName'],
+            region_name,
+            err.response.status_code if isinstance(err, RiotApiError) else repr(err)))
+    if len(failures) > 0:
+        raise failures[0][1]
+    return [f.result() for f in futures]
+
+
+def save_participant_summoners_and_match_tier(riotapi, known_tiers, region, ongoing_match_dict):
+    """
+        Request (and save) the participants' summoners and tiers, then calculate the average match tier
+        - returns (participant_summoners, teams_tiers, match_avg_tier)
+        - teams_tiers as {team_key: [{'champion_id': .., 'tier': ..}, ..], ..}
+    """
 
     # Get identities, tiers of the participants (20 requests)
     # then calculate the average match tier
     teams_tiers = {}
     participant_summoners = []
-    participants = []
+    # Permit the whole fan-out at once, instead of every request waiting for its own permit
+    num_participants = len(ongoing_match_dict['participants'])
+    riotapi.reserve_requests(region.name, {'get_summoner': num_participants, 'get_tiers': num_participants})
     # Gather all tiers in a dict {team_key: [tier_and_misc, ..], ..}
-    for p in ongoing_match_dict['participants']:
-        api_p_summoner_dict = request_and_return_summoner(region.name, p['summonerName'], riotapi, retries=2)
+    # Requested concurrently (as the concurrency limits allow) instead of one after another
+    try:
+        api_summoners_and_tiers = request_participants_summoners_and_tiers(region.name,
+                                                                           ongoing_match_dict['participants'],
+                                                                           riotapi,
+                                                                           retries=2)
+    finally:
+        # Permits the fan-out didn't use (e.g. of a summoner not found) go back to the rate limits right away
+        riotapi.release_reserved_requests()
+    for p, (api_p_summoner_dict, api_tiers_list) in zip(ongoing_match_dict['participants'], api_summoners_and_tiers):
         p_summoner = update_or_create_summoner(region, api_p_summoner_dict)
         participant_summoners.append(p_summoner)
-        participants.append(p)
-        api_tiers_list = request_and_return_summoner_tiers(region.name, p_summoner.summoner_id, riotapi, retries=2)
         participant_tier_milestone = update_summoner_tier_history(p_summoner, api_tiers_list)
         if p['teamId'] not in teams_tiers:
             teams_tiers[p['teamId']] = []
@@ -96,288 +148,135 @@ def get_participant_summoners(riotapi, known_tiers, region, ongoing_match_dict):
         print("Tiers of team {}: {}".format(team_key, ', '.join(map(lambda t: t['tier'], teams_tiers[team_key]))))
     print("Average tier for match is: {}".format(match_avg_tier))
 
-    return participant_summoners, participants
+    return participant_summoners, teams_tiers, match_avg_tier
 
 
-def request_and_return_summoner_tiers(region_name, summoner_id, riotapi, retries=0):
+def get_participant_summoners(riotapi, known_tiers, region, ongoing_match_dict):
+    participant_summoners, _, _ = save_participant_summoners_and_match_tier(riotapi, known_tiers, region,
+                                                                            ongoing_match_dict)
+    return participant_summoners, list(ongoing_match_dict['participants'])
+
+
+def request_and_return_summoner_tiers(region_name, summoner_id, riotapi, retries=None, retry_policy=None):
     """
-        If loading summoner tiers fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading summoner tiers fails, retry_policy (RetryPolicy by default) retries up to N times,
+        None leaving N to the policy's retry budget of the endpoint
         - if still no, we cannot really continue (unable to calculate match's avg tier) so re-raise the RiotApiError
     """
-    error_retries_done = 0
-    tries_permitted = 1 + retries
-    while error_retries_done < tries_permitted:
-        try:
-            api_tiers_list = riotapi.get_tiers(region_name, summoner_id).json()
-            return api_tiers_list
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load summoner tiers for summoner id #{} ({}) (HTTP Error {}) - retry in 1,2,..".format(
-                    summoner_id,
-                    region_name,
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-                if error_retries_done == tries_permitted:
-                    print("Retried the maximum {} times to load summoner tiers for summoner id #{} ({}).".format(
-                        retries,
-                        summoner_id,
-                        region_name
-                    ))
-                    raise RiotApiError(err.response) from None
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    return retry_policy.call(riotapi, 'get_tiers', region_name, summoner_id,
+                             retries=retries,
+                             description='summoner tiers for summoner id #{} ({})'.format(summoner_id,
+                                                                                          region_name)).json()
 
 
-def request_and_return_summoner(region_name, summoner_name, riotapi, retries=0):
+def request_and_return_summoner(region_name, summoner_name, riotapi, retries=None, retry_policy=None):
     """
-        If loading summoner fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading summoner fails, retry_policy (RetryPolicy by default) retries up to N times,
+        None leaving N to the policy's retry budget of the endpoint
         - if still no, we cannot really continue (not having the summoner data) so re-raise the RiotApiError
     """
-    error_retries_done = 0
-    tries_permitted = 1 + retries
-    while error_retries_done < tries_permitted:
-        try:
-            api_p_summoner_dict = riotapi.get_summoner(region_name, summoner_name).json()
-            return api_p_summoner_dict
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load summoner data for {} ({}) (HTTP Error {}) - retry in 1,2,..".format(
-                    summoner_name,
-                    region_name,
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-                if error_retries_done == tries_permitted:
-                    print("Retried the maximum {} times to load summoner data for {} ({}).".format(
-                        retries,
-                        summoner_name,
-                        region_name
-                    ))
-                    raise RiotApiError(err.response) from None
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    return retry_policy.call(riotapi, 'get_summoner', region_name, summoner_name,
+                             retries=retries,
+                             description='summoner data for {} ({})'.format(summoner_name, region_name)).json()
 
 
-def request_and_return_ongoing_match_or_none(riotapi, region, summoner, non_404_retries=0):
+def request_and_return_ongoing_match_or_none(riotapi, region, summoner, non_404_retries=None, retry_policy=None):
     """
-        If loading ongoing match fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
+        If loading ongoing match fails, retry_policy (RetryPolicy by default) retries up to N times,
+        None leaving N to the policy's retry budget of the endpoint
         - if http status code 404, return None
-        - else retry up to N times
         - if still no, exit gracefully (re-trying sometime later in next iteration) returning None
     """
-    error_retries_done = 0
-    tries_permitted = 1 + non_404_retries
-    while error_retries_done < tries_permitted:
-        try:
-            ongoing_match_dict = riotapi.get_active_match(region.name, summoner.summoner_id).json()
-            if 'gameQueueConfigId' not in ongoing_match_dict or ongoing_match_dict['gameQueueConfigId'] != 420:
-                print("Summoner '{}' is in different game/queue mode.".format(summoner.latest_name))
-                return None
-            return ongoing_match_dict
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            elif err.response.status_code == 404:
-                print("Summoner '{}' is not in active match.".format(summoner.latest_name))
-                return None
-            else:
-                print("Failed to load ongoing match data for summoner '{}' (HTTP Error {}) - retry in 1,2,..".format(
-                    summoner.latest_name,
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-    if error_retries_done == tries_permitted:
-        print("Retried maximum of {} times - Riot API still returning errors so skipping this summoner for now".format(
-            non_404_retries
-        ))
-
-
-def request_and_return_match_results(match_id, match_start_time, riotapi, platform_id, non_404_retries=0):
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    try:
+        ongoing_match_dict = retry_policy.call(riotapi, 'get_active_match', region.name, summoner.summoner_id,
+                                               retries=non_404_retries,
+                                               description="ongoing match data for summoner '{}'".format(
+                                                   summoner.latest_name),
+                                               passthrough_statuses=[404]).json()
+    except RetriesExhaustedError:
+        print("Riot API still returning errors so skipping this summoner for now")
+        return None
+    except RiotApiError as err:
+        if err.response.status_code != 404:
+            raise
+        print("Summoner '{}' is not in active match.".format(summoner.latest_name))
+        return None
+    if 'gameQueueConfigId' not in ongoing_match_dict or ongoing_match_dict['gameQueueConfigId'] != 420:
+        print("Summoner '{}' is in different game/queue mode.".format(summoner.latest_name))
+        return None
+    return ongoing_match_dict
+
+
+def request_and_return_match_results(match_id, match_start_time, riotapi, platform_id, non_404_retries=None,
+                                     retry_policy=None):
     """
-        If loading results fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading results fails, retry_policy (RetryPolicy by default) retries up to N times,
+        None leaving N to the policy's retry budget of the endpoint
+        - if http status code 404, the match is still going on, so wait another 5 minutes (not counted as a retry)
         - if still no, we cannot really continue (not knowing if match finished) so re-raise the RiotApiError
     """
-    error_retries_done = 0
-    tries_permitted = 1 + non_404_retries
-    while error_retries_done < tries_permitted:
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    while True:
         try:
-            match_result = riotapi.get_match_result(platform_id, match_id)
-            return match_result
+            return retry_policy.call(riotapi, 'get_match_result', platform_id, match_id,
+                                     retries=non_404_retries,
+                                     description='results for match {}'.format(match_id),
+                                     passthrough_statuses=[404])
         except RiotApiError as err:
-            if err.response.status_code == 404:
-                print("Match {} is still going on ({} minutes). Wait another 5 minutes".format(
-                    match_id,
-                    math.floor((time.time() * 1000 - match_start_time) / 1000 / 60)
-                ))
-                # Wait another 5 minutes
-                time.sleep(300)
-                continue  # This is permitted (and expected at least once) (404 error)
-            elif err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(
-                        err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load results for match {} (HTTP Error {}) - retry in 1,2,..".format(
-                    match_id,
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-                if error_retries_done == tries_permitted:
-                    print("Retried the maximum {} times to load results for match {}.".format(
-                        non_404_retries,
-                        match_id
-                    ))
-                    raise RiotApiError(err.response) from None
+            if err.response.status_code != 404:
+                raise
+            print("Match {} is still going on ({} minutes). Wait another 5 minutes".format(
+                match_id,
+                math.floor((time.time() * 1000 - match_start_time) / 1000 / 60)
+            ))
+            retry_policy.wait_hook(300)
 
 
-def request_and_link_timeline_to_match(match, riotapi, platform_id, retries=0):
+def request_and_link_timeline_to_match(match, riotapi, platform_id, retries=None, retry_policy=None):
     """
-        If loading timeline fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading timeline fails, retry_policy (RetryPolicy by default) retries up to N times,
+        None leaving N to the policy's retry budget of the endpoint
         - if still no, exit gracefully (leaving partial match data that can be filled later)
     """
-    error_retries_done = 0
-    tries_permitted = 1 + retries
-    while error_retries_done < tries_permitted:
-        try:
-            timeline_dict = riotapi.get_match_timeline(platform_id, match.match_id).json()
-            match.match_timeline_json = json.dumps(timeline_dict)
-            return timeline_dict
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load timeline for match {} (HTTP Error {}) - retry in 1,2,..".format(
-                    match.match_id,
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-    if error_retries_done == tries_permitted:
-        print("Retried maximum of {} times - Riot API still returning errors so skipping this timeline for now".format(
-            retries
-        ))
-
-
-def request_history(game_start_time, summoner, champion_id, summonerspells, reallane, riotapi, region, retries=0):
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    try:
+        timeline_dict = retry_policy.call(riotapi, 'get_match_timeline', platform_id, match.match_id,
+                                          retries=retries,
+                                          description='timeline for match {}'.format(match.match_id)).json()
+    except RetriesExhaustedError:
+        print("Riot API still returning errors so skipping this timeline for now")
+        return None
+    match.match_timeline_json = json.dumps(timeline_dict)
+    return timeline_dict
+
+
+def request_history(game_start_time, summoner, champion_id, summonerspells, reallane, riotapi, region, retries=None,
+                    retry_policy=None):
     """
-        If loading histories fails:
-        - IF HTTP STATUS CODE 429 [ = rate-limiting ] and not Service-429 => something wrong with rate-limiting so exit
-        - else retry up to N times
+        If loading histories fails, retry_policy (RetryPolicy by default) retries (the whole history) up to N times,
+        None leaving N to the policy's default_retries
         - if still no, exit gracefully (leaving partial match data that can be filled later)
     """
     # Fix an API error with "just-started" games
     if not int(game_start_time):
         game_start_time = time.time()*1000
-    error_retries_done = 0
-    tries_permitted = 1 + retries
-    while error_retries_done < tries_permitted:
-        try:
-            p_history = get_stats_history(summoner.account_id,
-                                          champion_id,
-                                          reallane,
-                                          summonerspells,
-                                          game_start_time,
-                                          riotapi, region,
-                                          max_weeks_lookback=3, max_games_lookback=40)
-            return p_history
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                # https://developer.riotgames.com/rate-limiting.html
-                if 'X-Rate-Limit-Type' not in err.response.headers:
-                    time.sleep(5)
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # if a service rate limit error, wait the time returned in header, and retry without counting it
-                if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                    time.sleep(int(err.response.headers['Retry-After']))
-                    continue  # Try again (without counting this as a retry because it is the service being crowded)
-                # else it is application or method rate limit error, something badly wrong in our rate limiting
-                else:
-                    print("Really bad. Received {} rate limit error".format(err.response.headers['X-Rate-Limit-Type']))
-                    raise RiotApiError(err.response) from None
-            else:
-                print("Failed to load a historical match (HTTP Error {}) - retry in 1,2,..".format(
-                    err.response.status_code))
-                # One, two
-                time.sleep(2)
-                error_retries_done += 1
-    if error_retries_done == tries_permitted:
-        print("Retried maximum of {} times - Riot API still returning errors so skipping this history for now".format(
-            retries
-        ))
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    try:
+        return retry_policy.run(lambda: get_stats_history(summoner.account_id,
+                                                          champion_id,
+                                                          reallane,
+                                                          summonerspells,
+                                                          game_start_time,
+                                                          riotapi, region,
+                                                          max_weeks_lookback=3, max_games_lookback=40),
+                                retries=retries,
+                                description='a historical match')
+    except RetriesExhaustedError:
+        print("Riot API still returning errors so skipping this history for now")
+        return None
 
 
 def update_or_create_summoner(region, api_summoner_dict):
@@ -733,13 +632,52 @@ def parse_participant_postgame_stats(participant_data, extraction_rules):
     return participant_postgame_stats
 
 
+def get_missing_match_data(region, match_refs, riotapi=None):
+    """{match-id: (result-missing, timeline-missing), ..} of a matchlist's matches, i.e. what has to be requested
+
+       With riotapi, a result or timeline its response cache serves doesn't count as missing (takes no permit).
+    """
+    stored_matches = HistoricalMatch.objects.filter(match_id__in=[m_ref['gameId'] for m_ref in match_refs],
+                                                    region=region)
+    stored_results = set(m.match_id for m in stored_matches if m.match_result_json is not None)
+    stored_timelines = set(m.match_id for m in stored_matches if m.match_timeline_json is not None)
+    missing_match_data = {}
+    for m_ref in match_refs:
+        result_missing = m_ref['gameId'] not in stored_results
+        timeline_missing = m_ref['gameId'] not in stored_timelines
+        if riotapi is not None:
+            result_missing = result_missing and not riotapi.is_cached(m_ref['platformId'], 'get_match_result',
+                                                                      m_ref['gameId'])
+            timeline_missing = timeline_missing and not riotapi.is_cached(m_ref['platformId'], 'get_match_timeline',
+                                                                          m_ref['gameId'])
+        missing_match_data[m_ref['gameId']] = (result_missing, timeline_missing)
+    return missing_match_data
+
+
+def reserve_match_results_and_timelines(riotapi, region, match_refs, missing_match_data=None):
+    """Permit the results and timelines (missing from DB and response cache) of a matchlist at once,
+       instead of one request at a time; missing_match_data as of get_missing_match_data if the caller has it already
+    """
+    if missing_match_data is None:
+        missing_match_data = get_missing_match_data(region, match_refs, riotapi)
+    missing_match_data = [missing_match_data[m_ref['gameId']] for m_ref in match_refs]
+    riotapi.reserve_requests(region.name, {
+        'get_match_result': len([1 for result_missing, _ in missing_match_data if result_missing]),
+        'get_match_timeline': len([1 for _, timeline_missing in missing_match_data if timeline_missing])
+    })
+
+
 def get_stats_history(account_id, reallane,
                       match_time, riotapi, region, items_dictionaries,
-                      max_weeks_lookback, max_games_lookback):
+                      max_weeks_lookback, max_games_lookback, request_budget=None):
     """
         TL-DR: on average a LoL-player has a total <<38 .. 76>> past games (in 3 week span)
                of which <<6 .. 46>> belong to the current role
                while (of the total) <<2 .. 20>> on the current champion
+
+        With a request_budget the lookback is as deep as the budget, scaled by the current headroom of the
+        matchlist and match limits, allows; shallow at peak hours and full depth when the quota is idle.
+        The depth actually used is in lookback_weeks, lookback_games and lookback_budget_limited.
     """
 
     # Whether the current reallane is (1.) primary lane, (2.) secondary lane, or the result of autofill
@@ -847,122 +785,165 @@ def get_stats_history(account_id, reallane,
     postgame_stats_in_current_lane = {statname: [] for statname in participant_postgame_extraction_rules.keys()}
     games_with_fighting = []
 
+    # Requests (matchlists, results and timelines missing from DB) the history may still spend, None if unlimited
+    requests_left = None
+    if request_budget is not None:
+        requests_left = int(request_budget * max(0.0, riotapi.get_headroom(region.name,
+                                                                           ['get_matchlist', 'get_match_result'])))
+    lookback_weeks = 0
+    lookback_budget_limited = False
+
     week_in_ms = 7*24*60*60*1000
-    for week_i in range(max_weeks_lookback):
-        end_time = match_time - 1000 - (week_i * week_in_ms)  # Offset by 1s
-        start_time = end_time - week_in_ms
-        try:
-            week_matchlist = riotapi.get_matchlist(region.name,
-                                                   account_id,
-                                                   end_time=end_time,
-                                                   begin_time=start_time)
-            for m_ref in week_matchlist.json()['matches']:
-                num_games += 1
-                if num_games <= max_games_lookback:
-                    # Fetch match (and any missing result or timeline) if does not already exist
-                    try:
-                        m_obj = HistoricalMatch.objects.get(match_id=m_ref['gameId'], region=region)
-                        if m_obj.match_result_json is not None:
-                            result_dict = json.loads(m_obj.match_result_json)
-                        else:
-                            result_dict = riotapi.get_match_result(m_ref['platformId'], m_ref['gameId']).json()
-                            m_obj.game_version = get_or_create_game_version(result_dict)
-                            m_obj.game_duration = result_dict['gameDuration']
-                            m_obj.match_result_json = json.dumps(result_dict)
-                            m_obj.save()
-                        if m_obj.match_timeline_json is not None:
-                            timeline_dict = json.loads(m_obj.match_timeline_json)
-                        else:
-                            timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi, m_ref['platformId'], retries=2)
-                            m_obj.save()
-                    except ObjectDoesNotExist:
+    # Reserved permits the weeks leave unused go back to the rate limits however the lookback ends (e.g. a 429)
+    try:
+        for week_i in range(max_weeks_lookback):
+            if requests_left is not None and (lookback_budget_limited or requests_left < 1):
+                lookback_budget_limited = True
+                break
+            lookback_weeks += 1
+            end_time = match_time - 1000 - (week_i * week_in_ms)  # Offset by 1s
+            start_time = end_time - week_in_ms
+            try:
+                if requests_left is not None:
+                    requests_left -= 1
+                week_matchlist = riotapi.get_matchlist(region.name,
+                                                       account_id,
+                                                       end_time=end_time,
+                                                       begin_time=start_time)
+                week_match_refs = week_matchlist.json()['matches']
+                num_games_left = max(0, max_games_lookback - num_games)
+                week_match_refs_to_fetch = week_match_refs[:num_games_left]
+                # Within a budget, only the games whose missing result and timeline it still covers
+                num_affordable_games = None
+                missing_match_data = None
+                if requests_left is not None:
+                    missing_match_data = get_missing_match_data(region, week_match_refs_to_fetch, riotapi)
+                    num_affordable_games = 0
+                    for m_ref in week_match_refs_to_fetch:
+                        num_requests_needed = sum(missing_match_data[m_ref['gameId']])
+                        if num_requests_needed > requests_left:
+                            lookback_budget_limited = True
+                            break
+                        requests_left -= num_requests_needed
+                        num_affordable_games += 1
+                    week_match_refs_to_fetch = week_match_refs_to_fetch[:num_affordable_games]
+                # Whatever the previous week left unused (e.g. remakes, a request that failed) goes back first
+                riotapi.release_reserved_requests()
+                reserve_match_results_and_timelines(riotapi, region, week_match_refs_to_fetch, missing_match_data)
+                for m_idx, m_ref in enumerate(week_match_refs):
+                    num_games += 1
+                    if num_games <= max_games_lookback and (num_affordable_games is None
+                                                            or m_idx < num_affordable_games):
+                        # Fetch match (and any missing result or timeline) if does not already exist
                         try:
-                            m_obj = HistoricalMatch(
-                                match_id=m_ref['gameId'],
-                                region=region
-                            )
-                            result_dict = riotapi.get_match_result(m_ref['platformId'], m_ref['gameId']).json()
-                            m_obj.game_version = get_or_create_game_version(result_dict)
-                            m_obj.game_duration = result_dict['gameDuration']
-                            m_obj.match_result_json = json.dumps(result_dict)
-                            timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi, m_ref['platformId'], retries=2)
-                            m_obj.save()
-                        except IntegrityError:
-                            # If match was created by another process, fetch it
                             m_obj = HistoricalMatch.objects.get(match_id=m_ref['gameId'], region=region)
                             if m_obj.match_result_json is not None:
                                 result_dict = json.loads(m_obj.match_result_json)
                             else:
                                 result_dict = riotapi.get_match_result(m_ref['platformId'], m_ref['gameId']).json()
+                                m_obj.game_version = get_or_create_game_version(result_dict)
+                                m_obj.game_duration = result_dict['gameDuration']
+                                m_obj.match_result_json = json.dumps(result_dict)
+                                m_obj.save()
                             if m_obj.match_timeline_json is not None:
                                 timeline_dict = json.loads(m_obj.match_timeline_json)
                             else:
-                                timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi, m_ref['platformId'], retries=2)
-
-                    # Check if it is remake
-                    if result_dict['gameDuration'] < 300:
-                        num_games -= 1
-                        continue
-
-                    # Lookup lane
-                    champion_then = m_ref['champion']
-                    lane_then = create_champion_lane_mapping(result_dict, timeline_dict)[champion_then]
-                    if lane_then == reallane:
-                        num_games_in_current_lane += 1
-                    lanes[lane_then] += 1
-
-                    # Ensure we have items_dictionary from static data or (preferably) cached in memory
-                    historical_game_version = get_or_create_game_version(result_dict)
-                    if historical_game_version.semver not in items_dictionaries:
-                        # May throw ObjectDoesNotExist, in which case it bubbles up to previous function
-                        static_data = StaticGameData.objects.get(game_version=historical_game_version)
-                        items_dictionaries[historical_game_version.semver] = json.loads(static_data.items_data_json)
-
-                    # Historically account ID may be different and UN-OBTAINABLE (pls riot) so we'll rely on champ
-                    p_data = next(filter(lambda p: p['championId'] == champion_then, result_dict['participants']))
-
-                    # Parse fight data
-                    participated_fights = parse_fights_one_game(result_dict,
-                                                                timeline_dict,
-                                                                items_dictionaries[historical_game_version.semver],
-                                                                p_data['participantId'])
-                    games_with_fighting.append(participated_fights)
-
-                    # Parse post-game aggregate data for both all-games and current-lane-games
-                    postgame_stats = parse_participant_postgame_stats(p_data, participant_postgame_extraction_rules)
-                    for statname, statvalue in postgame_stats.items():
-                        postgame_stats_total[statname].append(statvalue)
-                    if lane_then == reallane:
+                                timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi, m_ref['platformId'],
+                                                                                   retries=2)
+                                m_obj.save()
+                        except ObjectDoesNotExist:
+                            try:
+                                m_obj = HistoricalMatch(
+                                    match_id=m_ref['gameId'],
+                                    region=region
+                                )
+                                result_dict = riotapi.get_match_result(m_ref['platformId'], m_ref['gameId']).json()
+                                m_obj.game_version = get_or_create_game_version(result_dict)
+                                m_obj.game_duration = result_dict['gameDuration']
+                                m_obj.match_result_json = json.dumps(result_dict)
+                                timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi, m_ref['platformId'],
+                                                                                   retries=2)
+                                m_obj.save()
+                            except IntegrityError:
+                                # If match was created by another process, fetch it
+                                m_obj = HistoricalMatch.objects.get(match_id=m_ref['gameId'], region=region)
+                                if m_obj.match_result_json is not None:
+                                    result_dict = json.loads(m_obj.match_result_json)
+                                else:
+                                    result_dict = riotapi.get_match_result(m_ref['platformId'], m_ref['gameId']).json()
+                                if m_obj.match_timeline_json is not None:
+                                    timeline_dict = json.loads(m_obj.match_timeline_json)
+                                else:
+                                    timeline_dict = request_and_link_timeline_to_match(m_obj, riotapi,
+                                                                                       m_ref['platformId'], retries=2)
+
+                        # Check if it is remake
+                        if result_dict['gameDuration'] < 300:
+                            num_games -= 1
+                            continue
+
+                        # Lookup lane
+                        champion_then = m_ref['champion']
+                        lane_then = create_champion_lane_mapping(result_dict, timeline_dict)[champion_then]
+                        if lane_then == reallane:
+                            num_games_in_current_lane += 1
+                        lanes[lane_then] += 1
+
+                        # Ensure we have items_dictionary from static data or (preferably) cached in memory
+                        historical_game_version = get_or_create_game_version(result_dict)
+                        if historical_game_version.semver not in items_dictionaries:
+                            # May throw ObjectDoesNotExist, in which case it bubbles up to previous function
+                            static_data = StaticGameData.objects.get(game_version=historical_game_version)
+                            items_dictionaries[historical_game_version.semver] = json.loads(static_data.items_data_json)
+
+                        # Historically account ID may be different and UN-OBTAINABLE (pls riot) so we'll rely on champ
+                        p_data = next(filter(lambda p: p['championId'] == champion_then, result_dict['participants']))
+
+                        # Parse fight data
+                        participated_fights = parse_fights_one_game(result_dict,
+                                                                    timeline_dict,
+                                                                    items_dictionaries[historical_game_version.semver],
+                                                                    p_data['participantId'])
+                        games_with_fighting.append(participated_fights)
+
+                        # Parse post-game aggregate data for both all-games and current-lane-games
+                        postgame_stats = parse_participant_postgame_stats(p_data, participant_postgame_extraction_rules)
                         for statname, statvalue in postgame_stats.items():
-                            postgame_stats_in_current_lane[statname].append(statvalue)
-
-                    # Draw conclusions based on win/loss
-                    victory = p_data['stats']['win']
-                    if previous_game_won == 0:
-                        previous_game_won = 1 if victory else -1
-                    if winning is None:
-                        winning = victory
-                    elif winning:
-                        if victory:
-                            consecutive_wins += 1
-                        else:
-                            winning = False
-                            consecutive_wins = 0  # Reset
-                    else:
-                        if not victory:
-                            consecutive_losses += 1
+                            postgame_stats_total[statname].append(statvalue)
+                        if lane_then == reallane:
+                            for statname, statvalue in postgame_stats.items():
+                                postgame_stats_in_current_lane[statname].append(statvalue)
+
+                        # Draw conclusions based on win/loss
+                        victory = p_data['stats']['win']
+                        if previous_game_won == 0:
+                            previous_game_won = 1 if victory else -1
+                        if winning is None:
+                            winning = victory
+                        elif winning:
+                            if victory:
+                                consecutive_wins += 1
+                            else:
+                                winning = False
+                                consecutive_wins = 0  # Reset
                         else:
-                            winning = True
-                            consecutive_losses = 0  # Reset
+                            if not victory:
+                                consecutive_losses += 1
+                            else:
+                                winning = True
+                                consecutive_losses = 0  # Reset
 
-        except RiotApiError as err:
-            if err.response.status_code == 429:
-                raise RiotApiError(err.response) from None
-            elif err.response.status_code == 404:
-                continue  # No matches found {week_i} weeks in past, keep checking since the timeframe is explicit
-            else:
-                print('Unexpected HTTP {} error when querying match history ({})'.format(err.response.status_code,
-                                                                                         err.response.url.split('?')[0]))
+            except RiotApiError as err:
+                if err.response.status_code == 429:
+                    raise RiotApiError(err.response) from None
+                elif err.response.status_code == 404:
+                    continue  # No matches found {week_i} weeks in past, keep checking since the timeframe is explicit
+                else:
+                    print('Unexpected HTTP {} error when querying match history ({})'.format(
+                        err.response.status_code,
+                        err.response.url.split('?')[0]))
+    finally:
+        riotapi.release_reserved_requests()
     primary_lane = max(lanes.keys(), key=lambda lane_name: lanes[lane_name])
     secondary_lane = max((l for l in lanes.keys() if l != primary_lane), key=lambda lane_name: lanes[lane_name])
     aggressiveness_and_judgment = calc_participant_aggressiveness_and_judgment(games_with_fighting)
@@ -979,6 +960,9 @@ def get_stats_history(account_id, reallane,
         'previous_game_won': previous_game_won,
         'consecutive_wins': consecutive_wins,
         'consecutive_losses': consecutive_losses,
+        'lookback_weeks': lookback_weeks,
+        'lookback_games': len(games_with_fighting),
+        'lookback_budget_limited': lookback_budget_limited,
     }
     for statname, stat_aggregate in postgame_stats_total.items():
         history['total_{}'.format(statname)] = sum(stat_aggregate) / len(stat_aggregate) if len(stat_aggregate) > 0 else 0
@@ -0,0 +1,47 @@
+from django.test import SimpleTestCase
+from unittest import mock
+import json
+import os
+
+import active_data_gathering
+
+
+class RequestAndLinkHistoriesToMatchTests(SimpleTestCase):
+    """python manage.py test lolapi (from dj_lol_dcs)"""
+
+    @staticmethod
+    def get_match():
+        match = mock.Mock()
+        match.match_result_json = json.dumps({
+            'gameCreation': 1500000000000,
+            'participantIdentities': [
+                {'participantId': p_id, 'player': {'currentAccountId': 1000 + p_id}} for
+                p_id in
+                range(1, 11)
+            ],
+            'participants': [
+                {'participantId': p_id, 'championId': 100 + p_id, 'spell1Id': 4, 'spell2Id': 14} for
+                p_id in
+                range(1, 11)
+            ]
+        })
+        match.match_timeline_json = json.dumps({'frames': []})
+        return match
+
+    @mock.patch.dict(os.environ, {'HISTORY_REQUEST_BUDGET_PER_MATCH': '300'})
+    @mock.patch('active_data_gathering.create_champion_lane_mapping')
+    @mock.patch('active_data_gathering.get_stats_history', autospec=True)
+    def test_request_budget_is_split_per_participant(self, get_stats_history, create_champion_lane_mapping):
+        create_champion_lane_mapping.return_value = {100 + p_id: 'MID' for p_id in range(1, 11)}
+        get_stats_history.return_value = {'num_games': 0}
+        match = self.get_match()
+        riotapi = mock.Mock()
+        region = mock.Mock()
+
+        active_data_gathering.request_and_link_histories_to_match(match, riotapi, region, {})
+
+        self.assertEqual(get_stats_history.call_count, 10)
+        get_stats_history.assert_any_call(1001, 'MID', 1500000000000, riotapi, region, {},
+                                          max_weeks_lookback=3, max_games_lookback=40, request_budget=30.0)
+        self.assertEqual(json.loads(match.match_participants_histories_json),
+                         {str(100 + p_id): {'num_games': 0} for p_id in range(1, 11)})
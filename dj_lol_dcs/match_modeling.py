@@ -4,17 +4,14 @@ import sys
 import json
 import argparse
 
-import lolapi.app_lib.riotapi_endpoints as riotapi_endpoints
-from lolapi.app_lib.regional_riotapi_hosts import RegionalRiotapiHosts
-from lolapi.app_lib.riot_api import RiotApi
-from lolapi.app_lib.api_key_container import ApiKeyContainer, MethodRateLimits
+from lolapi.app_lib.riot_api_factory import build_riot_api_from_env
 from lolapi.app_lib.exceptions import RiotApiError, ConfigurationError, RatelimitMismatchError, MatchTakenError
 
 import django
 os.environ['DJANGO_SETTINGS_MODULE'] = 'dj_lol_dcs.settings'
 django.setup()
 from lolapi.app_lib.enumerations import Tiers
-from lolapi.app_lib.mysql_requesthistory_checking import MysqlRequestHistory
+from lolapi.app_lib.request_priorities import RequestPriorities
 from lolapi.app_lib.utils import get_or_create_game_version, get_or_create_region, get_existing_summoner_or_none
 from lolapi.app_lib.utils import update_or_create_summoner, update_summoner_tier_history, request_and_return_match_results
 from lolapi.app_lib.utils import request_and_link_timeline_to_match, request_and_return_ongoing_match_or_none
@@ -196,55 +193,11 @@ def parse_stats_one_game(result, timeline, participant_id):
 
 def main(args):
     ratelimit_logfile_location = './{}'.format(args.ratelimit_logfile_location) if args.ratelimit_logfile_location else None
-    api_key = os.environ['RIOT_API_KEY']
-    app_rate_limits = json.loads(os.environ['RIOT_APP_RATE_LIMITS_JSON'])  # [[num-requests, within-seconds], ..]
-    method_rate_limits = {
-        '/lol/summoner/v3/summoners/by-name/{summonerName}': {
-            'EUW': [[2000, 60]],
-            'KR': [[2000, 60]],
-            'NA': [[2000, 60]],
-            'EUNE': [[1600, 60]],
-            'BR': [[1300, 60]],
-            'TR': [[1300, 60]],
-            'LAN': [[1000, 60]],
-            'LAS': [[1000, 60]],
-            'JP': [[800, 60]],
-            'OCE': [[800, 60]],
-            'RU': [[600, 60]]
-        },
-        'leagues-v3 endpoints': {
-            'EUW': [[300, 60]],
-            'NA': [[270, 60]],
-            'EUNE': [[165, 60]],
-            'BR': [[90, 60]],
-            'KR': [[90, 60]],
-            'LAN': [[80, 60]],
-            'LAS': [[80, 60]],
-            'TR': [[60, 60]],
-            'OCE': [[55, 60]],
-            'JP': [[35, 60]],
-            'RU': [[35, 60]]
-        },
-        '/lol/match/v3/matchlists/by-account/{accountId}': [[1000, 10]],
-        '/lol/match/v3/[matches,timelines]': [[500, 10]],
-        'All other endpoints': [[20000, 10]]
-    }
 
     # API init
     tiers = Tiers()
-    riotapi = RiotApi(
-        ApiKeyContainer(
-            api_key,
-            app_rate_limits,
-            MethodRateLimits(method_rate_limits)),
-        MysqlRequestHistory(
-            os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
-            os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
-            os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
-            ratelimit_logfile_location
-        ),
-        RegionalRiotapiHosts(),
-        riotapi_endpoints)
+    # Key pool, rate limiter backend and response cache as configured by the environment (see README)
+    riotapi = build_riot_api_from_env(ratelimit_logfile_location, priority=RequestPriorities.HISTORY)
 
     region = get_or_create_region(args.target_region)
     api_summoner_dict = get_existing_summoner_or_none(riotapi, region, args.target_name)
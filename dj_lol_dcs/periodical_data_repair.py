@@ -4,12 +4,14 @@ import requests
 import json
 import time
 
-import lolapi.app_lib.riotapi_endpoints as riotapi_endpoints
 import lolapi.app_lib.datadragon_endpoints as d_endpoints
 from lolapi.app_lib.regional_riotapi_hosts import RegionalRiotapiHosts
 from lolapi.app_lib.riot_api import RiotApi
-from lolapi.app_lib.api_key_container import ApiKeyContainer, MethodRateLimits
-from lolapi.app_lib.exceptions import RiotApiError, ConfigurationError, RatelimitMismatchError, MatchTakenError
+from lolapi.app_lib.riot_api_factory import build_riot_api_from_env, build_api_key_pool_from_env
+from lolapi.app_lib.riot_api_factory import build_request_priorities_from_env, build_response_cache_from_env
+from lolapi.app_lib.exceptions import ConfigurationError, RatelimitMismatchError, MatchTakenError
+from lolapi.app_lib.exceptions import RetriesExhaustedError
+from lolapi.app_lib.retry_policy import RetryPolicy
 
 import django
 os.environ['DJANGO_SETTINGS_MODULE'] = 'dj_lol_dcs.settings'
@@ -17,9 +19,10 @@ django.setup()
 from lolapi.models import GameVersion, StaticGameData
 from lolapi.models import Region
 from lolapi.models import HistoricalMatch
-from lolapi.app_lib.mysql_requesthistory_checking import MysqlRequestHistory
+from lolapi.app_lib.request_priorities import RequestPriorities
+from lolapi.app_lib.quota_planner import QuotaPlanner
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 
 from sqlalchemy import create_engine
 import pandas as pd
@@ -108,6 +111,75 @@ def get_incomplete_records(region_name, semver):
         return incomplete_matches_df
 
 
+def count_cached_match_data(incomplete_matches_df, platform_name, response_cache):
+    """(num-results, num-timelines) of the incomplete records' missing ones the response cache has already"""
+    if response_cache is None:
+        return 0, 0
+    num_cached_results = 0
+    num_cached_timelines = 0
+    for row in incomplete_matches_df.itertuples(index=False):
+        if row.result_missing and response_cache.contains(platform_name, 'get_match_result', row.match_id):
+            num_cached_results += 1
+        if row.timeline_missing and response_cache.contains(platform_name, 'get_match_timeline', row.match_id):
+            num_cached_timelines += 1
+    return num_cached_results, num_cached_timelines
+
+
+def estimate_repair_requests(incomplete_matches_df, max_weeks_lookback, max_games_lookback, cache_hit_rate,
+                             games_per_week=19, num_cached_results=0, num_cached_timelines=0):
+    """{method: num-requests, ..} repairing the incomplete records will need
+
+       A missing result or timeline is one request (none if the response cache has it, num_cached_*), a missing
+       history is a matchlist per week and a result and timeline per game (up to max_games_lookback, ~19 games a
+       week on average) for each of the 10 participants, of which the games already stored locally
+       (cache_hit_rate, an assumption since the games aren't known before their matchlists) need no requests.
+    """
+    matches_and_timelines = RiotApi.ENDPOINT_METHODS['get_match_result']
+    matchlists = RiotApi.ENDPOINT_METHODS['get_matchlist']
+    num_missing_results = int(incomplete_matches_df['result_missing'].sum()) - num_cached_results
+    num_missing_timelines = int(incomplete_matches_df['timeline_missing'].sum()) - num_cached_timelines
+    num_missing_histories = int(incomplete_matches_df['history_missing'].sum())
+    num_history_games = min(max_games_lookback, max_weeks_lookback * games_per_week)
+    return {
+        matches_and_timelines: int(num_missing_results + num_missing_timelines
+                                   + num_missing_histories * 10 * num_history_games * 2 * (1 - cache_hit_rate)),
+        matchlists: num_missing_histories * 10 * max_weeks_lookback
+    }
+
+
+def print_repair_plan(incomplete_matches_df, region_name, platform_name, api_key_pool, request_priorities,
+                      max_weeks_lookback, max_games_lookback, cache_hit_rate, seconds_per_request):
+    # Measured for the incomplete records themselves, the history games' hit rate is only assumed (--cache-hit-rate)
+    num_cached_results, num_cached_timelines = count_cached_match_data(incomplete_matches_df, platform_name,
+                                                                       build_response_cache_from_env())
+    num_requests_per_method = estimate_repair_requests(incomplete_matches_df, max_weeks_lookback, max_games_lookback,
+                                                       cache_hit_rate,
+                                                       num_cached_results=num_cached_results,
+                                                       num_cached_timelines=num_cached_timelines)
+    # Requests are made one after another, so even without rate limits each one takes a round trip
+    planner = QuotaPlanner(api_key_pool, request_priorities, seconds_per_request=seconds_per_request)
+    seconds, limit_estimates = planner.plan(region_name, num_requests_per_method, RequestPriorities.REPAIR)
+    print('{} incomplete games in {} ({} results and {} timelines of them in the response cache)'.format(
+        len(incomplete_matches_df),
+        region_name,
+        num_cached_results,
+        num_cached_timelines))
+    print('{} requests, ~{:.1f} hours, if {:.0%} of the history games are stored already (--cache-hit-rate) '
+          'and a request takes {}s (--seconds-per-request)'.format(
+              sum(num_requests_per_method.values()),
+              seconds / 3600,
+              cache_hit_rate,
+              seconds_per_request))
+    for limit_seconds, method, max_requests, timeframe_size, num_requests in limit_estimates:
+        print('{:>8} requests against {} [{}, {}] => {:.1f} hours ({:.0%} of the time saturated)'.format(
+            num_requests,
+            method if method is not None else 'App ratelimit',
+            max_requests,
+            timeframe_size,
+            limit_seconds / 3600,
+            limit_seconds / seconds if seconds > 0 else 0))
+
+
 def update_and_get_versions():
     known_game_versions = list(GameVersion.objects.all())
     fresh_game_versions = requests.get(d_endpoints.VERSIONS).json()
@@ -275,62 +347,46 @@ def parse_fights_one_game(result, timeline, items_dictionary, participant_id):
 
 def main(args):
     ratelimit_logfile_location = './{}'.format(args.logfile) if args.logfile else None
-    api_key = os.environ['RIOT_API_KEY']
-    app_rate_limits = json.loads(os.environ['RIOT_APP_RATE_LIMITS_JSON'])  # [[num-requests, within-seconds], ..]
-    method_rate_limits = {
-        '/lol/summoner/v3/summoners/by-name/{summonerName}': {
-            'EUW': [[2000, 60]],
-            'KR': [[2000, 60]],
-            'NA': [[2000, 60]],
-            'EUNE': [[1600, 60]],
-            'BR': [[1300, 60]],
-            'TR': [[1300, 60]],
-            'LAN': [[1000, 60]],
-            'LAS': [[1000, 60]],
-            'JP': [[800, 60]],
-            'OCE': [[800, 60]],
-            'RU': [[600, 60]]
-        },
-        'leagues-v3 endpoints': {
-            'EUW': [[300, 60]],
-            'NA': [[270, 60]],
-            'EUNE': [[165, 60]],
-            'BR': [[90, 60]],
-            'KR': [[90, 60]],
-            'LAN': [[80, 60]],
-            'LAS': [[80, 60]],
-            'TR': [[60, 60]],
-            'OCE': [[55, 60]],
-            'JP': [[35, 60]],
-            'RU': [[35, 60]]
-        },
-        '/lol/match/v3/matchlists/by-account/{accountId}': [[1000, 10]],
-        '/lol/match/v3/[matches,timelines]': [[500, 10]],
-        'All other endpoints': [[20000, 10]]
-    }
 
     # API init
     riotapi_hosts = RegionalRiotapiHosts()
-    riotapi = RiotApi(
-        ApiKeyContainer(
-            api_key,
-            app_rate_limits,
-            MethodRateLimits(method_rate_limits)),
-        MysqlRequestHistory(
-            os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
-            os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
-            os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
-            ratelimit_logfile_location
-        ),
-        riotapi_hosts,
-        riotapi_endpoints)
-
-    game_versions = update_and_get_versions()
-    items_dictionaries = {}
+    # Key pool (and priority shares) as configured by the environment, needed by the plan already
+    request_priorities = build_request_priorities_from_env()
+    api_key_pool = build_api_key_pool_from_env()
 
     # Get "incomplete" records as per arguments
     incomplete_matches_df = get_incomplete_records(args.region_name, args.semver)
     region = Region.objects.get(name=args.region_name)
+    max_weeks_lookback = 3
+    max_games_lookback = 50
+
+    if args.dry_run:
+        print_repair_plan(incomplete_matches_df, args.region_name,
+                          riotapi_hosts.get_platform_by_region(args.region_name),
+                          api_key_pool, request_priorities, max_weeks_lookback, max_games_lookback, args.cache_hit_rate,
+                          args.seconds_per_request)
+        return
+
+    # Rate limiter backend and response cache as configured by the environment (see README)
+    riotapi = build_riot_api_from_env(ratelimit_logfile_location,
+                                      priority=RequestPriorities.REPAIR,
+                                      api_hosts=riotapi_hosts,
+                                      api_key_pool=api_key_pool,
+                                      request_priorities=request_priorities)
+
+    def wait_for_retry(wait_seconds):
+        # While backing off, the permits reserved for a history's matches but not used yet go back to the limiter
+        # (for other scripts' requests), and the DB connection isn't held idle; Django re-opens it on the next query
+        riotapi.release_reserved_requests()
+        if not connection.in_atomic_block:
+            connection.close()
+        time.sleep(wait_seconds)
+
+    # Every repair is picked up again on the next run, so one retry (after backing off) is enough
+    retry_policy = RetryPolicy(default_retries=1, wait_hook=wait_for_retry)
+
+    game_versions = update_and_get_versions()
+    items_dictionaries = {}
 
     # Start repairing
     for row in incomplete_matches_df.itertuples(index=False):
@@ -340,147 +396,66 @@ def main(args):
 
         # Fix if timeline is missing, standalone
         if getattr(row, 'timeline_missing'):
-            error_retries_done = 0
-            tries_permitted = 2
-            while error_retries_done < tries_permitted:
-                try:
-                    timeline_dict = riotapi.get_match_timeline(
-                        riotapi_hosts.get_platform_by_region(match_object.region.name),
-                        match_object.match_id
-                    ).json()
-                    match_object.match_timeline_json = json.dumps(timeline_dict)
-                    match_object.save()
-                    print('Recovered match#{} timeline'.format(match_object.match_id))
-                    break
-                except RiotApiError as err:
-                    if err.response.status_code == 429:
-                        # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                        # https://developer.riotgames.com/rate-limiting.html
-                        if 'X-Rate-Limit-Type' not in err.response.headers:
-                            time.sleep(5)
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # if a service rate limit error, wait the time returned in header, and retry without counting it
-                        if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                            time.sleep(int(err.response.headers['Retry-After']))
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # else it is application or method rate limit error, something badly wrong in our rate limiting
-                        else:
-                            print("Really bad. Received {} rate limit error".format(
-                                err.response.headers['X-Rate-Limit-Type']))
-                            raise RiotApiError(err.response) from None
-                    else:
-                        print("Failed to load timeline for match {} (HTTP Error {}) - retry in 1,2,..".format(
-                            match_object.match_id,
-                            err.response.status_code))
-                        # One, two
-                        time.sleep(2)
-                        error_retries_done += 1
-            if error_retries_done == tries_permitted:
-                print(
-                    "Retried maximum of {} times - Riot API still returning errors, skipping this timeline".format(
-                        tries_permitted
-                    ))
+            try:
+                timeline_dict = retry_policy.call(riotapi, 'get_match_timeline',
+                                                  riotapi_hosts.get_platform_by_region(match_object.region.name),
+                                                  match_object.match_id,
+                                                  description='timeline for match {}'.format(match_object.match_id)
+                                                  ).json()
+                match_object.match_timeline_json = json.dumps(timeline_dict)
+                match_object.save()
+                print('Recovered match#{} timeline'.format(match_object.match_id))
+            except RetriesExhaustedError:
+                print("Riot API still returning errors, skipping this timeline")
 
         # Fix if result is missing, dependency for version
         if getattr(row, 'result_missing'):
-            error_retries_done = 0
-            tries_permitted = 2
-            while error_retries_done < tries_permitted:
-                try:
-                    result_dict = riotapi.get_match_result(
-                        riotapi_hosts.get_platform_by_region(match_object.region.name),
-                        match_object.match_id
-                    ).json()
-                    match_object.match_result_json = json.dumps(result_dict)
-                    match_object.save()
-                    print('Recovered match#{} result'.format(match_object.match_id))
-                    break
-                except RiotApiError as err:
-                    if err.response.status_code == 429:
-                        # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                        # https://developer.riotgames.com/rate-limiting.html
-                        if 'X-Rate-Limit-Type' not in err.response.headers:
-                            time.sleep(5)
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # if a service rate limit error, wait the time returned in header, and retry without counting it
-                        if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                            time.sleep(int(err.response.headers['Retry-After']))
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # else it is application or method rate limit error, something badly wrong in our rate limiting
-                        else:
-                            print("Really bad. Received {} rate limit error".format(
-                                err.response.headers['X-Rate-Limit-Type']))
-                            raise RiotApiError(err.response) from None
-                    else:
-                        print("Failed to load result for match {} (HTTP Error {}) - retry in 1,2,..".format(
-                            match_object.match_id,
-                            err.response.status_code))
-                        # One, two
-                        time.sleep(2)
-                        error_retries_done += 1
-            if error_retries_done == tries_permitted:
-                print(
-                    "Retried maximum of {} times - Riot API still returning errors, skipping this result".format(
-                        tries_permitted
-                    ))
+            try:
+                result_dict = retry_policy.call(riotapi, 'get_match_result',
+                                                riotapi_hosts.get_platform_by_region(match_object.region.name),
+                                                match_object.match_id,
+                                                description='result for match {}'.format(match_object.match_id)
+                                                ).json()
+                match_object.match_result_json = json.dumps(result_dict)
+                match_object.save()
+                print('Recovered match#{} result'.format(match_object.match_id))
+            except RetriesExhaustedError:
+                print("Riot API still returning errors, skipping this result")
                 # This also means we are unable to get version, so skip that too
                 continue
 
         # Fix if history is missing, relies on result_json
         if getattr(row, 'history_missing'):
-            error_retries_done = 0
-            tries_permitted = 2
-            while error_retries_done < tries_permitted:
+            def request_histories():
+                m_result = json.loads(match_object.match_result_json)
+                m_timeline = json.loads(match_object.match_timeline_json)
+                champion_lane_mapping = create_champion_lane_mapping(m_result, m_timeline)
+                stats_histories = {}
+                for p_identity in m_result['participantIdentities']:
+                    p_id = p_identity['participantId']
+                    p_data = next(filter(lambda p_d: p_d['participantId'] == p_id, m_result['participants']))
+                    p_history = get_stats_history(p_identity['player']['currentAccountId'],
+                                                  champion_lane_mapping[p_data['championId']],
+                                                  m_result['gameCreation'],
+                                                  riotapi,
+                                                  match_object.region,
+                                                  items_dictionaries,
+                                                  max_weeks_lookback=max_weeks_lookback,
+                                                  max_games_lookback=max_games_lookback)
+                    stats_histories[p_data['championId']] = p_history
+                return stats_histories
+
+            try:
                 try:
-                    m_result = json.loads(match_object.match_result_json)
-                    m_timeline = json.loads(match_object.match_timeline_json)
-                    try:
-                        stats_histories = {}
-                        for p_identity in m_result['participantIdentities']:
-                            p_id = p_identity['participantId']
-                            p_data = next(filter(lambda p_d: p_d['participantId'] == p_id, m_result['participants']))
-                            p_history = get_stats_history(p_identity['player']['currentAccountId'],
-                                                          create_champion_lane_mapping(m_result, m_timeline)[p_data['championId']],
-                                                          m_result['gameCreation'],
-                                                          riotapi,
-                                                          match_object.region,
-                                                          items_dictionaries,
-                                                          max_weeks_lookback=3, max_games_lookback=50)
-                            stats_histories[p_data['championId']] = p_history
-                        match_object.match_participants_histories_json = json.dumps(stats_histories)
-                    except ObjectDoesNotExist:
-                        print('Missing static data (items namely) for a historical game version')
-                        pass
-                    match_object.save()
-                    print('Recovered match#{} history'.format(match_object.match_id))
-                    break
-                except RiotApiError as err:
-                    if err.response.status_code == 429:
-                        # if service rate limit from underlying service with unknown rate limit mechanism, wait 5s
-                        # https://developer.riotgames.com/rate-limiting.html
-                        if 'X-Rate-Limit-Type' not in err.response.headers:
-                            time.sleep(5)
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # if a service rate limit error, wait the time returned in header, and retry without counting it
-                        if err.response.headers['X-Rate-Limit-Type'] == 'service':
-                            time.sleep(int(err.response.headers['Retry-After']))
-                            continue  # Try again (without counting this as a retry because service-rate)
-                        # else it is application or method rate limit error, something badly wrong in our rate limiting
-                        else:
-                            print("Really bad. Received {} rate limit error".format(
-                                err.response.headers['X-Rate-Limit-Type']))
-                            raise RiotApiError(err.response) from None
-                    else:
-                        print("Failed to load a historical match (HTTP Error {}) - retry in 1,2,..".format(
-                            err.response.status_code))
-                        # One, two
-                        time.sleep(2)
-                        error_retries_done += 1
-            if error_retries_done == tries_permitted:
-                print(
-                    "Retried maximum of {} times - Riot API still returning errors, skipping this history".format(
-                        tries_permitted
-                    ))
+                    match_object.match_participants_histories_json = json.dumps(
+                        retry_policy.run(request_histories, description='a historical match'))
+                except ObjectDoesNotExist:
+                    print('Missing static data (items namely) for a historical game version')
+                    pass
+                match_object.save()
+                print('Recovered match#{} history'.format(match_object.match_id))
+            except RetriesExhaustedError:
+                print("Riot API still returning errors, skipping this history")
 
         # Fix if version is missing, relies on result_json
         if getattr(row, 'version_missing'):
@@ -501,4 +476,11 @@ if __name__ == "__main__":
     parser.add_argument('--region', dest='region_name', required=True, help='Region name of target games')
     parser.add_argument('--semver', dest='semver', default=None, help='Optionally limit repairs to specific version')
     parser.add_argument('--logfile', dest='logfile', default=None, help='Logfile location')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only estimate the requests and time the repairs need, and the bottleneck rate limit')
+    parser.add_argument('--cache-hit-rate', dest='cache_hit_rate', type=float, default=0.0,
+                        help='Share of history games assumed to be stored already (for --dry-run, which measures it '
+                             'only for the incomplete games themselves)')
+    parser.add_argument('--seconds-per-request', dest='seconds_per_request', type=float, default=0.1,
+                        help='Average round trip of a request to the API, in seconds (for --dry-run)')
     main(parser.parse_args())
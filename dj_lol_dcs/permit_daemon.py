@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+from lolapi.app_lib.inmemory_requesthistory_checking import InMemoryRequestHistory
+from lolapi.app_lib.permit_server import PermitServer
+from lolapi.app_lib.request_priorities import RequestPriorities
+
+
+def main(args):
+    ratelimit_logfile_location = './{}'.format(args.logfile) if args.logfile else None
+    request_priorities = RequestPriorities(json.loads(args.priority_shares))
+    server = PermitServer(args.socket_location, InMemoryRequestHistory(ratelimit_logfile_location, request_priorities))
+    print('Serving rate limit permits at {}'.format(args.socket_location))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve rate limit permits to the gathering scripts on this host')
+    parser.add_argument('--socket', dest='socket_location', required=True,
+                        help='Unix domain socket location, same as the scripts\' RATELIMIT_PERMIT_SOCKET')
+    parser.add_argument('--logfile', dest='logfile', default=None, help='Logfile location')
+    parser.add_argument('--priority-shares', dest='priority_shares', default='{}',
+                        help='Reserved shares of capacity per priority class, e.g. {"LIVE_MATCH": 0.3, "HISTORY": 0.2}')
+    main(parser.parse_args())
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+import argparse
+import tempfile
+import random
+import json
+import math
+import time
+import csv
+import os
+
+import lolapi.app_lib.inmemory_requesthistory_checking as inmemory_requesthistory_checking
+import lolapi.app_lib.sharedmemory_requesthistory_checking as sharedmemory_requesthistory_checking
+from lolapi.app_lib.api_key_container import ApiKeyContainer, MethodRateLimits
+from lolapi.app_lib.riot_api import RiotApi
+from lolapi.app_lib.request_priorities import RequestPriorities
+from lolapi.app_lib.pacing_policy import PacingPolicy
+from lolapi.app_lib.riot_api_factory import METHOD_RATE_LIMITS
+
+
+class VirtualClock:
+    """Stands in for the time module of the backends; sleeping advances the clock instead of waiting
+
+       Every sleep advances at least by the resolution, as a backend re-checking a window at the very moment
+       it frees up would otherwise sleep(0) forever.
+    """
+
+    def __init__(self, start_time, resolution_seconds=0.001):
+        self.now = start_time
+        self.resolution_seconds = resolution_seconds
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, self.resolution_seconds)
+
+
+class RealClock:
+    """Wall clock for backends whose windows are kept by a database server (NOW()), which can't be virtualized"""
+
+    @staticmethod
+    def time():
+        return time.time()
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+
+def generate_synthetic_trace(kind, region_name, duration_seconds, seed):
+    """[[seconds-from-start, region, method, priority], ..] shaped like the gathering scripts' requests
+
+       active: a live match every minute, i.e. summoner + active match, 10 participants' summoners and tiers,
+               then their matchlists and a few games' results and timelines each, all requested at once
+       repair: a backlog of incomplete games, each needing a result and a timeline (and sometimes a matchlist)
+    """
+    rng = random.Random(seed)
+    methods = RiotApi.ENDPOINT_METHODS
+    trace = []
+    if kind == 'active':
+        for match_start in range(0, duration_seconds, 60):
+            offset = match_start + rng.uniform(0, 5)
+            requests = ['get_summoner', 'get_active_match'] + ['get_summoner', 'get_tiers'] * 10
+            for _ in range(10):
+                requests += ['get_matchlist'] + ['get_match_result', 'get_match_timeline'] * rng.randint(2, 8)
+            trace += [[offset, region_name, methods[endpoint], RequestPriorities.LIVE_MATCH] for endpoint in requests]
+    elif kind == 'repair':
+        for _ in range(duration_seconds * 20):
+            requests = ['get_match_result', 'get_match_timeline']
+            if rng.random() < 0.1:
+                requests.append('get_matchlist')
+            trace += [[0, region_name, methods[endpoint], RequestPriorities.REPAIR] for endpoint in requests]
+    else:
+        raise ValueError('Unknown synthetic trace {}'.format(kind))
+    return sorted(trace, key=lambda request: request[0])
+
+
+def load_trace(trace_location):
+    """CSV rows of seconds-from-start (or epoch), region, method and optionally the priority (name or number)"""
+    trace = []
+    with open(trace_location, newline='') as fh:
+        for row in csv.reader(fh):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            priority = RequestPriorities.LIVE_MATCH
+            if len(row) > 3 and row[3] != '':
+                priority = int(row[3]) if row[3].isdigit() else getattr(RequestPriorities, row[3])
+            trace.append([float(row[0]), row[1], row[2], priority])
+    trace.sort(key=lambda request: request[0])
+    first_offset = trace[0][0] if len(trace) > 0 else 0
+    return [[offset - first_offset] + request for offset, *request in trace]
+
+
+def create_backend(backend_name, work_dir, request_priorities):
+    """(backend, clock, modules-whose-time-is-replaced) for the backend name"""
+    logfile_location = os.devnull
+    if backend_name == 'inmemory':
+        return (inmemory_requesthistory_checking.InMemoryRequestHistory(logfile_location, request_priorities),
+                None, [inmemory_requesthistory_checking])
+    if backend_name == 'sharedmemory':
+        return (sharedmemory_requesthistory_checking.SharedMemoryRequestHistory(
+                    os.path.join(work_dir, 'ratelimits.shm'), logfile_location, request_priorities=request_priorities),
+                None, [sharedmemory_requesthistory_checking])
+    if backend_name == 'mysql':
+        from lolapi.app_lib.mysql_requesthistory_checking import MysqlRequestHistory
+        return (MysqlRequestHistory(os.environ['MYSQL_REQUESTHISTORY_USERNAME'],
+                                    os.environ['MYSQL_REQUESTHISTORY_PASSWORD'],
+                                    os.environ['MYSQL_REQUESTHISTORY_DBNAME'],
+                                    logfile_location,
+                                    request_priorities=request_priorities),
+                RealClock(), [])
+    if backend_name == 'postgresql':
+        import django
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'dj_lol_dcs.settings'
+        django.setup()
+        from lolapi.app_lib.postgresql_requesthistory_checking import PostgresqlRequestHistory
+        return PostgresqlRequestHistory(logfile_location, request_priorities=request_priorities), RealClock(), []
+    raise ValueError('Unknown backend {}'.format(backend_name))
+
+
+def percentile(sorted_values, share):
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(share * len(sorted_values))) - 1)]
+
+
+def analyze_windows(permit_times, max_requests, timeframe_size):
+    """(max requests within any window, number of requests that made a window exceed max_requests)
+
+       Windows are taken as [t - timeframe-size, t] ending at every permit, same as the backends count them.
+    """
+    max_in_window = 0
+    num_exceeding = 0
+    window_start_idx = 0
+    for idx, permit_time in enumerate(permit_times):
+        while permit_times[window_start_idx] < permit_time - timeframe_size:
+            window_start_idx += 1
+        in_window = idx - window_start_idx + 1
+        max_in_window = max(max_in_window, in_window)
+        if in_window > max_requests:
+            num_exceeding += 1
+    return max_in_window, num_exceeding
+
+
+def replay(backend_name, trace, api_key_container, configured_app_rate_limits, request_priorities):
+    with tempfile.TemporaryDirectory() as work_dir:
+        backend, clock, virtualized_modules = create_backend(backend_name, work_dir, request_priorities)
+        if clock is None:
+            clock = VirtualClock(time.time())
+        replaced_time_modules = [module.time for module in virtualized_modules]
+        for module in virtualized_modules:
+            module.time = clock
+        try:
+            start_time = clock.time()
+            latencies = []
+            permits = []
+            # One sequential client, like the gathering scripts: a request waits for its arrival and the previous one
+            for offset, region_name, method, priority in trace:
+                arrival_time = start_time + offset
+                if clock.time() < arrival_time:
+                    clock.sleep(arrival_time - clock.time())
+                backend.permit_request(api_key_container, region_name, method, 'ratelimit_benchmark', priority)
+                latencies.append(clock.time() - arrival_time)
+                permits.append((clock.time(), region_name, method))
+            elapsed_seconds = clock.time() - start_time
+        finally:
+            for module, replaced_time_module in zip(virtualized_modules, replaced_time_modules):
+                module.time = replaced_time_module
+
+    sorted_latencies = sorted(latencies)
+    print('\n[{}] {} requests in {:.1f} (simulated) seconds{}'.format(
+        backend_name, len(permits), elapsed_seconds, '' if isinstance(clock, VirtualClock) else ', wall clock'))
+    print('  permit latency p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, max {:.3f}s'.format(
+        percentile(sorted_latencies, 0.5),
+        percentile(sorted_latencies, 0.9),
+        percentile(sorted_latencies, 0.99),
+        percentile(sorted_latencies, 1)))
+    # Buckets as configured (i.e. without pacing), so the pacing's effect on utilization shows up too
+    method_rate_limits = MethodRateLimits(METHOD_RATE_LIMITS)
+    buckets = {}
+    for permit_time, region_name, method in permits:
+        buckets.setdefault((region_name, None), []).append(permit_time)
+        buckets.setdefault((region_name, method), []).append(permit_time)
+    for (region_name, method), permit_times in sorted(buckets.items(), key=lambda item: str(item[0])):
+        limits = (configured_app_rate_limits if method is None
+                  else method_rate_limits.get_rate_limit(method, region_name))
+        for max_requests, timeframe_size in limits:
+            max_in_window, num_exceeding = analyze_windows(permit_times, max_requests, timeframe_size)
+            # Share of the most the sliding windows allow over the run, i.e. a full window at its start and then
+            # the sustained rate
+            span_seconds = permit_times[-1] - start_time
+            utilization = len(permit_times) / (max_requests * (span_seconds + timeframe_size) / timeframe_size)
+            print('  {} {} [{}, {}]: {} requests, peak {}/{} per window, {:.0%} of quota used, {} exceeding{}'.format(
+                region_name,
+                method if method is not None else 'App ratelimit',
+                max_requests,
+                timeframe_size,
+                len(permit_times),
+                max_in_window,
+                max_requests,
+                utilization,
+                num_exceeding,
+                ' (!)' if num_exceeding > 0 else ''))
+
+
+def main(args):
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = generate_synthetic_trace(args.synthetic, args.region_name.upper(), args.duration, args.seed)
+    configured_app_rate_limits = json.loads(args.app_rate_limits)
+    pacing_policy = PacingPolicy(args.pacing_burst) if args.pacing_burst is not None else None
+    api_key_container = ApiKeyContainer('ratelimit_benchmark',
+                                        configured_app_rate_limits,
+                                        MethodRateLimits(METHOD_RATE_LIMITS),
+                                        pacing_policy=pacing_policy)
+    request_priorities = RequestPriorities(json.loads(args.priority_shares))
+    print('Replaying {} requests{}'.format(len(trace), ' paced' if pacing_policy is not None else ''))
+    for backend_name in args.backends.split(','):
+        replay(backend_name, trace, api_key_container, configured_app_rate_limits, request_priorities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a request trace against rate limiter backends, no API needed')
+    parser.add_argument('--trace', dest='trace', default=None,
+                        help='CSV of seconds (or epoch), region, method and optional priority per request')
+    parser.add_argument('--synthetic', dest='synthetic', default='active', choices=['active', 'repair'],
+                        help='Synthetic trace shaped like active_data_gathering.py or periodical_data_repair.py')
+    parser.add_argument('--region', dest='region_name', default='EUW', help='Region of the synthetic trace')
+    parser.add_argument('--duration', dest='duration', type=int, default=600, help='Seconds of synthetic trace')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the synthetic trace')
+    parser.add_argument('--backends', dest='backends', default='inmemory,sharedmemory',
+                        help='Comma separated inmemory, sharedmemory (virtual clock), mysql, postgresql (wall clock)')
+    parser.add_argument('--app-rate-limits', dest='app_rate_limits',
+                        default=os.environ.get('RIOT_APP_RATE_LIMITS_JSON', '[[20, 1], [100, 120]]'),
+                        help='App rate limits as [[num-requests, within-seconds], ..]')
+    parser.add_argument('--pacing-burst', dest='pacing_burst', type=int, default=None,
+                        help='Pace the limits with this burst allowance (as RATELIMIT_PACING_BURST)')
+    parser.add_argument('--priority-shares', dest='priority_shares', default='{}',
+                        help='Reserved shares of capacity per priority class, e.g. {"LIVE_MATCH": 0.3, "HISTORY": 0.2}')
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import argparse
+import json
+import time
+import os
+
+from lolapi.app_lib.unixsocket_requesthistory_checking import UnixSocketRequestHistory
+
+
+def print_metrics(metrics, max_rows):
+    print('Rate limit metrics since {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metrics['since']))))
+    print('{:<8} {:<6} {:<40} {:>6} {:>11} {:>9} {:>8}'.format(
+        'Key', 'Region', 'Method', 'Window', 'Requests', 'Headroom', 'Binding'))
+    for bucket in metrics['buckets'][:max_rows]:
+        print('{:<8} {:<6} {:<40} {:>5}s {:>11} {:>8.0%} {:>8}'.format(
+            bucket['api_key'],
+            bucket['region'],
+            bucket['method'] if bucket['method'] is not None else 'App ratelimit',
+            bucket['timeframe_size'],
+            '{}/{}'.format(bucket['requests_done'], bucket['max_requests']),
+            bucket['headroom'] or 0,
+            bucket['times_binding']))
+    print('')
+    print('{:<8} {:<6} {:<40} {:>8} {:>9} {:>10} {:>10}'.format(
+        'Key', 'Region', 'Method', 'Permits', 'Requests', 'Mean wait', 'Max wait'))
+    for permit in metrics['permits'][:max_rows]:
+        print('{:<8} {:<6} {:<40} {:>8} {:>9} {:>9.3f}s {:>9.3f}s'.format(
+            permit['api_key'],
+            permit['region'],
+            permit['method'],
+            permit['permits_granted'],
+            permit['requests_granted'],
+            permit['wait_seconds_sum'] / permit['permits_granted'],
+            permit['wait_seconds_max']))
+
+
+def read_exported_metrics(file_location):
+    """The latest snapshot of each process exporting its metrics to the file (RATELIMIT_METRICS_FILE)"""
+    latest_per_process = {}
+    with open(file_location) as fh:
+        for line in fh:
+            metrics = json.loads(line)
+            latest_per_process[(metrics['host'], metrics['pid'])] = metrics
+    return list(latest_per_process.values())
+
+
+def main(args):
+    request_history_backend = None
+    if args.file_location is None:
+        request_history_backend = UnixSocketRequestHistory(args.socket_location)
+    while True:
+        if request_history_backend is not None:
+            metrics_per_process = [request_history_backend.get_metrics()]
+        else:
+            metrics_per_process = read_exported_metrics(args.file_location)
+        for metrics in metrics_per_process:
+            if args.json:
+                print(json.dumps(metrics))
+            else:
+                if 'pid' in metrics:
+                    print('Process {} on {}, exported at {}'.format(
+                        metrics['pid'],
+                        metrics['host'],
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metrics['exported_at']))))
+                print_metrics(metrics, args.max_rows)
+                print('')
+        if args.watch_seconds is None:
+            break
+        time.sleep(args.watch_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Show which rate limits of the permit daemon (or of the scripts exporting them) are throttling')
+    parser.add_argument('--socket', dest='socket_location', default=os.environ.get('RATELIMIT_PERMIT_SOCKET', None),
+                        help='Unix domain socket location of the permit daemon, RATELIMIT_PERMIT_SOCKET by default')
+    parser.add_argument('--file', dest='file_location', default=None,
+                        help='Metrics exported by the scripts instead of the permit daemon\'s, RATELIMIT_METRICS_FILE '
+                             'by default if there is no socket')
+    parser.add_argument('--json', dest='json', action='store_true', help='Export the metrics as a line of JSON')
+    parser.add_argument('--watch', dest='watch_seconds', type=float, default=None,
+                        help='Repeat every n seconds instead of once')
+    parser.add_argument('--max-rows', dest='max_rows', type=int, default=20, help='Rows per table')
+    parsed_args = parser.parse_args()
+    if parsed_args.socket_location is None and parsed_args.file_location is None:
+        parsed_args.file_location = os.environ.get('RATELIMIT_METRICS_FILE', None)
+    if parsed_args.socket_location is None and parsed_args.file_location is None:
+        parser.error('--socket (or RATELIMIT_PERMIT_SOCKET) or --file (or RATELIMIT_METRICS_FILE) is required')
+    main(parsed_args)